@@ -0,0 +1,127 @@
+"""Benchmark of the process and thread backends for the pre- and post-processing of a batch of images.
+
+Both backends process the same images, with the same pre-processing parameters as the pipeline. The post-processing
+is run on the ground truth as segmentation, which is sufficient to measure its execution time.
+"""
+import argparse
+import os
+import sys
+import timeit
+
+import numpy as np
+import SimpleITK as sitk
+
+try:
+    import mialab.data.structure as structure
+    import mialab.utilities.file_access_utilities as futil
+    import mialab.utilities.pipeline_utilities as putil
+except ImportError:
+    # Append the MIALab root directory to Python path
+    sys.path.insert(0, os.path.join(os.path.dirname(sys.argv[0]), '..'))
+    import mialab.data.structure as structure
+    import mialab.utilities.file_access_utilities as futil
+    import mialab.utilities.pipeline_utilities as putil
+
+LOADING_KEYS = [structure.BrainImageTypes.T1w,
+                structure.BrainImageTypes.T2w,
+                structure.BrainImageTypes.GroundTruth,
+                structure.BrainImageTypes.BrainMask,
+                structure.BrainImageTypes.RegistrationTransform]  # the list of data we will load
+
+
+def main(data_atlas_dir: str, data_dir: str, backends: list, n_workers: int, repetitions: int):
+    """Measures the execution time of the pre- and post-processing for each backend.
+
+    Args:
+        data_atlas_dir (str): Directory with atlas data.
+        data_dir (str): Directory with the images to process.
+        backends (list): The backends to compare.
+        n_workers (int): The number of processes or threads, None to use the CPUs allocated by SLURM or available.
+        repetitions (int): The number of repetitions per backend, of which the fastest is reported.
+    """
+    putil.load_atlas_images(data_atlas_dir)
+
+    pre_process_params = {'skullstrip_pre': True,
+                          'normalization_pre': True,
+                          'registration_pre': True,
+                          'coordinates_feature': True,
+                          'intensity_feature': True,
+                          'gradient_intensity_feature': True,
+                          'sampling_seed': 42}
+    post_process_params = {'simple_post': True}
+
+    crawler = futil.FileSystemDataCrawler(data_dir, LOADING_KEYS, futil.BrainImageFilePathGenerator(),
+                                          futil.DataDirectoryFilter())
+
+    times = {}
+    for backend in backends:
+        pre_times, post_times = [], []
+        for _ in range(repetitions):
+            start_time = timeit.default_timer()
+            images = putil.pre_process_batch(crawler.data, pre_process_params, n_workers=n_workers,
+                                             backend=backend)
+            pre_times.append(timeit.default_timer() - start_time)
+
+            segmentations = [sitk.Cast(img.images[structure.BrainImageTypes.GroundTruth], sitk.sitkUInt8)
+                             for img in images]
+            probabilities = [structure.ProbabilityMap(np.eye(6, dtype=np.float32)[
+                                                          sitk.GetArrayViewFromImage(segmentation).reshape(-1)],
+                                                      img.image_properties)
+                             for img, segmentation in zip(images, segmentations)]
+
+            start_time = timeit.default_timer()
+            putil.post_process_batch(images, segmentations, probabilities, post_process_params,
+                                     n_workers=n_workers, backend=backend)
+            post_times.append(timeit.default_timer() - start_time)
+        times[backend] = min(pre_times), min(post_times)
+
+    print('\n{:<10} {:>18} {:>18}'.format('BACKEND', 'PRE-PROCESS [s]', 'POST-PROCESS [s]'))
+    for backend, (pre_time, post_time) in times.items():
+        print('{:<10} {:>18.2f} {:>18.2f}'.format(backend, pre_time, post_time))
+
+
+if __name__ == "__main__":
+    """The program's entry point."""
+
+    script_dir = os.path.dirname(sys.argv[0])
+
+    parser = argparse.ArgumentParser(description='Benchmark of the multi-processing backends')
+
+    parser.add_argument(
+        '--data_atlas_dir',
+        type=str,
+        default=os.path.normpath(os.path.join(script_dir, '../mialab/data/atlas')),
+        help='Directory with atlas data.'
+    )
+
+    parser.add_argument(
+        '--data_dir',
+        type=str,
+        default=os.path.normpath(os.path.join(script_dir, '../mialab/data/train/')),
+        help='Directory with the images to process.'
+    )
+
+    parser.add_argument(
+        '--backends',
+        type=str,
+        nargs='+',
+        default=['process', 'thread'],
+        help='The backends to compare.'
+    )
+
+    parser.add_argument(
+        '--n_workers',
+        type=int,
+        default=None,
+        help='Number of processes or threads, defaults to the CPUs allocated by SLURM or available.'
+    )
+
+    parser.add_argument(
+        '--repetitions',
+        type=int,
+        default=1,
+        help='Number of repetitions per backend, of which the fastest is reported.'
+    )
+
+    args = parser.parse_args()
+    main(args.data_atlas_dir, args.data_dir, args.backends, args.n_workers, args.repetitions)
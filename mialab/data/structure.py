@@ -1,6 +1,7 @@
 """The data structure module holds model classes."""
 import enum
 
+import numpy as np
 import pymia.data.conversion as conversion
 import SimpleITK as sitk
 
@@ -14,10 +15,17 @@ class BrainImageTypes(enum.Enum):
     RegistrationTransform = 5  #: The registration transformation
 
 
+class RetentionPolicy(enum.Enum):
+    """Represents the data a brain image retains after the feature extraction."""
+    ALL = 1  #: All images, e.g. to segment, post-process and evaluate the image.
+    FEATURE_MATRIX = 2  #: The feature matrix with the labels and the image properties only, e.g. for training.
+
+
 class BrainImage:
     """Represents a brain image."""
 
-    def __init__(self, id_: str, path: str, images: dict, transformation: sitk.Transform):
+    def __init__(self, id_: str, path: str, images: dict, transformation: sitk.Transform,
+                 image_properties: conversion.ImageProperties = None):
         """Initializes a new instance of the BrainImage class.
 
         Args:
@@ -25,6 +33,8 @@ class BrainImage:
             path (str): Full path to the image directory.
             images (dict): The images, where the key is a :py:class:`BrainImageTypes` and the value is a
              SimpleITK image.
+            image_properties (conversion.ImageProperties): The image properties, or None to get them from the first
+                image.
         """
 
         self.id_ = id_
@@ -33,11 +43,76 @@ class BrainImage:
         self.transformation = transformation
 
         # ensure we have an image to get the image properties
-        if len(images) == 0:
+        if len(images) == 0 and image_properties is None:
             raise ValueError('No images provided')
 
-        self.image_properties = conversion.ImageProperties(self.images[list(self.images.keys())[0]])
+        self.image_properties = image_properties if image_properties is not None else \
+            conversion.ImageProperties(self.images[next(iter(self.images))])
         self.feature_images = {}
         self.feature_matrix = None  # a tuple (features, labels),
         # where the shape of features is (n, number_of_features) and the shape of labels is (n, 1)
-        # with n being the amount of voxels
\ No newline at end of file
+        # with n being the amount of voxels
+        self.roi = None  # a tuple (index, size) of the region of interest the images are cropped to, or None
+        self.full_image_properties = None  # the image properties before cropping to the region of interest
+
+    def retain(self, policy: RetentionPolicy):
+        """Releases the data not retained by a policy.
+
+        The feature images are released by any policy because only the feature matrix is needed after the feature
+        extraction.
+
+        Args:
+            policy (RetentionPolicy): The retention policy.
+        """
+        self.feature_images = {}
+        if policy == RetentionPolicy.FEATURE_MATRIX:
+            self.images.clear()
+
+
+class ProbabilityMap:
+    """Represents the voxel-wise class probabilities of an image in a compact form.
+
+    The probabilities are stored as float32 or quantized to uint8, and converted to a SimpleITK image only on demand.
+    """
+
+    def __init__(self, probabilities: np.ndarray, image_properties: conversion.ImageProperties,
+                 quantize: bool = False):
+        """Initializes a new instance of the ProbabilityMap class.
+
+        Args:
+            probabilities (np.ndarray): The probabilities of shape (n, number_of_classes) with n being the amount of
+                voxels.
+            image_properties (conversion.ImageProperties): The properties of the image the probabilities belong to.
+            quantize (bool): Whether to quantize the probabilities to uint8 with a step of 1/255 instead of float32.
+        """
+
+        self.image_properties = image_properties
+        if quantize:
+            self.array = np.rint(probabilities * 255).astype(np.uint8)
+            self.scale = 1 / 255
+        else:
+            self.array = probabilities.astype(np.float32, copy=False)
+            self.scale = None
+
+    @property
+    def nbytes(self) -> int:
+        """int: The number of bytes of the stored probabilities."""
+        return self.array.nbytes
+
+    def to_array(self) -> np.ndarray:
+        """Gets the probabilities.
+
+        Returns:
+            np.ndarray: The float32 probabilities of shape (n, number_of_classes).
+        """
+        if self.scale is None:
+            return self.array
+        return self.array.astype(np.float32) * np.float32(self.scale)
+
+    def to_image(self) -> sitk.Image:
+        """Gets the probabilities as image.
+
+        Returns:
+            sitk.Image: The probabilities as float32 vector image with one component per class.
+        """
+        return conversion.NumpySimpleITKImageBridge.convert(self.to_array(), self.image_properties)
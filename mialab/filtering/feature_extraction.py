@@ -1,4 +1,5 @@
 """The feature extraction module contains classes for feature extraction."""
+import functools
 import sys
 
 import numpy as np
@@ -6,6 +7,58 @@ import pymia.filtering.filter as fltr
 import SimpleITK as sitk
 
 
+@functools.lru_cache(maxsize=4)
+def _get_atlas_coordinates(size: tuple, origin: tuple, spacing: tuple, direction: tuple) -> np.ndarray:
+    """Computes the physical coordinates of all voxels of an image geometry.
+
+    Args:
+        size (tuple of int): The image size.
+        origin (tuple of float): The image origin.
+        spacing (tuple of float): The image spacing.
+        direction (tuple of float): The image direction cosines (row-major).
+
+    Returns:
+        np.ndarray: A read-only float32 array of shape (z, y, x, 3) with the physical x, y, z coordinates in mm.
+    """
+    x, y, z = size
+    index_to_physical = np.reshape(direction, (3, 3)) * np.asarray(spacing)[np.newaxis, :]
+
+    # physical point = origin + direction * spacing * index, accumulated by broadcasting the index along each axis
+    coords = np.empty((z, y, x, 3), np.float32)
+    coords[...] = np.asarray(origin, np.float32)
+    coords += np.arange(x, dtype=np.float32)[np.newaxis, np.newaxis, :, np.newaxis] * \
+        index_to_physical[:, 0].astype(np.float32)
+    coords += np.arange(y, dtype=np.float32)[np.newaxis, :, np.newaxis, np.newaxis] * \
+        index_to_physical[:, 1].astype(np.float32)
+    coords += np.arange(z, dtype=np.float32)[:, np.newaxis, np.newaxis, np.newaxis] * \
+        index_to_physical[:, 2].astype(np.float32)
+
+    coords.flags.writeable = False
+    return coords
+
+
+def get_atlas_coordinates(image: sitk.Image) -> np.ndarray:
+    """Gets the atlas coordinates of an image.
+
+    The coordinates only depend on the image geometry, which is the same for all images registered to the atlas.
+    They are therefore computed once per geometry and process and shared among all callers.
+
+    Args:
+        image (sitk.Image): The image.
+
+    Returns:
+        np.ndarray: A read-only float32 array of shape (z, y, x, 3) with the physical x, y, z coordinates in mm.
+
+    Raises:
+        ValueError: If image is not 3-D.
+    """
+
+    if image.GetDimension() != 3:
+        raise ValueError('image needs to be 3-D')
+
+    return _get_atlas_coordinates(image.GetSize(), image.GetOrigin(), image.GetSpacing(), image.GetDirection())
+
+
 class AtlasCoordinates(fltr.Filter):
     """Represents an atlas coordinates feature extractor."""
 
@@ -28,30 +81,7 @@ class AtlasCoordinates(fltr.Filter):
             ValueError: If image is not 3-D.
         """
 
-        if image.GetDimension() != 3:
-            raise ValueError('image needs to be 3-D')
-
-        x, y, z = image.GetSize()
-
-        # create matrix with homogenous indices in axis 3
-        coords = np.zeros((x, y, z, 4))
-        coords[..., 0] = np.arange(x)[:, np.newaxis, np.newaxis]
-        coords[..., 1] = np.arange(y)[np.newaxis, :, np.newaxis]
-        coords[..., 2] = np.arange(z)[np.newaxis, np.newaxis, :]
-        coords[..., 3] = 1
-
-        # reshape such that each voxel is one row
-        lin_coords = np.reshape(coords, [coords.shape[0] * coords.shape[1] * coords.shape[2], 4])
-
-        # generate transformation matrix
-        tmp_mat = image.GetDirection() + image.GetOrigin()
-        tfm = np.reshape(tmp_mat, [3, 4], order='F')
-        tfm = np.vstack((tfm, [0, 0, 0, 1]))
-
-        atlas_coords = (tfm @ np.transpose(lin_coords))[0:3, :]
-        atlas_coords = np.reshape(np.transpose(atlas_coords), [z, y, x, 3], 'F')
-
-        img_out = sitk.GetImageFromArray(atlas_coords)
+        img_out = sitk.GetImageFromArray(get_atlas_coordinates(image))
         img_out.CopyInformation(image)
 
         return img_out
@@ -121,15 +151,115 @@ def first_order_texture_features_function(values):
                      ])
 
 
+def first_order_texture_features_batch_function(values):
+    """Calculates first-order texture features for a batch of neighborhoods.
+
+    This is the vectorized counterpart of :py:func:`first_order_texture_features_function`, i.e. row ``i`` of the
+    result equals ``first_order_texture_features_function(values[i])``.
+
+    Args:
+        values (np.array): The neighborhoods of shape (n, ...), where the first axis indexes the neighborhoods.
+
+    Returns:
+        np.array: An array of shape (n, 16) containing the first-order texture features of each neighborhood
+        (see :py:func:`first_order_texture_features_function` for the order of the features).
+    """
+    eps = sys.float_info.epsilon  # to avoid division by zero
+
+    num_values = values.shape[1]  # equals len() of a single neighborhood
+    values = values.reshape((values.shape[0], -1))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.mean(values, axis=1)
+        centered = values - mean[:, np.newaxis]
+        centered_sq = centered * centered  # explicit products are considerably faster than the power operator
+        variance = np.mean(centered_sq, axis=1)
+        std = np.sqrt(variance)
+        snr = np.where(std != 0, mean / np.where(std != 0, std, 1), 0)
+        p = values / (np.sum(values, axis=1, keepdims=True) + eps)
+
+        # sort once and linearly interpolate the percentiles as np.percentile does
+        sorted_values = np.sort(values, axis=1)
+        min_ = sorted_values[:, 0]
+        max_ = sorted_values[:, -1]
+        percentiles = []
+        for q in (10, 25, 50, 75, 90):
+            position = q / 100 * (values.shape[1] - 1)
+            lower = int(np.floor(position))
+            upper = min(lower + 1, values.shape[1] - 1)
+            percentiles.append(sorted_values[:, lower] +
+                               (position - lower) * (sorted_values[:, upper] - sorted_values[:, lower]))
+
+        return np.column_stack([mean,
+                                variance,
+                                std,
+                                np.sqrt(num_values * (num_values - 1)) / (num_values - 2) *
+                                np.sum(centered_sq * centered, axis=1) / (num_values * std ** 3 + eps),  # skewness
+                                np.sum(centered_sq * centered_sq, axis=1) / (num_values * std ** 4 + eps),  # kurtosis
+                                np.sum(-p * np.log2(p), axis=1),  # entropy
+                                np.sum(p ** 2, axis=1),  # energy
+                                snr,
+                                min_,
+                                max_,
+                                max_ - min_,
+                                *percentiles
+                                ])
+
+
+# maps per-neighborhood functions to their vectorized counterparts used by NeighborhoodFeatureExtractor
+_BATCH_FUNCTIONS = {first_order_texture_features_function: first_order_texture_features_batch_function}
+
+
+def _gather_neighborhoods(image_array: np.ndarray, kernel: tuple, indices: np.ndarray) -> np.ndarray:
+    """Gathers the neighborhoods of some voxels as placed by :py:class:`NeighborhoodFeatureExtractor`.
+
+    Only the neighborhoods are read, i.e. the symmetric padding at the end of each axis is resolved by index
+    reflection instead of padding the whole image.
+
+    Args:
+        image_array (np.ndarray): The image array of shape (z, y, x).
+        kernel (tuple of int): The neighborhood size in x, y, and z direction.
+        indices (np.ndarray): The flat indices of the voxels.
+
+    Returns:
+        np.ndarray: The neighborhoods of shape (n, z, y, x).
+    """
+    neighborhood_indices = []
+    for start, size_, length in zip(np.unravel_index(indices, image_array.shape), kernel[::-1], image_array.shape):
+        axis_indices = start[:, np.newaxis] + np.arange(size_)
+        neighborhood_indices.append(np.where(axis_indices < length, axis_indices, 2 * length - 1 - axis_indices))
+
+    z, y, x = neighborhood_indices
+    return image_array[z[:, :, np.newaxis, np.newaxis],
+                       y[:, np.newaxis, :, np.newaxis],
+                       x[:, np.newaxis, np.newaxis, :]]
+
+
 class NeighborhoodFeatureExtractor(fltr.Filter):
     """Represents a feature extractor filter, which works on a neighborhood."""
 
-    def __init__(self, kernel=(3, 3, 3), function_=first_order_texture_features_function):
-        """Initializes a new instance of the NeighborhoodFeatureExtractor class."""
+    def __init__(self, kernel=(3, 3, 3), function_=first_order_texture_features_function, batch_function_=None,
+                 slab_size: int = 8):
+        """Initializes a new instance of the NeighborhoodFeatureExtractor class.
+
+        Args:
+            kernel (tuple of int): The neighborhood size in x, y, and z direction.
+            function_ (callable): The function calculating the feature(s) of a single neighborhood.
+            batch_function_ (callable): The vectorized counterpart of ``function_``, which receives an array of shape
+                (n, z, y, x) with n neighborhoods and returns the n features along the first axis. If None, a known
+                counterpart of ``function_`` is used if available, otherwise ``function_`` is called per voxel.
+                If ``function_`` provides a method ``execute_neighborhoods(image_array, kernel)``, such as
+                :py:class:`RollingHistogramFeatures`, this method computes the features of all neighborhoods instead,
+                and its method ``execute_at(image_array, kernel, indices)`` the features of some neighborhoods.
+            slab_size (int): The number of z-slices whose neighborhoods are processed at once by the batch function.
+                None processes the whole image at once, which is the fastest but requires the most memory.
+        """
         super().__init__()
         self.neighborhood_radius = 3
         self.kernel = kernel
         self.function = function_
+        self.batch_function = batch_function_ if batch_function_ is not None else _BATCH_FUNCTIONS.get(function_)
+        self.slab_size = slab_size
 
     def execute(self, image: sitk.Image, params: fltr.FilterParams = None) -> sitk.Image:
         """Executes a neighborhood feature extractor on an image.
@@ -171,18 +301,56 @@ class NeighborhoodFeatureExtractor(fltr.Filter):
         pad = ((0, z_offset), (0, y_offset), (0, x_offset))
         img_arr_padded = np.pad(img_arr, pad, 'symmetric')
 
-        for xx in range(x):
-            for yy in range(y):
-                for zz in range(z):
+        # view with the neighborhood of voxel (zz, yy, xx) at windows[zz, yy, xx]
+        windows = np.lib.stride_tricks.sliding_window_view(img_arr_padded, (z_offset, y_offset, x_offset))
+        windows = windows[:z, :y, :x]
 
-                    val = self.function(img_arr_padded[zz:zz + z_offset, yy:yy + y_offset, xx:xx + x_offset])
-                    img_out_arr[zz, yy, xx] = val
+        if hasattr(self.function, 'execute_neighborhoods'):
+            img_out_arr[...] = np.reshape(self.function.execute_neighborhoods(img_arr, self.kernel), img_out_arr.shape)
+        elif self.batch_function is None:
+            for zz, yy, xx in np.ndindex(z, y, x):
+                img_out_arr[zz, yy, xx] = self.function(windows[zz, yy, xx])
+        else:
+            slab_size = z if self.slab_size is None else max(1, self.slab_size)
+            for z_start in range(0, z, slab_size):
+                z_stop = min(z_start + slab_size, z)
+                batch = windows[z_start:z_stop].reshape((-1, z_offset, y_offset, x_offset))
+                img_out_arr[z_start:z_stop] = np.reshape(self.batch_function(batch), img_out_arr[z_start:z_stop].shape)
 
         img_out = sitk.GetImageFromArray(img_out_arr)
         img_out.CopyInformation(image)
 
         return img_out
 
+    def execute_at(self, image: sitk.Image, indices: np.ndarray) -> np.ndarray:
+        """Executes a neighborhood feature extractor on some voxels of an image only.
+
+        Args:
+            image (sitk.Image): The image.
+            indices (np.ndarray): The flat indices (in the order of ``sitk.GetArrayFromImage``) of the voxels.
+
+        Returns:
+            np.ndarray: The features of shape (n, number_of_features).
+
+        Raises:
+            ValueError: If image is not 3-D.
+        """
+
+        if image.GetDimension() != 3:
+            raise ValueError('image needs to be 3-D')
+
+        if hasattr(self.function, 'execute_at'):
+            features = self.function.execute_at(sitk.GetArrayViewFromImage(image), self.kernel, indices)
+            return np.reshape(features, (indices.size, -1)).astype(np.float32)
+
+        neighborhoods = _gather_neighborhoods(sitk.GetArrayViewFromImage(image), self.kernel, indices)
+        if self.batch_function is not None:
+            features = self.batch_function(neighborhoods)
+        else:
+            features = np.array([self.function(neighborhood) for neighborhood in neighborhoods])
+
+        return np.reshape(features, (indices.size, -1)).astype(np.float32)
+
     def __str__(self):
         """Gets a printable string representation.
 
@@ -193,6 +361,406 @@ class NeighborhoodFeatureExtractor(fltr.Filter):
             .format(self=self)
 
 
+def _box_sum(array: np.ndarray, size: tuple) -> np.ndarray:
+    """Sums an array over boxes using separable running sums.
+
+    Args:
+        array (np.ndarray): The array.
+        size (tuple of int): The box size along each axis of the array.
+
+    Returns:
+        np.ndarray: The box sums, where element i is the sum of the box starting at i. Each axis shrinks by the box
+        size minus one.
+    """
+    for axis, size_ in enumerate(size):
+        array = np.moveaxis(array, axis, 0)
+        length = array.shape[0] - size_ + 1
+        if size_ <= 8:
+            # adding the shifted arrays is faster than the cumulative sum for small boxes
+            box_sum = array[:length].copy()
+            for offset in range(1, size_):
+                box_sum += array[offset:offset + length]
+        else:
+            # keeping the data type is exact for unsigned integers as long as the box sums do not overflow
+            cumsum = np.cumsum(array, axis=0, dtype=array.dtype)
+            box_sum = cumsum[size_ - 1:].copy()
+            box_sum[1:] -= cumsum[:-size_]
+        array = np.moveaxis(box_sum, 0, axis)
+    return array
+
+
+class NeighborhoodMomentsExtractor(fltr.Filter):
+    """Represents a feature extractor filter, which calculates local moments on a neighborhood.
+
+    The local raw moments of order one to four are obtained from box sums of the powers of the image, such that the
+    costs per voxel are independent of the neighborhood size. The neighborhoods are placed as in
+    :py:class:`NeighborhoodFeatureExtractor`.
+    """
+
+    def __init__(self, kernels=((3, 3, 3),)):
+        """Initializes a new instance of the NeighborhoodMomentsExtractor class.
+
+        Args:
+            kernels (list of tuple): The neighborhood sizes in x, y, and z direction.
+        """
+        super().__init__()
+        self.kernels = kernels
+
+    def execute(self, image: sitk.Image, params: fltr.FilterParams = None) -> sitk.Image:
+        """Executes a neighborhood moments feature extractor on an image.
+
+        Args:
+            image (sitk.Image): The image.
+            params (fltr.FilterParams): The parameters (unused).
+
+        Returns:
+            sitk.Image: The moments image (a vector image with six components per kernel, which represent the mean,
+            variance, sigma, skewness, kurtosis, and snr of the neighborhood).
+
+        Raises:
+            ValueError: If image is not 3-D.
+        """
+
+        if image.GetDimension() != 3:
+            raise ValueError('image needs to be 3-D')
+
+        img_arr = sitk.GetArrayFromImage(image).astype(np.float64)
+        z, y, x = img_arr.shape
+
+        # the moments are invariant to a shift except the mean, shifting reduces the loss of precision
+        shift = np.mean(img_arr)
+        img_arr -= shift
+
+        features = []
+        for kernel in self.kernels:
+            x_offset, y_offset, z_offset = kernel
+            pad = ((0, z_offset), (0, y_offset), (0, x_offset))
+            img_arr_padded = np.pad(img_arr, pad, 'symmetric')
+            num_values = x_offset * y_offset * z_offset
+
+            powers = img_arr_padded.copy()
+            raw_moments = []
+            for _ in range(4):
+                raw_moments.append(_box_sum(powers, (z_offset, y_offset, x_offset))[:z, :y, :x] / num_values)
+                powers *= img_arr_padded
+
+            features.extend(self._get_features(*raw_moments, num_values, shift))
+
+        img_out = sitk.GetImageFromArray(np.stack(features, axis=-1).astype(np.float32))
+        img_out.CopyInformation(image)
+
+        return img_out
+
+    def execute_at(self, image: sitk.Image, indices: np.ndarray) -> np.ndarray:
+        """Executes a neighborhood moments feature extractor on some voxels of an image only.
+
+        Args:
+            image (sitk.Image): The image.
+            indices (np.ndarray): The flat indices (in the order of ``sitk.GetArrayFromImage``) of the voxels.
+
+        Returns:
+            np.ndarray: The features of shape (n, 6 * number_of_kernels), ordered as the components of
+            :py:meth:`execute`.
+
+        Raises:
+            ValueError: If image is not 3-D.
+        """
+
+        if image.GetDimension() != 3:
+            raise ValueError('image needs to be 3-D')
+
+        img_arr = sitk.GetArrayViewFromImage(image)
+        shift = np.mean(img_arr, dtype=np.float64)
+
+        features = []
+        for kernel in self.kernels:
+            neighborhoods = _gather_neighborhoods(img_arr, kernel, indices).reshape((indices.size, -1))
+            neighborhoods = neighborhoods.astype(np.float64) - shift
+            num_values = neighborhoods.shape[1]
+
+            powers = neighborhoods.copy()
+            raw_moments = []
+            for _ in range(4):
+                raw_moments.append(np.mean(powers, axis=1))
+                powers *= neighborhoods
+
+            features.extend(self._get_features(*raw_moments, num_values, shift))
+
+        return np.stack(features, axis=-1).astype(np.float32)
+
+    @staticmethod
+    def _get_features(m1, m2, m3, m4, num_values: int, shift: float) -> list:
+        """Gets the features from the raw moments of the shifted intensities.
+
+        Returns:
+            list of np.ndarray: The mean, variance, sigma, skewness, kurtosis, and snr.
+        """
+        eps = sys.float_info.epsilon  # to avoid division by zero
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            variance = m2 - m1 ** 2
+            # a variance within the rounding error of the raw moments belongs to a constant neighborhood
+            constant = variance <= 16 * np.finfo(np.float64).eps * m2
+            variance[constant] = 0
+            std = np.sqrt(variance)
+            mean = m1 + shift
+            snr = np.where(std != 0, mean / np.where(std != 0, std, 1), 0)
+            central_m3 = m3 - 3 * m1 * m2 + 2 * m1 ** 3
+            central_m4 = m4 - 4 * m1 * m3 + 6 * m1 ** 2 * m2 - 3 * m1 ** 4
+            skewness = np.where(constant, 0, central_m3 / (std ** 3 + eps))
+            if num_values > 2:
+                # adjusted Fisher-Pearson coefficient of skewness
+                skewness *= np.sqrt(num_values * (num_values - 1)) / (num_values - 2)
+            kurtosis = np.where(constant, 0, central_m4 / (variance ** 2 + eps))
+
+        return [mean, variance, std, skewness, kurtosis, snr]
+
+    def __str__(self):
+        """Gets a printable string representation.
+
+        Returns:
+            str: String representation.
+        """
+        return 'NeighborhoodMomentsExtractor:\n' \
+               ' kernels:  {self.kernels}\n' \
+            .format(self=self)
+
+
+class RollingHistogramFeatures:
+    """Represents rank and histogram features on quantized intensities.
+
+    The intensities are quantized into a fixed number of bins. The histograms of all neighborhoods are obtained by
+    running sums of the bin indicators along each axis, i.e. the histogram is updated incrementally while the
+    neighborhood slides over the image. The percentiles, minimum, and maximum are thus approximated by bin centers.
+
+    An instance can be used as ``function_`` of :py:class:`NeighborhoodFeatureExtractor`. The features are:
+
+        - min
+        - max
+        - range
+        - percentile10th
+        - percentile25th
+        - percentile50th
+        - percentile75th
+        - percentile90th
+        - entropy (of the intensity histogram)
+    """
+
+    PERCENTILES = (10, 25, 50, 75, 90)
+
+    def __init__(self, bins: int = 32, value_range: tuple = None):
+        """Initializes a new instance of the RollingHistogramFeatures class.
+
+        Args:
+            bins (int): The number of quantization bins.
+            value_range (tuple of float): The (lower, upper) intensity range to quantize. If None, the intensity range
+                of the image is used by :py:meth:`execute_neighborhoods` and :py:meth:`execute_at`, such that both
+                quantize equally, respectively the range of the neighborhood when called on a single neighborhood.
+        """
+        self.bins = bins
+        self.value_range = value_range
+
+    def __call__(self, values: np.ndarray) -> np.ndarray:
+        """Calculates the features of a single neighborhood.
+
+        Args:
+            values (np.ndarray): The values of the neighborhood.
+
+        Returns:
+            np.ndarray: A vector containing the features.
+        """
+        low, high = self._get_range(values)
+        return self._get_features(np.reshape(values, (1, -1)), low, high)[0]
+
+    def execute_at(self, image_array: np.ndarray, kernel: tuple, indices: np.ndarray) -> np.ndarray:
+        """Calculates the features of some neighborhoods of an image.
+
+        The neighborhoods are placed and quantized as by :py:meth:`execute_neighborhoods`.
+
+        Args:
+            image_array (np.ndarray): The image array of shape (z, y, x).
+            kernel (tuple of int): The neighborhood size in x, y, and z direction.
+            indices (np.ndarray): The flat indices of the voxels.
+
+        Returns:
+            np.ndarray: The features of shape (n, 9).
+        """
+        low, high = self._get_range(image_array)
+        neighborhoods = _gather_neighborhoods(image_array, kernel, indices)
+        return self._get_features(np.reshape(neighborhoods, (indices.size, -1)), low, high).astype(np.float32)
+
+    def execute_neighborhoods(self, image_array: np.ndarray, kernel: tuple) -> np.ndarray:
+        """Calculates the features of all neighborhoods of an image.
+
+        The neighborhoods are placed as in :py:class:`NeighborhoodFeatureExtractor`.
+
+        Args:
+            image_array (np.ndarray): The image array of shape (z, y, x).
+            kernel (tuple of int): The neighborhood size in x, y, and z direction.
+
+        Returns:
+            np.ndarray: The features of shape (z, y, x, 9).
+        """
+        z, y, x = image_array.shape
+        x_offset, y_offset, z_offset = kernel
+        num_values = x_offset * y_offset * z_offset
+
+        low, high = self._get_range(image_array)
+        centers = self._get_centers(low, high)
+        ranks = self._get_ranks(num_values)
+
+        # the smallest data types suffice since the counts never exceed the neighborhood size
+        count_dtype = np.min_scalar_type(num_values)
+        bin_dtype = np.min_scalar_type(self.bins)
+
+        pad = ((0, z_offset), (0, y_offset), (0, x_offset))
+        quantized = np.pad(self._quantize(image_array, low, high).astype(bin_dtype), pad, 'symmetric')
+
+        # the features are accumulated as bin indices, i.e. the number of bins below the bin of the feature
+        min_bin = np.zeros((z, y, x), bin_dtype)
+        max_bin = np.zeros((z, y, x), bin_dtype)
+        percentile_bins = np.zeros((len(ranks), z, y, x), bin_dtype)
+        entropy = np.zeros((z, y, x), np.float32)
+        counts = np.arange(num_values + 1)
+        entropy_lut = -np.where(counts > 0, counts / num_values * np.log2(np.maximum(counts, 1) / num_values), 0)
+        entropy_lut = entropy_lut.astype(np.float32)
+
+        cumulative_count = np.zeros((z, y, x), count_dtype)
+        for bin_ in range(self.bins - 1):
+            indicator = (quantized == bin_).astype(count_dtype)
+            count = _box_sum(indicator, (z_offset, y_offset, x_offset))[:z, :y, :x]
+            cumulative_count += count
+            entropy += entropy_lut[count]
+
+            min_bin += cumulative_count == 0
+            max_bin += cumulative_count < num_values
+            for idx, rank in enumerate(ranks):
+                percentile_bins[idx] += cumulative_count <= rank
+        entropy += entropy_lut[num_values - cumulative_count]  # the count of the last bin
+
+        out = np.empty((z, y, x, 9), np.float32)
+        out[..., 0] = centers[min_bin]
+        out[..., 1] = centers[max_bin]
+        out[..., 2] = out[..., 1] - out[..., 0]
+        for idx in range(len(ranks)):
+            out[..., 3 + idx] = centers[percentile_bins[idx]]
+        out[..., 8] = entropy
+        return out
+
+    def _get_features(self, values: np.ndarray, low: float, high: float) -> np.ndarray:
+        """Gets the features of neighborhoods of shape (n, number_of_values) quantized in the range [low, high]."""
+        n, num_values = values.shape
+        quantized = self._quantize(values, low, high) + np.arange(n)[:, np.newaxis] * self.bins
+        histograms = np.bincount(quantized.ravel(), minlength=n * self.bins).reshape((n, self.bins))
+        cumulative_histograms = np.cumsum(histograms, axis=1)
+        centers = self._get_centers(low, high)
+
+        occupied = histograms > 0
+        min_ = centers[np.argmax(occupied, axis=1)]
+        max_ = centers[self.bins - 1 - np.argmax(occupied[:, ::-1], axis=1)]
+        percentiles = [centers[np.sum(cumulative_histograms <= rank, axis=1)] for rank in self._get_ranks(num_values)]
+        p = histograms / num_values
+        entropy = -np.sum(p * np.log2(np.where(occupied, p, 1)), axis=1)
+        return np.column_stack([min_, max_, max_ - min_, *percentiles, entropy])
+
+    def _get_range(self, values: np.ndarray) -> tuple:
+        if self.value_range is not None:
+            return self.value_range
+        return float(np.min(values)), float(np.max(values))
+
+    def _quantize(self, values: np.ndarray, low: float, high: float) -> np.ndarray:
+        if high <= low:
+            return np.zeros(values.shape, np.intp)
+        bins = np.floor((values - low) * (self.bins / (high - low))).astype(np.intp)
+        return np.clip(bins, 0, self.bins - 1)
+
+    def _get_centers(self, low: float, high: float) -> np.ndarray:
+        return low + (np.arange(self.bins) + 0.5) * (high - low) / self.bins
+
+    def _get_ranks(self, num_values: int) -> list:
+        # zero-based rank of the value at the lower end of the linear interpolation of np.percentile
+        return [int(np.floor(q / 100 * (num_values - 1))) for q in self.PERCENTILES]
+
+    def __str__(self):
+        """Gets a printable string representation.
+
+        Returns:
+            str: String representation.
+        """
+        return 'RollingHistogramFeatures:\n' \
+               ' bins:        {self.bins}\n' \
+               ' value_range: {self.value_range}\n' \
+            .format(self=self)
+
+
+class StratifiedVoxelSampler:
+    """Represents a stratified voxel sampler.
+
+    The sampler draws a fraction or a fixed number of voxels per label without replacement. The voxels are grouped
+    by label with a single stable sort of the labels, and the random numbers are drawn from a
+    :py:class:`numpy.random.Generator`, such that the samples are reproducible independent of the process.
+    """
+
+    def __init__(self, labels: list, label_fractions: list = None, label_counts: list = None):
+        """Initializes a new instance of the StratifiedVoxelSampler class.
+
+        Args:
+            labels (list of int): The labels to sample, e.g. [0, 1, 2].
+            label_fractions (list of float): The fraction of voxels to sample per label, e.g. [0.01, 0.1, 0.1].
+            label_counts (list of int): The number of voxels to sample per label (at most all voxels of a label),
+                which bounds the number of samples per image independent of the image size. Takes precedence over
+                ``label_fractions``.
+
+        Raises:
+            ValueError: If neither fractions nor counts are given or their length differs from the labels.
+        """
+        if label_counts is None and label_fractions is None:
+            raise ValueError('either label_fractions or label_counts are required')
+        if len(label_counts if label_counts is not None else label_fractions) != len(labels):
+            raise ValueError('one fraction or count per label is required')
+
+        self.labels = labels
+        self.label_fractions = label_fractions
+        self.label_counts = label_counts
+
+    def get_indices(self, ground_truth: sitk.Image, rng: np.random.Generator,
+                    background_mask: sitk.Image = None) -> np.ndarray:
+        """Samples voxels of an image.
+
+        Args:
+            ground_truth (sitk.Image): The ground truth image.
+            rng (np.random.Generator): The random number generator, e.g. ``np.random.default_rng(seed)``.
+            background_mask (sitk.Image): A mask, where intensity 0 indicates voxels to exclude independent of the
+                label.
+
+        Returns:
+            np.ndarray: The sorted flat indices (in the order of ``sitk.GetArrayFromImage``) of the sampled voxels.
+        """
+        # labels are non-negative integers, but might be stored as floating point numbers
+        ground_truth_array = sitk.GetArrayViewFromImage(ground_truth).ravel().astype(np.uint16, copy=False)
+        if background_mask is not None:
+            # move the excluded voxels behind all labels
+            excluded = sitk.GetArrayViewFromImage(background_mask).ravel() == 0
+            ground_truth_array = np.where(excluded, np.uint16(max(self.labels) + 1), ground_truth_array)
+
+        # group the voxels by label, the stable sort of 16-bit integers is a linear-time radix sort
+        order = np.argsort(ground_truth_array, kind='stable')
+        label_counts = np.bincount(ground_truth_array, minlength=max(self.labels) + 1)
+        label_starts = np.concatenate([[0], np.cumsum(label_counts)])
+
+        samples = []
+        for label_idx, label in enumerate(self.labels):
+            no_voxels = label_counts[label]
+            if self.label_counts is not None:
+                no_samples = min(self.label_counts[label_idx], no_voxels)
+            else:
+                no_samples = int(no_voxels * self.label_fractions[label_idx])
+            label_voxels = order[label_starts[label]:label_starts[label + 1]]
+            samples.append(label_voxels[rng.choice(no_voxels, no_samples, replace=False)])
+
+        return np.sort(np.concatenate(samples))
+
+
 class RandomizedTrainingMaskGenerator:
     """Represents a training mask generator.
 
@@ -204,7 +772,8 @@ class RandomizedTrainingMaskGenerator:
     def get_mask(ground_truth: sitk.Image,
                  ground_truth_labels: list,
                  label_percentages: list,
-                 background_mask: sitk.Image = None) -> sitk.Image:
+                 background_mask: sitk.Image = None,
+                 seed=None) -> sitk.Image:
         """Gets a training mask.
 
         Args:
@@ -215,33 +784,17 @@ class RandomizedTrainingMaskGenerator:
                 e.g. [0.2, 0.2].
             background_mask (sitk.Image): A mask, where intensity 0 indicates voxels to exclude independent of the
             label.
+            seed: The seed of the random number generator (see ``np.random.default_rng``). None draws a fresh seed.
 
         Returns:
             sitk.Image: The training mask.
         """
 
-        # initialize mask
-        ground_truth_array = sitk.GetArrayFromImage(ground_truth)
-        mask_array = np.zeros(ground_truth_array.shape, dtype=np.uint8)
+        sampler = StratifiedVoxelSampler(ground_truth_labels, label_fractions=label_percentages)
+        indices = sampler.get_indices(ground_truth, np.random.default_rng(seed), background_mask)
 
-        # exclude background
-        if background_mask is not None:
-            background_mask_array = sitk.GetArrayFromImage(background_mask)
-            background_mask_array = np.logical_not(background_mask_array)
-            ground_truth_array = ground_truth_array.astype(float)  # convert to float because of np.nan
-            ground_truth_array[background_mask_array] = np.nan
-
-        for label_idx, label in enumerate(ground_truth_labels):
-            indices = np.transpose(np.where(ground_truth_array == label))
-            np.random.shuffle(indices)
-
-            no_mask_items = int(indices.shape[0] * label_percentages[label_idx])
-
-            for no in range(no_mask_items):
-                x = indices[no][0]
-                y = indices[no][1]
-                z = indices[no][2]
-                mask_array[x, y, z] = 1  # this is a masked item
+        mask_array = np.zeros(ground_truth.GetSize()[::-1], dtype=np.uint8)
+        mask_array.flat[indices] = 1  # these are masked items
 
         mask = sitk.GetImageFromArray(mask_array)
         mask.SetOrigin(ground_truth.GetOrigin())
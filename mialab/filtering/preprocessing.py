@@ -2,6 +2,7 @@
 
 Image pre-processing aims to improve the image quality (image intensities) for subsequent pipeline steps.
 """
+import typing as t
 import warnings
 
 import pymia.filtering.filter as pymia_fltr
@@ -93,10 +94,11 @@ class SkullStripping(pymia_fltr.Filter):
         
         skullstripped_array = mask_array * image_array
         
-        image = sitk.GetImageFromArray(skullstripped_array)
-        #sitk.Show(image)
+        img_out = sitk.GetImageFromArray(skullstripped_array)
+        img_out.CopyInformation(image)
+        #sitk.Show(img_out)
        
-        return image
+        return img_out
 
     def __str__(self):
         """Gets a printable string representation.
@@ -108,6 +110,124 @@ class SkullStripping(pymia_fltr.Filter):
             .format(self=self)
 
 
+def get_streaming_statistics(array: np.ndarray, mask: np.ndarray = None, chunk_size: int = 1 << 20) -> tuple:
+    """Gets the mean and standard deviation of an array in one pass over chunks of it.
+
+    The chunks are combined by the parallel algorithm of Chan et al., such that the result is as accurate as a
+    two-pass computation in float64 while only a chunk is converted at a time.
+
+    Args:
+        array (np.ndarray): The array.
+        mask (np.ndarray): A mask of the same shape, where non-zero values are included, or None to include all values.
+        chunk_size (int): The number of values per chunk.
+
+    Returns:
+        tuple: The mean and the (population) standard deviation, both zero if no value is included.
+    """
+    flat_array = array.reshape(-1)
+    flat_mask = mask.reshape(-1) if mask is not None else None
+    count, mean, m2 = 0, 0.0, 0.0
+    for start in range(0, flat_array.size, chunk_size):
+        chunk = flat_array[start:start + chunk_size]
+        if flat_mask is not None:
+            chunk = chunk[flat_mask[start:start + chunk_size] != 0]
+        if chunk.size == 0:
+            continue
+        chunk_mean = np.mean(chunk, dtype=np.float64)
+        chunk_m2 = float(np.sum(np.square(chunk - chunk_mean)))
+        delta = chunk_mean - mean
+        total = count + chunk.size
+        mean += delta * chunk.size / total
+        m2 += chunk_m2 + delta ** 2 * count * chunk.size / total
+        count = total
+    if count == 0:
+        return 0.0, 0.0
+    return mean, np.sqrt(m2 / count)
+
+
+class SkullStrippingNormalizationParameters(pymia_fltr.FilterParams):
+    """Fused skull-stripping and normalization parameters."""
+
+    def __init__(self, img_mask: sitk.Image = None, normalize: bool = True, mask_aware: bool = True):
+        """Initializes a new instance of the SkullStrippingNormalizationParameters
+
+        Args:
+            img_mask (sitk.Image): The brain mask image, or None to skip the skull-stripping.
+            normalize (bool): Indicates weather the image is normalized or not.
+            mask_aware (bool): Indicates weather the normalization statistics are computed within the brain mask only,
+                leaving the background zero, or over the whole image like :class:`ImageNormalization`.
+        """
+        self.img_mask = img_mask
+        self.normalize = normalize
+        self.mask_aware = mask_aware
+
+
+class SkullStrippingNormalization(pymia_fltr.Filter):
+    """Represents a fused skull-stripping and normalization filter.
+
+    In contrast to a :class:`SkullStripping` followed by an :class:`ImageNormalization`, the image is converted once to
+    a float32 array, which is masked and normalized in place, and converted back to an image with the geometry of the
+    input image.
+    """
+
+    def __init__(self, chunk_size: int = 1 << 20):
+        """Initializes a new instance of the SkullStrippingNormalization class.
+
+        Args:
+            chunk_size (int): The number of voxels processed at a time, which bounds the temporary memory.
+        """
+        super().__init__()
+        self.chunk_size = chunk_size
+
+    def execute(self, image: sitk.Image, params: SkullStrippingNormalizationParameters = None) -> sitk.Image:
+        """Executes a skull stripping and a normalization on an image.
+
+        Args:
+            image (sitk.Image): The image.
+            params (SkullStrippingNormalizationParameters): The parameters.
+
+        Returns:
+            sitk.Image: The skull-stripped and normalized float32 image.
+        """
+        params = params if params is not None else SkullStrippingNormalizationParameters()
+
+        img_arr = sitk.GetArrayFromImage(image)
+        img_arr = img_arr.astype(np.float32, copy=img_arr.dtype != np.float32)  # the single buffer
+        flat_img_arr = img_arr.reshape(-1)
+
+        mask_arr = None
+        if params.img_mask is not None:
+            mask_arr = sitk.GetArrayViewFromImage(params.img_mask).reshape(-1)
+            for start in range(0, flat_img_arr.size, self.chunk_size):
+                chunk = flat_img_arr[start:start + self.chunk_size]
+                np.multiply(chunk, mask_arr[start:start + self.chunk_size], out=chunk, casting='unsafe')
+
+        if params.normalize:
+            mask_aware = params.mask_aware and mask_arr is not None
+            mu, std = get_streaming_statistics(flat_img_arr, mask_arr if mask_aware else None, self.chunk_size)
+            for start in range(0, flat_img_arr.size, self.chunk_size):
+                chunk = flat_img_arr[start:start + self.chunk_size]
+                where = mask_arr[start:start + self.chunk_size] != 0 if mask_aware else True
+                np.subtract(chunk, mu, out=chunk, where=where, casting='unsafe')
+                if std != 0:
+                    np.divide(chunk, std, out=chunk, where=where, casting='unsafe')
+
+        img_out = sitk.GetImageFromArray(img_arr)
+        img_out.CopyInformation(image)
+
+        return img_out
+
+    def __str__(self):
+        """Gets a printable string representation.
+
+        Returns:
+            str: String representation.
+        """
+        return 'SkullStrippingNormalization:\n' \
+               ' chunk_size: {self.chunk_size}\n' \
+            .format(self=self)
+
+
 class ImageRegistrationParameters(pymia_fltr.FilterParams):
     """Image registration parameters."""
 
@@ -181,3 +301,343 @@ class ImageRegistration(pymia_fltr.Filter):
         """
         return 'ImageRegistration:\n' \
             .format(self=self)
+
+
+class MultiImageRegistrationParameters(pymia_fltr.FilterParams):
+    """Multi-image registration parameters."""
+
+    def __init__(self, atlas: sitk.Image, transformation: sitk.Transform, is_label: t.List[bool],
+                 mask_index: int = None):
+        """Initializes a new instance of the MultiImageRegistrationParameters
+
+        Args:
+            atlas (sitk.Image): The atlas image, i.e. the grid onto which all images are resampled.
+            transformation (sitk.Transform): The transformation for registration, common to all images.
+            is_label (List[bool]): Indicates for each image weather it is a label image (e.g. the ground truth or the
+                brain mask), which is resampled by nearest neighbor instead of linear interpolation.
+            mask_index (int): The index of a label image (e.g. the brain mask), outside of whose registered bounding box
+                the intensity images are not interpolated but set to zero, or None to interpolate the whole grid.
+        """
+        self.atlas = atlas
+        self.transformation = transformation
+        self.is_label = is_label
+        self.mask_index = mask_index
+
+
+class MultiImageRegistration(pymia_fltr.Filter):
+    """Represents a registration filter of several images of a subject with the same transformation.
+
+    Compared to an :class:`ImageRegistration` per image, the resampling onto the atlas grid is set up once per subject,
+    the label images are resampled first and the interpolation of the intensity images can be restricted to the
+    bounding box of a registered mask. The restriction does not change the intensities within the mask, such that
+    it is exact if the images are skull-stripped with this mask afterwards.
+    """
+
+    def __init__(self):
+        """Initializes a new instance of the MultiImageRegistration class."""
+        super().__init__()
+
+    def execute(self, images: t.List[sitk.Image], params: MultiImageRegistrationParameters = None) \
+            -> t.List[sitk.Image]:
+        """Registers the images.
+
+        Args:
+            images (List[sitk.Image]): The images of a subject.
+            params (MultiImageRegistrationParameters): The registration parameters.
+
+        Returns:
+            List[sitk.Image]: The registered images, in the order of the images.
+        """
+        resampler = sitk.ResampleImageFilter()
+        resampler.SetReferenceImage(params.atlas)
+        resampler.SetTransform(params.transformation)
+
+        registered_images = [None] * len(images)
+        resampler.SetInterpolator(sitk.sitkNearestNeighbor)
+        for idx, image in enumerate(images):
+            if params.is_label[idx]:
+                registered_images[idx] = resampler.Execute(image)
+
+        start = [0] * params.atlas.GetDimension()
+        if params.mask_index is not None:
+            label_statistics = sitk.LabelShapeStatisticsImageFilter()
+            label_statistics.Execute(sitk.Cast(registered_images[params.mask_index] != 0, sitk.sitkUInt8))
+            if label_statistics.HasLabel(1):
+                bounding_box = label_statistics.GetBoundingBox(1)
+                start = list(bounding_box[:len(start)])
+                resampler.SetSize(bounding_box[len(start):])
+                resampler.SetOutputOrigin(params.atlas.TransformIndexToPhysicalPoint(start))
+
+        resampler.SetInterpolator(sitk.sitkLinear)
+        for idx, image in enumerate(images):
+            if params.is_label[idx]:
+                continue
+            registered_image = resampler.Execute(image)
+            if registered_image.GetSize() != params.atlas.GetSize():
+                # embed the bounding box into the atlas grid
+                full_image = sitk.Image(params.atlas.GetSize(), registered_image.GetPixelID())
+                full_image.CopyInformation(params.atlas)
+                registered_image = sitk.Paste(full_image, registered_image, registered_image.GetSize(),
+                                              [0] * len(start), start)
+            registered_images[idx] = registered_image
+
+        return registered_images
+
+    def __str__(self):
+        """Gets a printable string representation.
+
+        Returns:
+            str: String representation.
+        """
+        return 'MultiImageRegistration:\n' \
+            .format(self=self)
+
+
+class MultiResolutionRegistrationParameters(pymia_fltr.FilterParams):
+    """Multi-resolution registration parameters."""
+
+    def __init__(self, atlas: sitk.Image, atlas_mask: sitk.Image = None, image_mask: sitk.Image = None):
+        """Initializes a new instance of the MultiResolutionRegistrationParameters
+
+        Args:
+            atlas (sitk.Image): The atlas image, i.e. the fixed image.
+            atlas_mask (sitk.Image): A mask limiting the metric to a region of the atlas, or None.
+            image_mask (sitk.Image): A mask limiting the metric to a region of the image (e.g. the brain mask), or None.
+        """
+        self.atlas = atlas
+        self.atlas_mask = atlas_mask
+        self.image_mask = image_mask
+
+
+class MultiResolutionRegistration(pymia_fltr.Filter):
+    """Represents a multi-resolution affine registration filter of an image to an atlas.
+
+    The transformation is estimated by the SimpleITK registration framework with a Mattes mutual information metric
+    evaluated at a random fraction of the voxels, a pyramid of downsampled and smoothed images, and a gradient descent
+    stopping early at each level once the metric converges. It maps points of the atlas to the image like the
+    provided transformations (see :class:`ImageRegistration`).
+    """
+
+    def __init__(self,
+                 shrink_factors: t.Sequence[int] = (4, 2, 1),
+                 smoothing_sigmas: t.Sequence[float] = (2, 1, 0),
+                 sampling_percentage: float = 0.02,
+                 number_of_histogram_bins: int = 50,
+                 learning_rate: float = 1.0,
+                 number_of_iterations: int = 100,
+                 convergence_minimum_value: float = 1e-7,
+                 convergence_window_size: int = 20,
+                 sampling_seed: int = 42):
+        """Initializes a new instance of the MultiResolutionRegistration class.
+
+        Args:
+            shrink_factors (Sequence[int]): The shrink factors at each level (from coarse to fine).
+            smoothing_sigmas (Sequence[float]): The Gaussian sigmas for smoothing at each level (in physical units).
+            sampling_percentage (float): Fraction of the atlas voxels at which the metric is evaluated (0, 1].
+            number_of_histogram_bins (int): The number of histogram bins of the metric.
+            learning_rate (float): The optimizer's learning rate.
+            number_of_iterations (int): The maximum number of optimization iterations per level.
+            convergence_minimum_value (float): The minimum change of the metric within the convergence window,
+                below which the optimization of a level stops.
+            convergence_window_size (int): The number of iterations over which the convergence is checked.
+            sampling_seed (int): The seed of the metric sampling for reproducible transformations.
+        """
+        super().__init__()
+        if len(shrink_factors) != len(smoothing_sigmas):
+            raise ValueError('shrink_factors and smoothing_sigmas need to be same length')
+        self.shrink_factors = tuple(shrink_factors)
+        self.smoothing_sigmas = tuple(smoothing_sigmas)
+        self.sampling_percentage = sampling_percentage
+        self.number_of_histogram_bins = number_of_histogram_bins
+        self.learning_rate = learning_rate
+        self.number_of_iterations = number_of_iterations
+        self.convergence_minimum_value = convergence_minimum_value
+        self.convergence_window_size = convergence_window_size
+        self.sampling_seed = sampling_seed
+
+    def estimate_transform(self, image: sitk.Image, params: MultiResolutionRegistrationParameters) -> sitk.Transform:
+        """Estimates the transformation registering an image to the atlas.
+
+        Args:
+            image (sitk.Image): The image, i.e. the moving image.
+            params (MultiResolutionRegistrationParameters): The registration parameters.
+
+        Returns:
+            sitk.Transform: The transformation mapping points of the atlas to the image.
+        """
+        atlas = sitk.Cast(params.atlas, sitk.sitkFloat32)
+        image = sitk.Cast(image, sitk.sitkFloat32)
+
+        registration = sitk.ImageRegistrationMethod()
+        registration.SetMetricAsMattesMutualInformation(self.number_of_histogram_bins)
+        registration.SetMetricSamplingStrategy(registration.RANDOM)
+        registration.SetMetricSamplingPercentage(self.sampling_percentage, self.sampling_seed)
+        if params.atlas_mask is not None:
+            registration.SetMetricFixedMask(params.atlas_mask)
+        if params.image_mask is not None:
+            registration.SetMetricMovingMask(params.image_mask)
+        registration.SetInterpolator(sitk.sitkLinear)
+
+        registration.SetOptimizerAsGradientDescent(learningRate=self.learning_rate,
+                                                   numberOfIterations=self.number_of_iterations,
+                                                   convergenceMinimumValue=self.convergence_minimum_value,
+                                                   convergenceWindowSize=self.convergence_window_size,
+                                                   estimateLearningRate=registration.Once)
+        registration.SetOptimizerScalesFromPhysicalShift()
+
+        registration.SetShrinkFactorsPerLevel(self.shrink_factors)
+        registration.SetSmoothingSigmasPerLevel(self.smoothing_sigmas)
+        registration.SmoothingSigmasAreSpecifiedInPhysicalUnitsOn()
+
+        initial_transform = sitk.CenteredTransformInitializer(atlas, image, sitk.AffineTransform(image.GetDimension()),
+                                                              sitk.CenteredTransformInitializerFilter.MOMENTS)
+        registration.SetInitialTransform(initial_transform, inPlace=True)
+        registration.Execute(atlas, image)
+
+        if self.verbose:
+            print('MultiResolutionRegistration:\n Final metric value: {0}'.format(registration.GetMetricValue()))
+            print(' Optimizer\'s stopping condition, {0}'.format(registration.GetOptimizerStopConditionDescription()))
+
+        return sitk.AffineTransform(initial_transform)
+
+    def execute(self, image: sitk.Image, params: MultiResolutionRegistrationParameters = None) -> sitk.Image:
+        """Registers an image to the atlas.
+
+        Args:
+            image (sitk.Image): The image.
+            params (MultiResolutionRegistrationParameters): The registration parameters.
+
+        Returns:
+            sitk.Image: The registered image.
+        """
+        return ImageRegistration().execute(image, ImageRegistrationParameters(
+            params.atlas, self.estimate_transform(image, params)))
+
+    def __str__(self):
+        """Gets a printable string representation.
+
+        Returns:
+            str: String representation.
+        """
+        return 'MultiResolutionRegistration:\n' \
+               ' shrink_factors:            {self.shrink_factors}\n' \
+               ' smoothing_sigmas:          {self.smoothing_sigmas}\n' \
+               ' sampling_percentage:       {self.sampling_percentage}\n' \
+               ' number_of_histogram_bins:  {self.number_of_histogram_bins}\n' \
+               ' learning_rate:             {self.learning_rate}\n' \
+               ' number_of_iterations:      {self.number_of_iterations}\n' \
+               ' convergence_minimum_value: {self.convergence_minimum_value}\n' \
+               ' convergence_window_size:   {self.convergence_window_size}\n' \
+               ' sampling_seed:             {self.sampling_seed}\n' \
+            .format(self=self)
+
+
+class BiasFieldCorrectionParameters(pymia_fltr.FilterParams):
+    """Bias field correction parameters."""
+
+    def __init__(self, img_mask: sitk.Image = None, log_bias_field: sitk.Image = None):
+        """Initializes a new instance of the BiasFieldCorrectionParameters
+
+        Args:
+            img_mask (sitk.Image): The brain mask image, limiting the estimation of the bias field, or None.
+            log_bias_field (sitk.Image): A previously estimated logarithm of the bias field on the shrunken image
+                (see :meth:`BiasFieldCorrection.estimate_log_bias_field`), or None to estimate it.
+        """
+        self.img_mask = img_mask
+        self.log_bias_field = log_bias_field
+
+
+class BiasFieldCorrection(pymia_fltr.Filter):
+    """Represents a N4 bias field correction filter.
+
+    The bias field is estimated on a shrunken image, which is much faster than on the full resolution, and
+    reconstructed at full resolution by linear interpolation of its logarithm, which is smooth. The logarithm on the
+    shrunken image is small enough to be stored per image, such that the estimation is not repeated.
+    """
+
+    def __init__(self,
+                 shrink_factor: int = 4,
+                 number_of_iterations: t.Sequence[int] = (50, 50, 50, 50),
+                 convergence_threshold: float = 0.001,
+                 number_of_control_points: t.Sequence[int] = (4, 4, 4)):
+        """Initializes a new instance of the BiasFieldCorrection class.
+
+        Args:
+            shrink_factor (int): The factor by which the image is shrunken for the estimation.
+            number_of_iterations (Sequence[int]): The maximum number of iterations at each fitting level.
+            convergence_threshold (float): The convergence threshold of each fitting level.
+            number_of_control_points (Sequence[int]): The number of B-spline control points per dimension
+                at the first fitting level.
+        """
+        super().__init__()
+        self.shrink_factor = shrink_factor
+        self.number_of_iterations = tuple(number_of_iterations)
+        self.convergence_threshold = convergence_threshold
+        self.number_of_control_points = tuple(number_of_control_points)
+
+    def estimate_log_bias_field(self, image: sitk.Image, img_mask: sitk.Image = None) -> sitk.Image:
+        """Estimates the logarithm of the bias field of an image.
+
+        Args:
+            image (sitk.Image): The image.
+            img_mask (sitk.Image): The brain mask image, or None to estimate the bias field on the whole image.
+
+        Returns:
+            sitk.Image: The float32 logarithm of the bias field on the shrunken image.
+        """
+        image = sitk.Cast(image, sitk.sitkFloat32)
+        shrink_factors = [self.shrink_factor] * image.GetDimension()
+        shrunken_image = sitk.Shrink(image, shrink_factors)
+
+        corrector = sitk.N4BiasFieldCorrectionImageFilter()
+        corrector.SetMaximumNumberOfIterations(self.number_of_iterations)
+        corrector.SetConvergenceThreshold(self.convergence_threshold)
+        corrector.SetNumberOfControlPoints(self.number_of_control_points)
+        if img_mask is not None:
+            shrunken_mask = sitk.Shrink(sitk.Cast(img_mask != 0, sitk.sitkUInt8), shrink_factors)
+            corrector.Execute(shrunken_image, shrunken_mask)
+        else:
+            corrector.Execute(shrunken_image)
+
+        return sitk.Cast(corrector.GetLogBiasFieldAsImage(shrunken_image), sitk.sitkFloat32)
+
+    def execute(self, image: sitk.Image, params: BiasFieldCorrectionParameters = None) -> sitk.Image:
+        """Executes a bias field correction on an image.
+
+        Args:
+            image (sitk.Image): The image.
+            params (BiasFieldCorrectionParameters): The parameters with the brain mask or the estimated bias field.
+
+        Returns:
+            sitk.Image: The float32 corrected image.
+        """
+        params = params if params is not None else BiasFieldCorrectionParameters()
+
+        log_bias_field = params.log_bias_field
+        if log_bias_field is None:
+            log_bias_field = self.estimate_log_bias_field(image, params.img_mask)
+
+        # reconstruct the logarithm at full resolution, extrapolating it to the border of the image
+        log_bias_field = sitk.Resample(log_bias_field, image, sitk.Transform(), sitk.sitkLinear, 0.0, sitk.sitkFloat32,
+                                       True)
+
+        img_arr = sitk.GetArrayFromImage(image).astype(np.float32, copy=False)
+        img_arr /= np.exp(sitk.GetArrayViewFromImage(log_bias_field))
+
+        img_out = sitk.GetImageFromArray(img_arr)
+        img_out.CopyInformation(image)
+
+        return img_out
+
+    def __str__(self):
+        """Gets a printable string representation.
+
+        Returns:
+            str: String representation.
+        """
+        return 'BiasFieldCorrection:\n' \
+               ' shrink_factor:            {self.shrink_factor}\n' \
+               ' number_of_iterations:     {self.number_of_iterations}\n' \
+               ' convergence_threshold:    {self.convergence_threshold}\n' \
+               ' number_of_control_points: {self.number_of_control_points}\n' \
+            .format(self=self)
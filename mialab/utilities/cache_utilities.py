@@ -0,0 +1,460 @@
+"""This module contains content-addressed caches of pre-processed images, registration transformations and
+bias fields."""
+import glob
+import hashlib
+import collections
+import itertools
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import typing as t
+import warnings
+
+import numpy as np
+import SimpleITK as sitk
+
+import mialab.data.structure as structure
+import mialab.utilities.multi_processor as mproc
+
+IGNORED_PARAMS = ('feature_threads', 'cache_dir', 'cache_max_bytes')  # parameters not affecting the result
+
+
+def get_code_version() -> str:
+    """Gets the version of the code, i.e. a digest of all source files of the mialab package.
+
+    Returns:
+        str: The hexadecimal digest.
+    """
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    digest = hashlib.sha256()
+    for file in sorted(glob.glob(os.path.join(package_dir, '**', '*.py'), recursive=True)):
+        digest.update(os.path.relpath(file, package_dir).encode())
+        with open(file, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+_file_digests = {}  # the digests of the files hashed in this process, by path, size and modification time
+
+
+def get_file_digest(path: str) -> str:
+    """Gets the digest of a file's content.
+
+    Args:
+        path (str): The path to the file.
+
+    Returns:
+        str: The hexadecimal digest.
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _file_digests:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        _file_digests[key] = digest.hexdigest()
+    return _file_digests[key]
+
+
+def get_image_digest(image: sitk.Image) -> str:
+    """Gets the digest of an image's content and geometry.
+
+    Args:
+        image (sitk.Image): The image.
+
+    Returns:
+        str: The hexadecimal digest.
+    """
+    digest = hashlib.sha256()
+    digest.update(repr((image.GetSize(), image.GetOrigin(), image.GetSpacing(), image.GetDirection(),
+                        image.GetPixelIDValue())).encode())
+    digest.update(sitk.GetArrayViewFromImage(image).tobytes())
+    return digest.hexdigest()
+
+
+class PreProcessingCache:
+    """Represents a content-addressed on-disk cache of pre-processed images.
+
+    An entry is identified by a key hashing the input files, the registration transformation, the atlas images,
+    the pre-processing parameters and the code version. It is stored in a directory containing the images and the
+    feature matrix as uncompressed numpy files, which are memory-mapped when loaded. The least recently used entries
+    are evicted when the cache exceeds its size limit, and all entries are removed when the code version changes.
+
+    Examples:
+        >>> cache = PreProcessingCache('/path/to/cache')
+        >>> key = cache.get_key(id_, paths, [atlas_t1, atlas_t2], pre_process_params)
+        >>> img = cache.load(key)
+        >>> if img is None:
+        >>>     img = pre_process(id_, paths, **pre_process_params)
+        >>>     cache.save(key, img)
+    """
+
+    def __init__(self, directory: str, max_bytes: int = None):
+        """Initializes a new instance of the PreProcessingCache class.
+
+        Args:
+            directory (str): The cache directory.
+            max_bytes (int): The maximum size of the cache in bytes, or None for no limit.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.version = get_code_version()
+        os.makedirs(self.directory, exist_ok=True)
+        self._invalidate()
+
+    def get_key(self, id_: str, paths: dict, atlas_images: t.List[sitk.Image], params: dict) -> str:
+        """Gets the key of a pre-processed image.
+
+        Args:
+            id_ (str): The image identifier.
+            paths (dict): A dict, where the keys are an image identifier of type structure.BrainImageTypes
+                and the values are paths to the images or already loaded images.
+            atlas_images (List[sitk.Image]): The atlas images.
+            params (dict): The pre-processing parameters.
+
+        Returns:
+            str: The hexadecimal key.
+        """
+        digest = hashlib.sha256()
+        digest.update(self.version.encode())
+        digest.update(id_.encode())
+        for key, path in sorted(((key, path) for key, path in paths.items()
+                                 if isinstance(key, structure.BrainImageTypes)), key=lambda item: item[0].value):
+            if isinstance(path, str) and not os.path.isfile(path):
+                continue  # e.g. a registration transformation, which is estimated instead
+            digest.update(key.name.encode())
+            digest.update((get_image_digest(path) if isinstance(path, sitk.Image) else get_file_digest(path)).encode())
+        for atlas_image in atlas_images:
+            digest.update(get_image_digest(atlas_image).encode())
+        digest.update(json.dumps({key: value for key, value in params.items() if key not in IGNORED_PARAMS},
+                                 sort_keys=True, default=str).encode())
+        return digest.hexdigest()
+
+    def load(self, key: str) -> t.Optional[structure.BrainImage]:
+        """Loads a pre-processed image.
+
+        Args:
+            key (str): The key (see :meth:`get_key`).
+
+        Returns:
+            structure.BrainImage: The image with the feature matrix memory-mapped, or None if not cached.
+        """
+        entry_dir = os.path.join(self.directory, key)
+        try:
+            with open(os.path.join(entry_dir, 'image.pkl'), 'rb') as f:
+                picklable_img = pickle.load(f)
+            picklable_img.np_images = {image_type: np.load(os.path.join(entry_dir, file_name), mmap_mode='r')
+                                       for image_type, file_name in picklable_img.np_images.items()}
+            picklable_img.feature_matrix = tuple(np.load(os.path.join(entry_dir, file_name), mmap_mode='r')
+                                                 for file_name in picklable_img.feature_matrix)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError, ValueError):
+            return None
+
+        os.utime(entry_dir)  # mark as recently used
+        return mproc.PicklableToBrainImageBridge.convert(picklable_img)
+
+    def save(self, key: str, img: structure.BrainImage):
+        """Saves a pre-processed image.
+
+        Args:
+            key (str): The key (see :meth:`get_key`).
+            img (structure.BrainImage): The pre-processed image.
+        """
+        # write to a temporary directory first such that concurrent processes never see incomplete entries
+        tmp_dir = tempfile.mkdtemp(prefix='.' + key, dir=self.directory)
+
+        def save_array(file_name: str, array: np.ndarray) -> str:
+            np.save(os.path.join(tmp_dir, file_name), array)
+            return file_name
+
+        image_numbers = itertools.count()
+        picklable_img = mproc.BrainImageToPicklableBridge.convert(
+            img, lambda image: save_array('image{}.npy'.format(next(image_numbers)), sitk.GetArrayViewFromImage(image)))
+        picklable_img.feature_matrix = (save_array('features.npy', img.feature_matrix[0]),
+                                        save_array('labels.npy', img.feature_matrix[1]))
+        with open(os.path.join(tmp_dir, 'image.pkl'), 'wb') as f:
+            pickle.dump(picklable_img, f)
+
+        try:
+            os.rename(tmp_dir, os.path.join(self.directory, key))
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)  # saved by another process in the meantime
+        self._evict()
+
+    @property
+    def nbytes(self) -> int:
+        """int: The size of the cached entries in bytes."""
+        return sum(size for _, _, size in self._get_entries())
+
+    def _get_entries(self) -> t.List[t.Tuple[str, float, int]]:
+        """Gets the entries as tuples of directory, last usage time and size in bytes."""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_dir() and not entry.name.startswith('.'):
+                try:
+                    size = sum(file.stat().st_size for file in os.scandir(entry.path))
+                    entries.append((entry.path, entry.stat().st_mtime, size))
+                except FileNotFoundError:
+                    continue  # evicted by another process
+        return entries
+
+    def _evict(self):
+        """Removes the least recently used entries until the cache fits its size limit."""
+        if self.max_bytes is None:
+            return
+        entries = sorted(self._get_entries(), key=lambda entry: entry[1])
+        total_size = sum(size for _, _, size in entries)
+        for entry_dir, _, size in entries:
+            if total_size <= self.max_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= size
+
+    def _invalidate(self):
+        """Removes all entries if they were created by another code version."""
+        version_file = os.path.join(self.directory, 'VERSION')
+        if os.path.isfile(version_file):
+            with open(version_file) as f:
+                if f.read() == self.version:
+                    return
+        for entry in os.scandir(self.directory):
+            if entry.is_dir():
+                shutil.rmtree(entry.path, ignore_errors=True)
+        with open(version_file, 'w') as f:
+            f.write(self.version)
+
+
+def get_subject_file_path(directory: str, prefix: str, extension: str, images: t.List[sitk.Image], filter_) -> str:
+    """Gets the path of a file computed from images, e.g. a registration transformation, which is identified by the
+    digests of the images and the parameters of the filter computing it.
+
+    Args:
+        directory (str): The directory to store the file in, e.g. the image directory.
+        prefix (str): The file name prefix.
+        extension (str): The file extension.
+        images (List[sitk.Image]): The images the file is computed from.
+        filter_: The filter computing the file, whose string representation lists its parameters.
+
+    Returns:
+        str: The path to the file.
+    """
+    digest = hashlib.sha256()
+    for image in images:
+        digest.update(get_image_digest(image).encode())
+    digest.update(str(filter_).encode())
+    return os.path.join(directory, '{}_{}{}'.format(prefix, digest.hexdigest()[:16], extension))
+
+
+def get_transform_path(directory: str, image: sitk.Image, atlas: sitk.Image, registration) -> str:
+    """Gets the path of a registration transformation (see :func:`get_subject_file_path`).
+
+    Args:
+        directory (str): The directory to store the transformation in, e.g. the image directory.
+        image (sitk.Image): The registered image.
+        atlas (sitk.Image): The atlas image.
+        registration: The registration filter, whose string representation lists its parameters.
+
+    Returns:
+        str: The path to the transformation file.
+    """
+    return get_subject_file_path(directory, 'affine', '.tfm', [image, atlas], registration)
+
+
+def get_bias_field_path(directory: str, image: sitk.Image, img_mask: t.Optional[sitk.Image], correction) -> str:
+    """Gets the path of the logarithm of a bias field (see :func:`get_subject_file_path`).
+
+    Args:
+        directory (str): The directory to store the bias field in, e.g. the image directory.
+        image (sitk.Image): The corrected image.
+        img_mask (sitk.Image): The brain mask image limiting the estimation, or None.
+        correction: The bias field correction filter, whose string representation lists its parameters.
+
+    Returns:
+        str: The path to the bias field file.
+    """
+    images = [image] if img_mask is None else [image, img_mask]
+    return get_subject_file_path(directory, 'bias', '.nii.gz', images, correction)
+
+
+def load_transform(path: str) -> t.Optional[sitk.Transform]:
+    """Loads a registration transformation.
+
+    Args:
+        path (str): The path (see :func:`get_transform_path`).
+
+    Returns:
+        sitk.Transform: The transformation, or None if not stored.
+    """
+    return _load(path, sitk.ReadTransform)
+
+
+def save_transform(path: str, transform: sitk.Transform):
+    """Saves a registration transformation, unless its directory is not writable.
+
+    Args:
+        path (str): The path (see :func:`get_transform_path`).
+        transform (sitk.Transform): The transformation.
+    """
+    _save(path, lambda tmp_path: sitk.WriteTransform(transform, tmp_path))
+
+
+def load_image(path: str) -> t.Optional[sitk.Image]:
+    """Loads an image computed from other images, e.g. a bias field.
+
+    Args:
+        path (str): The path (see :func:`get_subject_file_path`).
+
+    Returns:
+        sitk.Image: The image, or None if not stored.
+    """
+    return _load(path, sitk.ReadImage)
+
+
+def save_image(path: str, image: sitk.Image):
+    """Saves an image computed from other images, e.g. a bias field, unless its directory is not writable.
+
+    Args:
+        path (str): The path (see :func:`get_subject_file_path`).
+        image (sitk.Image): The image.
+    """
+    _save(path, lambda tmp_path: sitk.WriteImage(image, tmp_path, True))
+
+
+def _load(path: str, read_fn: callable):
+    """Reads a file, or returns None if it does not exist or is not readable."""
+    if not os.path.isfile(path):
+        return None
+    try:
+        return read_fn(path)
+    except RuntimeError:
+        return None
+
+
+def _save(path: str, write_fn: callable):
+    """Writes a file by a function taking a path, unless its directory is not writable."""
+    # write to a temporary file first such that concurrent processes never read incomplete files
+    directory, file_name = os.path.split(path)
+    tmp_path = os.path.join(directory, '.{}-{}-{}'.format(os.getpid(), threading.get_ident(), file_name))
+    try:
+        write_fn(tmp_path)
+        os.replace(tmp_path, path)
+    except (OSError, RuntimeError) as e:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+        warnings.warn('{} not saved: {}'.format(file_name, e))
+
+
+def get_image_size(img: structure.BrainImage) -> int:
+    """Gets the memory occupied by the images, feature images and feature matrix of an image.
+
+    Memory-mapped arrays are not counted because they are backed by files.
+
+    Args:
+        img (structure.BrainImage): The image.
+
+    Returns:
+        int: The size in bytes.
+    """
+    def get_size(item) -> int:
+        if isinstance(item, sitk.Image):
+            return item.GetNumberOfPixels() * item.GetNumberOfComponentsPerPixel() * item.GetSizeOfPixelComponent()
+        if isinstance(item, np.ndarray) and not isinstance(item, np.memmap) and \
+                not isinstance(getattr(item, 'base', None), np.memmap):
+            return item.nbytes
+        return 0
+
+    items = list(img.images.values()) + list(img.feature_images.values()) + list(img.feature_matrix or ())
+    return sum(get_size(item) for item in items)
+
+
+class BrainImageCache:
+    """Represents an in-memory cache of pre-processed images, e.g. to evaluate several classifiers on the same images
+    within a process.
+
+    The cached images are shared with the callers, i.e. they must not be modified. The least recently used images are
+    evicted when the images exceed the byte budget.
+    """
+
+    def __init__(self, max_bytes: int = None):
+        """Initializes a new instance of the BrainImageCache class.
+
+        Args:
+            max_bytes (int): The maximum size of the cached images in bytes (see :func:`get_image_size`),
+                or None for no limit.
+        """
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._images = collections.OrderedDict()  # the images by key, from least to most recently used
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_key(id_: str, paths: dict, params: dict) -> str:
+        """Gets the key of a pre-processed image.
+
+        Args:
+            id_ (str): The image identifier.
+            paths (dict): A dict, where the keys are an image identifier of type structure.BrainImageTypes
+                and the values are paths to the images.
+            params (dict): The pre-processing parameters.
+
+        Returns:
+            str: The key.
+        """
+        return json.dumps([id_, sorted(str(path) for path in paths.values() if isinstance(path, str)),
+                           {key: value for key, value in params.items() if key not in IGNORED_PARAMS}],
+                          sort_keys=True, default=str)
+
+    @property
+    def nbytes(self) -> int:
+        """int: The size of the cached images in bytes."""
+        with self._lock:
+            return sum(self._sizes.values())
+
+    def __len__(self):
+        return len(self._images)
+
+    def get(self, key: str) -> t.Optional[structure.BrainImage]:
+        """Gets a cached image.
+
+        Args:
+            key (str): The key (see :meth:`get_key`).
+
+        Returns:
+            structure.BrainImage: The image, or None if not cached.
+        """
+        with self._lock:
+            if key not in self._images:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._images.move_to_end(key)
+            return self._images[key]
+
+    def put(self, key: str, img: structure.BrainImage):
+        """Adds an image to the cache, unless it alone exceeds the byte budget.
+
+        Args:
+            key (str): The key (see :meth:`get_key`).
+            img (structure.BrainImage): The pre-processed image.
+        """
+        size = get_image_size(img)
+        with self._lock:
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._images[key] = img
+            self._sizes[key] = size
+            while self.max_bytes is not None and sum(self._sizes.values()) > self.max_bytes:
+                evicted_key, _ = self._images.popitem(last=False)
+                del self._sizes[evicted_key]
+
+    def clear(self):
+        """Removes all images from the cache."""
+        with self._lock:
+            self._images.clear()
+            self._sizes.clear()
@@ -1,9 +1,14 @@
 """This modules contains utility functions and classes for the access of the file system."""
 import abc
+import collections
+import concurrent.futures as futures
 import enum
 import os
+import threading
 import typing as t
 
+import SimpleITK as sitk
+
 import mialab.data.structure as structure
 
 
@@ -241,3 +246,114 @@ class FileSystemDataCrawler:
             if any(file.endswith(self.file_extension) for file  # check if directory contains data files
                    in os.listdir(os.path.join(self.root_dir, data_dir)))
         }
+
+
+class PrefetchingDataLoader:
+    """Represents a loader iterating over the data of a :class:`FileSystemDataCrawler`, which loads the data of the
+    next subjects in background threads while the current subject is processed.
+
+    The loaded data is kept in a buffer bounded by a number of bytes, from which the least recently used subjects are
+    evicted. The current subject and the subjects loaded in advance are never evicted, but no more subjects are
+    loaded in advance while the buffer is full.
+
+    Examples:
+        >>> loader = PrefetchingDataLoader(crawler.data, load_images, depth=2)
+        >>> for id_, data in loader:
+        >>>     process(id_, data)
+    """
+
+    def __init__(self, data: dict, load_fn: callable, depth: int = 2, max_bytes: int = None, n_threads: int = 1):
+        """Initializes a new instance of the PrefetchingDataLoader class.
+
+        Args:
+            data (dict): The data, e.g. :attr:`FileSystemDataCrawler.data`, where the keys are the identifiers and the
+                values are dicts with the paths to the data files.
+            load_fn (callable): The function taking the paths of a subject and returning them with the data loaded.
+            depth (int): The number of subjects to load in advance.
+            max_bytes (int): The maximum number of bytes of the buffered images. If None, only the current subject and
+                the subjects loaded in advance are buffered.
+            n_threads (int): The number of threads loading the data.
+        """
+        self.data = data
+        self.load_fn = load_fn
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.n_threads = n_threads
+
+        self.hits = 0
+        self.misses = 0
+        self._buffer = collections.OrderedDict()  # the loaded data by identifier, from least to most recently used
+        self._sizes = {}
+        self._window = set()  # the current subject and the subjects loaded in advance, which are not evicted
+        self._lock = threading.Lock()
+
+    @property
+    def nbytes(self) -> int:
+        """int: The number of bytes of the buffered images."""
+        with self._lock:
+            return sum(self._sizes.values())
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        """Iterates over the subjects in the order of the data.
+
+        Yields:
+            tuple: The identifier and a copy of its paths with the data loaded.
+        """
+        ids = list(self.data)
+        with futures.ThreadPoolExecutor(max(self.n_threads, 1)) as executor:
+            pending = {}
+            for idx, id_ in enumerate(ids):
+                with self._lock:
+                    self._window = set(ids[idx:idx + 1 + self.depth])
+                # keep the next subjects loading as long as the buffer is not full
+                for next_id in ids[idx + 1:idx + 1 + self.depth]:
+                    if next_id not in pending and next_id not in self._buffer and self._has_capacity():
+                        pending[next_id] = executor.submit(self._load, next_id)
+                if id_ in pending:
+                    pending.pop(id_).result()
+                yield id_, self.get(id_)
+            with self._lock:
+                self._window = set()
+                self._evict()
+
+    def get(self, id_: str) -> dict:
+        """Gets the data of a subject, from the buffer if it has already been loaded.
+
+        Args:
+            id_ (str): The subject identifier.
+
+        Returns:
+            dict: A copy of the paths of the subject with the data loaded.
+        """
+        with self._lock:
+            if id_ in self._buffer:
+                self.hits += 1
+                self._buffer.move_to_end(id_)
+                return dict(self._buffer[id_])
+            self.misses += 1
+        return dict(self._load(id_))
+
+    def _load(self, id_: str) -> dict:
+        loaded = self.load_fn(dict(self.data[id_]))
+        size = sum(item.GetNumberOfPixels() * item.GetNumberOfComponentsPerPixel() * item.GetSizeOfPixelComponent()
+                   for item in loaded.values() if isinstance(item, sitk.Image))
+        with self._lock:
+            self._buffer[id_] = loaded
+            self._sizes[id_] = size
+            self._evict()
+        return loaded
+
+    def _has_capacity(self) -> bool:
+        with self._lock:
+            return self.max_bytes is None or sum(self._sizes.values()) < self.max_bytes
+
+    def _evict(self):
+        """Evicts the least recently used subjects outside the window until the buffer fits its limit."""
+        for id_ in [id_ for id_ in self._buffer if id_ not in self._window]:
+            if self.max_bytes is not None and sum(self._sizes.values()) <= self.max_bytes:
+                break
+            del self._buffer[id_]
+            del self._sizes[id_]
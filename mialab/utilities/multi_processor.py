@@ -1,4 +1,8 @@
 """Module for the management of multi-process function calls."""
+import atexit
+import concurrent.futures as futures
+from multiprocessing import resource_tracker, shared_memory
+import os
 import typing as t
 
 import numpy as np
@@ -22,6 +26,80 @@ class PicklableAffineTransform:
         return transform
 
 
+_attached_segments = {}  # the shared memory segments attached in this process, by name
+
+
+class SharedArray:
+    """Represents a numpy array transferred between processes via a named shared memory segment.
+
+    Only the segment name, the shape and the data type are pickled. The process creating the array writes it into a
+    new segment and the receiving process maps the same memory with :meth:`attach` instead of copying it through a
+    pipe. The segment is unlinked as soon as it is attached, i.e. its memory is freed when the receiving process
+    releases it (see :meth:`release` and :func:`release_shared_memory`) or terminates. A segment that is not needed
+    anymore is freed by :meth:`discard`. Until then, the segment stays registered with the resource tracker, which
+    unlinks it when the processes terminate without freeing it, e.g. after an error.
+
+    Notes:
+        Requires POSIX shared memory, i.e. segments outliving the process that created them.
+    """
+
+    def __init__(self, array: np.ndarray):
+        """Initializes a new instance of the SharedArray class by copying the array into a new segment.
+
+        Args:
+            array (np.ndarray): The array to share.
+        """
+        self.shape = array.shape
+        self.dtype = array.dtype.str
+
+        segment = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        shared = np.ndarray(self.shape, array.dtype, buffer=segment.buf)
+        shared[...] = array
+        del shared  # release the buffer export before closing the segment
+        self.name = segment.name
+        segment.close()
+
+    def attach(self) -> np.ndarray:
+        """Maps the segment into the current process.
+
+        Returns:
+            np.ndarray: A view on the shared array, valid until the segment is released.
+        """
+        segment = shared_memory.SharedMemory(name=self.name)
+        segment.unlink()  # the name is not needed anymore, the memory persists as long as it is mapped
+        _attached_segments[self.name] = segment
+        return np.ndarray(self.shape, np.dtype(self.dtype), buffer=segment.buf)
+
+    def release(self):
+        """Releases the segment in the current process. All views returned by :meth:`attach` must be deleted before."""
+        _attached_segments.pop(self.name).close()
+
+    def discard(self):
+        """Frees the segment without mapping it, e.g. if the receiving process does not need the array anymore."""
+        try:
+            segment = shared_memory.SharedMemory(name=self.name)
+        except FileNotFoundError:
+            return  # already freed
+        segment.unlink()
+        segment.close()
+
+
+def release_shared_memory():
+    """Releases all shared memory segments attached in the current process.
+
+    Segments with views still in use are kept and released on a later call or when the process terminates.
+    """
+    for name, segment in list(_attached_segments.items()):
+        try:
+            segment.close()
+        except BufferError:
+            continue  # views on the segment are still referenced
+        del _attached_segments[name]
+
+
+atexit.register(release_shared_memory)
+
+
 class PicklableBrainImage:
     """Represents a brain image that can be pickled."""
 
@@ -45,17 +123,20 @@ class PicklableBrainImage:
         # where the shape of features is (n, number_of_features) and the shape of labels is (n, 1)
         # with n being the amount of voxels
         self.pickable_transform = PicklableAffineTransform(transform)
+        self.roi = None
+        self.full_image_properties = None
 
 
 class BrainImageToPicklableBridge:
     """A :class:`BrainImage <data.structure.BrainImage>` to :class:`PicklableBrainImage` bridge."""
 
     @staticmethod
-    def convert(brain_image: structure.BrainImage) -> PicklableBrainImage:
+    def convert(brain_image: structure.BrainImage, to_array: callable = sitk.GetArrayFromImage) -> PicklableBrainImage:
         """Converts a :class:`BrainImage <data.structure.BrainImage>` to :class:`PicklableBrainImage`.
 
         Args:
             brain_image (BrainImage): A brain image.
+            to_array (callable): The function converting the images to picklable arrays.
 
         Returns:
             PicklableBrainImage: The pickable brain image.
@@ -63,16 +144,21 @@ class BrainImageToPicklableBridge:
 
         np_images = {}
         for key, img in brain_image.images.items():
-            np_images[key] = sitk.GetArrayFromImage(img)
+            np_images[key] = to_array(img)
         np_feature_images = {}
         for key, feat_img in brain_image.feature_images.items():
-            np_feature_images[key] = sitk.GetArrayFromImage(feat_img)
+            # feature images might already be arrays, e.g. the shared atlas coordinates
+            np_feature_images[key] = feat_img if isinstance(feat_img, np.ndarray) else sitk.GetArrayFromImage(feat_img)
 
         pickable_brain_image = PicklableBrainImage(brain_image.id_, brain_image.path, np_images,
                                                    brain_image.image_properties,
                                                    brain_image.transformation)
         pickable_brain_image.np_feature_images = np_feature_images
-        pickable_brain_image.feature_matrix = brain_image.feature_matrix
+        if brain_image.feature_matrix is not None:
+            # memory-mapped arrays (e.g. loaded from the pre-processing cache) cannot be pickled, plain views can
+            pickable_brain_image.feature_matrix = tuple(np.asarray(array) for array in brain_image.feature_matrix)
+        pickable_brain_image.roi = brain_image.roi
+        pickable_brain_image.full_image_properties = brain_image.full_image_properties
 
         return pickable_brain_image
 
@@ -102,8 +188,11 @@ class PicklableToBrainImageBridge:
 
         transform = picklable_brain_image.pickable_transform.get_sitk_transformation()
 
-        brain_image = structure.BrainImage(picklable_brain_image.id_, picklable_brain_image.path, images, transform)
+        brain_image = structure.BrainImage(picklable_brain_image.id_, picklable_brain_image.path, images, transform,
+                                           picklable_brain_image.image_properties)
         brain_image.feature_matrix = picklable_brain_image.feature_matrix
+        brain_image.roi = picklable_brain_image.roi
+        brain_image.full_image_properties = picklable_brain_image.full_image_properties
         return brain_image
 
 
@@ -160,6 +249,16 @@ class DefaultPickleHelper:
         """
         return ret_val
 
+    def discard_return_value(self, ret_val):
+        """Default function called to free the resources of picklable return values ``ret_val`` that are not
+        recovered, e.g. because another call failed.
+        To be overwritten if ``ret_val`` references resources outliving the process that created them.
+
+        Args:
+            ret_val: Picklable return values of the function executed in another process.
+        """
+        pass
+
 
 class PreProcessingPickleHelper(DefaultPickleHelper):
     """Pre-processing pickle helper class"""
@@ -192,7 +291,8 @@ class PreProcessingPickleHelper(DefaultPickleHelper):
 class PostProcessingPickleHelper(DefaultPickleHelper):
     """Post-processing pickle helper class"""
 
-    def make_params_picklable(self, params: t.Tuple[structure.BrainImage, sitk.Image, sitk.Image, dict]):
+    def make_params_picklable(self, params: t.Tuple[structure.BrainImage, sitk.Image, structure.ProbabilityMap,
+                                                    dict]):
         """Ensures that all post-processing parameters can be pickled before transferred to the new process.
 
         Args:
@@ -204,10 +304,10 @@ class PostProcessingPickleHelper(DefaultPickleHelper):
         brain_img, segmentation, probability, fn_kwargs = params
         picklable_brain_image = BrainImageToPicklableBridge.convert(brain_img)
         np_segmentation, _ = conversion.SimpleITKNumpyImageBridge.convert(segmentation)
-        np_probability, _ = conversion.SimpleITKNumpyImageBridge.convert(probability)
-        return picklable_brain_image, np_segmentation, np_probability, fn_kwargs
+        # the probability map is picklable as it is, i.e. its compact array is transferred
+        return picklable_brain_image, np_segmentation, probability, fn_kwargs
 
-    def recover_params(self, params: t.Tuple[PicklableBrainImage, np.ndarray, np.ndarray, dict]):
+    def recover_params(self, params: t.Tuple[PicklableBrainImage, np.ndarray, structure.ProbabilityMap, dict]):
         """Recovers (from the pickle state) the original post-processing parameters in another process.
 
         Args:
@@ -217,10 +317,9 @@ class PostProcessingPickleHelper(DefaultPickleHelper):
             tuple: The recovered post-processing parameters.
 
         """
-        picklable_img, np_segmentation, np_probability, fn_kwargs = params
+        picklable_img, np_segmentation, probability, fn_kwargs = params
         img = PicklableToBrainImageBridge.convert(picklable_img)
         segmentation = conversion.NumpySimpleITKImageBridge.convert(np_segmentation, picklable_img.image_properties)
-        probability = conversion.NumpySimpleITKImageBridge.convert(np_probability, picklable_img.image_properties)
         return img, segmentation, probability, fn_kwargs
 
     def make_return_value_picklable(self, ret_val: sitk.Image) -> t.Tuple[np.ndarray, conversion.ImageProperties]:
@@ -249,11 +348,241 @@ class PostProcessingPickleHelper(DefaultPickleHelper):
         return conversion.NumpySimpleITKImageBridge.convert(np_img, image_properties)
 
 
+class SharedMemoryPreProcessingPickleHelper(PreProcessingPickleHelper):
+    """Pre-processing pickle helper class transferring the images and feature matrix via shared memory."""
+
+    def make_return_value_picklable(self, ret_val: structure.BrainImage) -> PicklableBrainImage:
+        """Writes the images and the feature matrix of the pre-processing return values ``ret_val`` into shared memory.
+
+        Args:
+            ret_val(BrainImage): Return values of the pre-processing function executed in another process.
+
+        Returns:
+            PicklableBrainImage: The pre-processing return values referencing :class:`SharedArray` instances.
+        """
+        picklable_img = BrainImageToPicklableBridge.convert(
+            ret_val, lambda img: SharedArray(sitk.GetArrayViewFromImage(img)))
+        if picklable_img.feature_matrix is not None:
+            picklable_img.feature_matrix = tuple(SharedArray(array) for array in picklable_img.feature_matrix)
+        return picklable_img
+
+    def recover_return_value(self, ret_val: PicklableBrainImage) -> structure.BrainImage:
+        """Recovers the original pre-processing return values from shared memory.
+
+        The images are copied into SimpleITK images and their segments released, whereas the feature matrix remains
+        a view on the shared memory until :func:`release_shared_memory` is called.
+
+        Args:
+            ret_val(PicklableBrainImage): Pre-processing return values to be recovered.
+
+        Returns:
+            BrainImage: The recovered pre-processing return values.
+        """
+        shared_images = ret_val.np_images
+        ret_val.np_images = {key: shared_array.attach() for key, shared_array in shared_images.items()}
+        if ret_val.feature_matrix is not None:
+            ret_val.feature_matrix = tuple(shared_array.attach() for shared_array in ret_val.feature_matrix)
+
+        brain_image = super().recover_return_value(ret_val)
+
+        ret_val.np_images = None
+        for shared_array in shared_images.values():
+            shared_array.release()
+        return brain_image
+
+    def discard_return_value(self, ret_val: PicklableBrainImage):
+        """Frees the shared memory of pre-processing return values that are not recovered.
+
+        Args:
+            ret_val(PicklableBrainImage): Pre-processing return values referencing :class:`SharedArray` instances.
+        """
+        for shared_array in list(ret_val.np_images.values()) + list(ret_val.feature_matrix or ()):
+            shared_array.discard()
+
+
+class SharedMemoryPostProcessingPickleHelper(PostProcessingPickleHelper):
+    """Post-processing pickle helper class transferring the post-processed image via shared memory."""
+
+    def make_return_value_picklable(self, ret_val: sitk.Image) -> t.Tuple[SharedArray, conversion.ImageProperties]:
+        """Writes the post-processing return values ``ret_val`` into shared memory.
+
+        Args:
+            ret_val(sitk.Image): Return values of the post-processing function executed in another process.
+
+        Returns:
+            The post-processing return values referencing a :class:`SharedArray`.
+        """
+        return SharedArray(sitk.GetArrayViewFromImage(ret_val)), conversion.ImageProperties(ret_val)
+
+    def recover_return_value(self, ret_val: t.Tuple[SharedArray, conversion.ImageProperties]) -> sitk.Image:
+        """Recovers the original post-processing return values from shared memory.
+
+        Args:
+            ret_val: Post-processing return values to be recovered.
+
+        Returns:
+            sitk.Image: The recovered post-processing return values.
+        """
+        shared_array, image_properties = ret_val
+        image = super().recover_return_value((shared_array.attach(), image_properties))
+        shared_array.release()
+        return image
+
+    def discard_return_value(self, ret_val: t.Tuple[SharedArray, conversion.ImageProperties]):
+        """Frees the shared memory of post-processing return values that are not recovered.
+
+        Args:
+            ret_val: Post-processing return values referencing a :class:`SharedArray`.
+        """
+        ret_val[0].discard()
+
+
+def get_number_of_workers(n_workers: int = None) -> int:
+    """Gets the number of worker processes.
+
+    Args:
+        n_workers (int): An explicit number of workers, which takes precedence.
+
+    Returns:
+        int: The explicit number of workers, the CPUs allocated by SLURM (``SLURM_CPUS_PER_TASK``), or the CPUs
+        available to the current process, in this order.
+    """
+    if n_workers is not None:
+        return max(n_workers, 1)
+    if 'SLURM_CPUS_PER_TASK' in os.environ:
+        return max(int(os.environ['SLURM_CPUS_PER_TASK']), 1)
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def get_memory_budget(memory_budget: int = None) -> t.Optional[int]:
+    """Gets the memory available for the worker processes.
+
+    Args:
+        memory_budget (int): An explicit memory budget in bytes, which takes precedence.
+
+    Returns:
+        int: The explicit memory budget, the memory allocated by SLURM (``SLURM_MEM_PER_NODE`` or
+        ``SLURM_MEM_PER_CPU`` times ``SLURM_CPUS_PER_TASK``), or the available memory, in this order.
+        None if the memory cannot be determined.
+    """
+    if memory_budget is not None:
+        return memory_budget
+    mb = 1024 ** 2
+    if 'SLURM_MEM_PER_NODE' in os.environ:
+        return int(os.environ['SLURM_MEM_PER_NODE']) * mb
+    if 'SLURM_MEM_PER_CPU' in os.environ:
+        return int(os.environ['SLURM_MEM_PER_CPU']) * int(os.environ.get('SLURM_CPUS_PER_TASK', 1)) * mb
+    memory_available = _get_memory_available()
+    if memory_available is not None:
+        return memory_available
+    try:
+        # the free memory only, i.e. without the page cache that could be reclaimed
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def _get_memory_available(meminfo_path: str = '/proc/meminfo') -> t.Optional[int]:
+    """Gets the memory available for new processes as estimated by the Linux kernel (``MemAvailable``), which
+    includes the reclaimable page cache unlike the free memory.
+
+    Returns:
+        int: The available memory in bytes, or None if not reported.
+    """
+    try:
+        with open(meminfo_path) as file:
+            for line in file:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024  # reported in kB
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def get_number_of_processes(number_of_calls: int, n_workers: int = None, memory_budget: int = None,
+                            memory_per_call: t.List[int] = None) -> int:
+    """Gets the number of processes to run concurrently.
+
+    Args:
+        number_of_calls (int): The number of function calls.
+        n_workers (int): An explicit number of workers (see :func:`get_number_of_workers`).
+        memory_budget (int): An explicit memory budget in bytes (see :func:`get_memory_budget`).
+        memory_per_call (List[int]): The estimated memory in bytes required by each call.
+
+    Returns:
+        int: The number of workers, limited such that the largest calls running concurrently fit the memory budget.
+    """
+    n_processes = min(get_number_of_workers(n_workers), max(number_of_calls, 1))
+    memory_budget = get_memory_budget(memory_budget)
+    if memory_budget is not None and memory_per_call:
+        n_processes = min(n_processes, max(memory_budget // max(max(memory_per_call), 1), 1))
+    return n_processes
+
+
+class WorkerPool:
+    """Represents a long-lived pool of worker processes, which can be reused by several :class:`MultiProcessor` calls.
+
+    Examples:
+        >>> with WorkerPool(4, initializer, (arg,)) as pool:
+        >>>     ret_vals = MultiProcessor.run(fn, param_list, pool=pool)
+    """
+
+    def __init__(self, n_workers: int = None, initializer: callable = None, initargs: tuple = ()):
+        """Initializes a new instance of the WorkerPool class and starts the worker processes.
+
+        Args:
+            n_workers (int): The number of worker processes (see :func:`get_number_of_workers`).
+            initializer (callable): A function called once by each worker process when it starts,
+                e.g. to load data shared by all function calls.
+            initargs (tuple): The arguments of the initializer.
+        """
+        self.n_workers = get_number_of_workers(n_workers)
+        # start the resource tracker before the workers such that they share it, i.e. the shared memory segments
+        # created by the workers and freed by this process are tracked by the same tracker
+        resource_tracker.ensure_running()
+        self._pool = pmp.Pool(self.n_workers, initializer, initargs)
+
+    def imap_unordered(self, fn: callable, iterable: iter):
+        """Executes the function ``fn`` for each element of the iterable in the worker processes.
+
+        Args:
+            fn (callable): The function to be executed.
+            iterable (iter): The arguments of each ``fn`` call.
+
+        Returns:
+            iter: The return values in the order the calls finish.
+        """
+        return self._pool.imap_unordered(fn, iterable)
+
+    def close(self):
+        """Waits for the pending calls and stops the worker processes."""
+        self._pool.close()
+        self._pool.join()
+
+    def terminate(self):
+        """Stops the worker processes immediately."""
+        self._pool.terminate()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+
 class MultiProcessor:
     """Class managing multiprocessing"""
 
     @staticmethod
-    def run(fn: callable, param_list: iter, fn_kwargs: dict = None, pickle_helper_cls: type = DefaultPickleHelper):
+    def run(fn: callable, param_list: iter, fn_kwargs: dict = None, pickle_helper_cls: type = DefaultPickleHelper,
+            n_workers: int = None, memory_budget: int = None, memory_per_call: t.List[int] = None,
+            pool: WorkerPool = None, backend: str = 'process'):
         """ Executes the function ``fn`` in parallel (different processes) for each parameter in the parameter list.
 
         Args:
@@ -261,32 +590,109 @@ class MultiProcessor:
             param_list (List[tuple]): List containing the parameters for each ``fn`` call.
             fn_kwargs (dict): kwargs for the ``fn`` function call.
             pickle_helper_cls: Class responsible for the pickling of the parameters
+            n_workers (int): The number of worker processes (see :func:`get_number_of_workers`).
+            memory_budget (int): The memory in bytes available for the workers (see :func:`get_memory_budget`).
+            memory_per_call (List[int]): The estimated memory in bytes required by each ``fn`` call, used to limit
+                the number of concurrent calls to the memory budget.
+            pool (WorkerPool): A pool to execute the calls in, instead of starting a new one (process backend only).
+            backend (str): Either 'process' to execute the calls in processes, or 'thread' to execute them in threads
+                of the current process. The thread backend passes the parameters and return values as they are,
+                i.e. without the pickle helper, and is efficient for functions mostly running SimpleITK filters,
+                which release the GIL.
 
         Returns:
             list: A list of all return values of the ``fn`` calls
         """
+        param_list = list(param_list)
+        ret_vals = [None] * len(param_list)
+        for idx, ret_val in MultiProcessor.imap_unordered(fn, param_list, fn_kwargs, pickle_helper_cls, n_workers,
+                                                          memory_budget, memory_per_call, pool, backend):
+            ret_vals[idx] = ret_val
+        return ret_vals
+
+    @staticmethod
+    def imap_unordered(fn: callable, param_list: iter, fn_kwargs: dict = None,
+                       pickle_helper_cls: type = DefaultPickleHelper, n_workers: int = None, memory_budget: int = None,
+                       memory_per_call: t.List[int] = None, pool: WorkerPool = None, backend: str = 'process'):
+        """ Executes the function ``fn`` in parallel (different processes) for each parameter in the parameter list
+        and yields the return values as soon as the calls finish.
+
+        Args:
+            See :meth:`run`.
+
+        Yields:
+            tuple: The index of the parameters in the parameter list and the return value of the ``fn`` call.
+        """
         if fn_kwargs is None:
             fn_kwargs = {}
 
+        param_list = list(param_list)
+        if backend == 'thread':
+            n_threads = get_number_of_processes(len(param_list), n_workers, memory_budget, memory_per_call)
+            yield from MultiProcessor._imap_unordered_threads(fn, param_list, fn_kwargs, n_threads)
+        elif backend != 'process':
+            raise ValueError('Unknown backend "{}"'.format(backend))
+        elif pool is None:
+            n_processes = get_number_of_processes(len(param_list), n_workers, memory_budget, memory_per_call)
+            with WorkerPool(n_processes) as new_pool:
+                yield from MultiProcessor._imap_unordered(fn, param_list, fn_kwargs, pickle_helper_cls, new_pool,
+                                                          len(param_list))
+        else:
+            # a running pool cannot be resized, i.e. limit the concurrent calls by submitting them in chunks
+            n_processes = get_number_of_processes(len(param_list), pool.n_workers, memory_budget, memory_per_call)
+            chunk_size = n_processes if n_processes < pool.n_workers else len(param_list)
+            yield from MultiProcessor._imap_unordered(fn, param_list, fn_kwargs, pickle_helper_cls, pool, chunk_size)
+
+    @staticmethod
+    def _imap_unordered(fn, param_list, fn_kwargs, pickle_helper_cls, pool, chunk_size):
         helper = pickle_helper_cls()
-        # add additional_params
-        param_list = ((*p, fn_kwargs) for p in param_list)
-        param_list = (helper.make_params_picklable(params) for params in param_list)
+        wrapped_fn = MultiProcessor._wrap_fn(fn, pickle_helper_cls)
+        for start in range(0, len(param_list), max(chunk_size, 1)):
+            # add additional_params
+            indexed_params = ((idx, helper.make_params_picklable((*param_list[idx], fn_kwargs)))
+                              for idx in range(start, min(start + chunk_size, len(param_list))))
+            ret_vals = pool.imap_unordered(wrapped_fn, indexed_params)
+            try:
+                for idx, ret_val in ret_vals:
+                    yield idx, helper.recover_return_value(ret_val)
+            finally:
+                # after an error or an early stop, free the return values of the calls still running
+                MultiProcessor._discard(ret_vals, helper)
 
-        with pmp.Pool() as p:
-            ret_vals = p.starmap(MultiProcessor._wrap_fn(fn, pickle_helper_cls), param_list)
-        ret_vals = [helper.recover_return_value(ret_val) for ret_val in ret_vals]
-        return ret_vals
+    @staticmethod
+    def _discard(ret_vals: iter, helper: DefaultPickleHelper):
+        while True:
+            try:
+                _, ret_val = next(ret_vals)
+            except StopIteration:
+                return
+            except Exception:
+                continue  # another failed call
+            helper.discard_return_value(ret_val)
+
+    @staticmethod
+    def _imap_unordered_threads(fn, param_list, fn_kwargs, n_threads):
+        # share the CPUs among the concurrent SimpleITK filters instead of each filter using all of them
+        sitk_threads = sitk.ProcessObject.GetGlobalDefaultNumberOfThreads()
+        sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(max(get_number_of_workers() // n_threads, 1))
+        try:
+            with futures.ThreadPoolExecutor(n_threads) as executor:
+                indices = {executor.submit(fn, *params, **fn_kwargs): idx for idx, params in enumerate(param_list)}
+                for future in futures.as_completed(indices):
+                    yield indices[future], future.result()
+        finally:
+            sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(sitk_threads)
 
     @staticmethod
     def _wrap_fn(fn, pickle_helper_cls):
-        def wrapped_fn(*params):
+        def wrapped_fn(indexed_params):
+            idx, params = indexed_params
             # create instance due to possible race condition (not sure if really possible)
             helper = pickle_helper_cls()
             params = helper.recover_params(params)
             params, shared_params = params[:-1], params[-1]
             ret_val = fn(*params, **shared_params)
             ret_val = helper.make_return_value_picklable(ret_val)
-            return ret_val
+            return idx, ret_val
 
         return wrapped_fn
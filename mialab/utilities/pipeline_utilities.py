@@ -1,8 +1,12 @@
 """This module contains utility classes and functions."""
+import concurrent.futures as futures
 import enum
+import functools
 import os
+import timeit
 import typing as t
 import warnings
+import zlib
 
 import numpy as np
 import pymia.data.conversion as conversion
@@ -15,6 +19,8 @@ import mialab.data.structure as structure
 import mialab.filtering.feature_extraction as fltr_feat
 import mialab.filtering.postprocessing as fltr_postp
 import mialab.filtering.preprocessing as fltr_prep
+import mialab.utilities.cache_utilities as cache_util
+import mialab.utilities.file_access_utilities as futil
 import mialab.utilities.multi_processor as mproc
 
 atlas_t1 = sitk.Image()
@@ -36,6 +42,66 @@ def load_atlas_images(directory: str):
         raise ValueError('T1w and T2w atlas images have not the same image properties')
 
 
+def init_worker(directory: str):
+    """Initializes a worker process by loading the atlas images and computing the static atlas features.
+
+    Args:
+        directory (str): The atlas data directory.
+    """
+    load_atlas_images(directory)
+    fltr_feat.get_atlas_coordinates(atlas_t1)
+
+
+def create_worker_pool(directory: str, n_workers: int = None) -> mproc.WorkerPool:
+    """Creates a pool of worker processes, which are initialized with the atlas images (see :func:`init_worker`).
+
+    Args:
+        directory (str): The atlas data directory.
+        n_workers (int): The number of processes, defaults to the CPUs allocated by SLURM or available.
+
+    Returns:
+        mproc.WorkerPool: The pool, to be passed to :func:`pre_process_batch` and :func:`post_process_batch` and
+        closed after usage.
+    """
+    return mproc.WorkerPool(n_workers, init_worker, (directory,))
+
+
+class StageTimer:
+    """Represents a timer of the stages of a processing, e.g. the pre-processing of an image.
+
+    Examples:
+        >>> timer = StageTimer()
+        >>> images = load(paths)
+        >>> timer.lap('loading')
+        >>> images = register(images)
+        >>> timer.lap('registration')
+        >>> print(timer)
+    """
+
+    def __init__(self):
+        """Initializes a new instance of the StageTimer class."""
+        self.times = {}  # the times in seconds by stage, in the order of execution
+        self._lap_time = timeit.default_timer()
+
+    def lap(self, stage: str):
+        """Records the time elapsed since the previous lap (or the creation of the timer) as time of a stage.
+
+        Args:
+            stage (str): The stage, whose time is summed if it was recorded before.
+        """
+        lap_time = timeit.default_timer()
+        self.times[stage] = self.times.get(stage, 0.0) + lap_time - self._lap_time
+        self._lap_time = lap_time
+
+    def __str__(self):
+        """Gets a printable string representation.
+
+        Returns:
+            str: String representation.
+        """
+        return ', '.join('{} {:.2f} s'.format(stage, time) for stage, time in self.times.items())
+
+
 class FeatureImageTypes(enum.Enum):
     """Represents the feature image types."""
 
@@ -44,6 +110,12 @@ class FeatureImageTypes(enum.Enum):
     T1w_GRADIENT_INTENSITY = 3
     T2w_INTENSITY = 4
     T2w_GRADIENT_INTENSITY = 5
+    T1w_MOMENTS = 6
+    T2w_MOMENTS = 7
+    T1w_TEXTURE = 8
+    T2w_TEXTURE = 9
+    T1w_HISTOGRAM = 10
+    T2w_HISTOGRAM = 11
 
 
 class FeatureExtractor:
@@ -60,112 +132,224 @@ class FeatureExtractor:
         self.coordinates_feature = kwargs.get('coordinates_feature', False)
         self.intensity_feature = kwargs.get('intensity_feature', False)
         self.gradient_intensity_feature = kwargs.get('gradient_intensity_feature', False)
-
-
+        self.moments_feature = kwargs.get('moments_feature', False)
+        self.moments_kernels = kwargs.get('moments_kernels', [(3, 3, 3)])
+        self.texture_feature = kwargs.get('texture_feature', False)
+        self.texture_kernel = kwargs.get('texture_kernel', (3, 3, 3))
+        self.histogram_feature = kwargs.get('histogram_feature', False)
+        self.histogram_kernel = kwargs.get('histogram_kernel', (5, 5, 5))
+        self.histogram_bins = kwargs.get('histogram_bins', 32)
+        self.label_fractions = kwargs.get('label_fractions', [0.0003, 0.004, 0.003, 0.04, 0.04, 0.02])
+        self.label_counts = kwargs.get('label_counts', None)
+        self.sampling_seed = kwargs.get('sampling_seed', None)
+        self.sparse_features = kwargs.get('sparse_features', False)
+        self.feature_threads = kwargs.get('feature_threads', 1)
+        self.indices = None  # the flat indices of the voxels used for training
 
     def execute(self) -> structure.BrainImage:
         """Extracts features from an image.
 
+        The features are independent of each other and computed concurrently by ``feature_threads`` threads,
+        which mostly run SimpleITK and numpy code releasing the GIL, or sequentially for a single thread.
+
         Returns:
             structure.BrainImage: The image with extracted features.
         """
         # todo: add T2w features
 
+        if self.training:
+            self.indices = self._sample_training_voxels()
+
+        feature_functions = self._get_feature_functions()
+        if self.feature_threads <= 1:
+            for feature_type, function in feature_functions.items():
+                self.img.feature_images[feature_type] = function()
+            self._generate_feature_matrix()
+            return self.img
+
+        with futures.ThreadPoolExecutor(self.feature_threads) as executor:
+            feature_images = [executor.submit(function) for function in feature_functions.values()]
+            for feature_type, feature_image in zip(feature_functions, feature_images):
+                self.img.feature_images[feature_type] = feature_image.result()
+
+            self._generate_feature_matrix(executor)
+        return self.img
+
+    def _get_feature_functions(self) -> t.Dict[FeatureImageTypes, callable]:
+        """Gets the functions computing the enabled features.
+
+        Returns:
+            dict: The functions without arguments returning a feature image, in the order of the feature matrix columns.
+        """
+        t1w = self.img.images[structure.BrainImageTypes.T1w]
+        t2w = self.img.images[structure.BrainImageTypes.T2w]
+
+        # in sparse mode, the neighborhood features are only evaluated at the voxels used for training
+        sparse = self.training and self.sparse_features
+
+        functions = {}
         if self.coordinates_feature:
-            # Atlas coordinates feature
-            atlas_coordinates = fltr_feat.AtlasCoordinates()
-            self.img.feature_images[FeatureImageTypes.ATLAS_COORD] = \
-                atlas_coordinates.execute(self.img.images[structure.BrainImageTypes.T1w])
+            # Atlas coordinates feature (a read-only array shared by all images on the atlas geometry)
+            functions[FeatureImageTypes.ATLAS_COORD] = functools.partial(fltr_feat.get_atlas_coordinates, t1w)
 
         if self.intensity_feature:
-            # T1w intensity
-            self.img.feature_images[FeatureImageTypes.T1w_INTENSITY] = self.img.images[structure.BrainImageTypes.T1w]
-            # T2w intensity
-            self.img.feature_images[FeatureImageTypes.T2w_INTENSITY] = self.img.images[structure.BrainImageTypes.T2w]
+            # T1w and T2w intensity
+            functions[FeatureImageTypes.T1w_INTENSITY] = lambda: t1w
+            functions[FeatureImageTypes.T2w_INTENSITY] = lambda: t2w
 
         if self.gradient_intensity_feature:
-            # T1w gradient intensity
-            self.img.feature_images[FeatureImageTypes.T1w_GRADIENT_INTENSITY] = \
-                sitk.GradientMagnitude(self.img.images[structure.BrainImageTypes.T1w])
-            # T2w gradient intensity
-            self.img.feature_images[FeatureImageTypes.T2w_GRADIENT_INTENSITY] = \
-                sitk.GradientMagnitude(self.img.images[structure.BrainImageTypes.T2w])
-
-        self._generate_feature_matrix()
-        return self.img
+            # T1w and T2w gradient intensity
+            functions[FeatureImageTypes.T1w_GRADIENT_INTENSITY] = functools.partial(sitk.GradientMagnitude, t1w)
+            functions[FeatureImageTypes.T2w_GRADIENT_INTENSITY] = functools.partial(sitk.GradientMagnitude, t2w)
+
+        # the neighborhood features of the T1w and T2w image
+        neighborhood_extractors = []
+        if self.moments_feature:
+            # local mean, variance, sigma, skewness, kurtosis, and snr for each neighborhood size
+            neighborhood_extractors.append((fltr_feat.NeighborhoodMomentsExtractor(self.moments_kernels),
+                                            FeatureImageTypes.T1w_MOMENTS, FeatureImageTypes.T2w_MOMENTS))
+        if self.texture_feature:
+            # first-order texture features (see fltr_feat.first_order_texture_features_function)
+            neighborhood_extractors.append((fltr_feat.NeighborhoodFeatureExtractor(self.texture_kernel),
+                                            FeatureImageTypes.T1w_TEXTURE, FeatureImageTypes.T2w_TEXTURE))
+        if self.histogram_feature:
+            # rank and entropy features of the quantized intensities
+            histogram = fltr_feat.RollingHistogramFeatures(self.histogram_bins)
+            neighborhood_extractors.append((fltr_feat.NeighborhoodFeatureExtractor(self.histogram_kernel, histogram),
+                                            FeatureImageTypes.T1w_HISTOGRAM, FeatureImageTypes.T2w_HISTOGRAM))
+
+        for extractor, t1w_feature_type, t2w_feature_type in neighborhood_extractors:
+            for feature_type, image in ((t1w_feature_type, t1w), (t2w_feature_type, t2w)):
+                if sparse:
+                    functions[feature_type] = functools.partial(extractor.execute_at, image, self.indices)
+                else:
+                    functions[feature_type] = functools.partial(extractor.execute, image)
+
+        return functions
+
+    def _sample_training_voxels(self) -> np.ndarray:
+        """Samples the voxels used for training.
 
-    def _generate_feature_matrix(self):
-        """Generates a feature matrix."""
+        Returns:
+            np.ndarray: The sorted flat indices of the voxels used for training.
+        """
 
-        mask = None
-        if self.training:
-            # generate a randomized mask where 1 represents voxels used for training
-            # the mask needs to be binary, where the value 1 is considered as a voxel which is to be loaded
-            # we have following labels:
-            # - 0 (background)
-            # - 1 (white matter)
-            # - 2 (grey matter)
-            # - 3 (Hippocampus)
-            # - 4 (Amygdala)
-            # - 5 (Thalamus)
-
-            # you can exclude background voxels from the training mask generation
-            # mask_background = self.img.images[structure.BrainImageTypes.BrainMask]
-            # and use background_mask=mask_background in get_mask()
-
-            mask = fltr_feat.RandomizedTrainingMaskGenerator.get_mask(
-                self.img.images[structure.BrainImageTypes.GroundTruth],
-                [0, 1, 2, 3, 4, 5],
-                [0.0003, 0.004, 0.003, 0.04, 0.04, 0.02])
-
-            # convert the mask to a logical array where value 1 is False and value 0 is True
-            mask = sitk.GetArrayFromImage(mask)
-            mask = np.logical_not(mask)
-
-        # generate features
-        data = np.concatenate(
-            [self._image_as_numpy_array(image, mask) for id_, image in self.img.feature_images.items()],
-            axis=1)
+        # sample either a fraction or a fixed number of voxels per label
+        # we have following labels:
+        # - 0 (background)
+        # - 1 (white matter)
+        # - 2 (grey matter)
+        # - 3 (Hippocampus)
+        # - 4 (Amygdala)
+        # - 5 (Thalamus)
+
+        # you can exclude background voxels from the sampling
+        # mask_background = self.img.images[structure.BrainImageTypes.BrainMask]
+        # and use background_mask=mask_background in get_indices()
+
+        sampler = fltr_feat.StratifiedVoxelSampler([0, 1, 2, 3, 4, 5], self.label_fractions, self.label_counts)
+        return sampler.get_indices(self.img.images[structure.BrainImageTypes.GroundTruth], self._get_rng())
+
+    def _generate_feature_matrix(self, executor: futures.Executor = None):
+        """Generates a feature matrix.
+
+        Args:
+            executor (futures.Executor): An executor to write the feature images concurrently, or None.
+        """
+
+        indices = self.indices
+
+        # preallocate the feature matrix and write each feature image into its columns
+        feature_images = list(self.img.feature_images.values())
+        no_components = [self._get_number_of_components(image) for image in feature_images]
+        no_voxels = indices.size if indices is not None else \
+            int(np.prod(self.img.images[structure.BrainImageTypes.GroundTruth].GetSize()))
+        data = np.empty((no_voxels, sum(no_components)), np.float32)
+
+        images_and_columns = []
+        column = 0
+        for image, number_of_components in zip(feature_images, no_components):
+            images_and_columns.append((image, data[:, column:column + number_of_components]))
+            column += number_of_components
 
         # generate labels (note that we assume to have a ground truth even for testing)
-        labels = self._image_as_numpy_array(self.img.images[structure.BrainImageTypes.GroundTruth], mask)
+        labels = np.empty((no_voxels, 1), np.int16)
+        images_and_columns.append((self.img.images[structure.BrainImageTypes.GroundTruth], labels))
+
+        map_ = executor.map if executor is not None else map
+        list(map_(lambda image_and_columns: self._write_columns(image_and_columns[0], indices, image_and_columns[1]),
+                  images_and_columns))
+
+        self.img.feature_matrix = (data, labels)
 
-        self.img.feature_matrix = (data.astype(np.float32), labels.astype(np.int16))
+    def _get_rng(self) -> np.random.Generator:
+        """Gets the random number generator for the sampling of the training voxels.
+
+        Returns:
+            np.random.Generator: A generator seeded by the sampling seed and the image identifier, such that the samples
+            of an image are reproducible independent of the process and the order of processing.
+        """
+        if self.sampling_seed is None:
+            return np.random.default_rng()
+        return np.random.default_rng([self.sampling_seed, zlib.crc32(self.img.id_.encode())])
 
     @staticmethod
-    def _image_as_numpy_array(image: sitk.Image, mask: np.ndarray = None):
-        """Gets an image as numpy array where each row is a voxel and each column is a feature.
+    def _get_number_of_components(image: t.Union[sitk.Image, np.ndarray]) -> int:
+        """Gets the number of features of an image.
 
         Args:
-            image (sitk.Image): The image.
-            mask (np.ndarray): A mask defining which voxels to return. True is background, False is a masked voxel.
+            image (sitk.Image or np.ndarray): The image, its array of shape (z, y, x) or (z, y, x, components), or
+                the features of shape (no_voxels, components) evaluated at the sampled voxels only.
 
         Returns:
-            np.ndarray: An array where each row is a voxel and each column is a feature.
+            int: The number of components per voxel.
         """
+        if isinstance(image, np.ndarray):
+            return image.shape[-1] if image.ndim in (2, 4) else 1
+        return image.GetNumberOfComponentsPerPixel()
 
-        number_of_components = image.GetNumberOfComponentsPerPixel()  # the number of features for this image
-        no_voxels = np.prod(image.GetSize())
-        image = sitk.GetArrayFromImage(image)
+    @staticmethod
+    def _write_columns(image: t.Union[sitk.Image, np.ndarray], indices: np.ndarray, out: np.ndarray):
+        """Writes an image into columns of the feature matrix, where each row is a voxel and each column a feature.
 
-        if mask is not None:
-            no_voxels = np.size(mask) - np.count_nonzero(mask)
+        Args:
+            image (sitk.Image or np.ndarray): The image, its array of shape (z, y, x) or (z, y, x, components), or
+                the features of shape (no_voxels, components) evaluated at the sampled voxels only.
+            indices (np.ndarray): The flat indices of the voxels to write, or None to write all voxels.
+            out (np.ndarray): The columns of the feature matrix of shape (no_voxels, number_of_components).
+        """
+        number_of_components = out.shape[1]
+        if isinstance(image, np.ndarray) and image.ndim == 2:
+            out[...] = image  # already evaluated at the sampled voxels
+            return
 
-            if number_of_components == 1:
-                masked_image = np.ma.masked_array(image, mask=mask)
-            else:
-                # image is a vector image, make a vector mask
-                vector_mask = np.expand_dims(mask, axis=3)  # shape is now (z, x, y, 1)
-                vector_mask = np.repeat(vector_mask, number_of_components,
-                                        axis=3)  # shape is now (z, x, y, number_of_components)
-                masked_image = np.ma.masked_array(image, mask=vector_mask)
+        if isinstance(image, sitk.Image):
+            image = sitk.GetArrayViewFromImage(image)  # no copy, only valid while the image is alive
+        image = image.reshape((-1, number_of_components))
 
-            image = masked_image[~masked_image.mask]
+        if indices is None:
+            out[...] = image
+        else:
+            out[...] = image[indices]
+
+
+def load_images(paths: dict) -> dict:
+    """Loads the images of an image identifier.
+
+    Args:
+        paths (dict): A dict, where the keys are an image identifier of type structure.BrainImageTypes
+            and the values are paths to the images or already loaded images.
 
-        return image.reshape((no_voxels, number_of_components))
+    Returns:
+        dict: The paths with the images loaded, except the registration transformation and the image directory.
+    """
+    return {key: sitk.ReadImage(path) if isinstance(key, structure.BrainImageTypes) and
+            key != structure.BrainImageTypes.RegistrationTransform and not isinstance(path, sitk.Image) else path
+            for key, path in paths.items()}
 
 
-def pre_process(id_: str, paths: dict, **kwargs) -> structure.BrainImage:
+def pre_process(id_: str, paths: dict, pre_processing_cache: cache_util.PreProcessingCache = None,
+                **kwargs) -> structure.BrainImage:
     """Loads and processes an image.
 
     The processing includes:
@@ -174,10 +358,19 @@ def pre_process(id_: str, paths: dict, **kwargs) -> structure.BrainImage:
     - Pre-processing
     - Feature extraction
 
+    If ``cache_dir`` is given, the pre-processed image is loaded from the cache in this directory if the same inputs
+    were pre-processed with the same parameters and code before, and otherwise added to the cache, which is limited
+    to ``cache_max_bytes`` (see :class:`mialab.utilities.cache_utilities.PreProcessingCache`). A batch opens the
+    cache once and passes it as ``pre_processing_cache`` (see :func:`get_pre_processing_cache`).
+
+    If ``estimate_registration`` is set, the registration transformation is estimated once and stored in the image
+    directory (see :func:`estimate_transform`) instead of reading the given one, which must exist otherwise.
+
     Args:
         id_ (str): An image identifier.
         paths (dict): A dict, where the keys are an image identifier of type structure.BrainImageTypes
-            and the values are paths to the images.
+            and the values are paths to the images or already loaded images (see :func:`load_images`).
+        pre_processing_cache (cache_util.PreProcessingCache): The opened cache of ``cache_dir``, or None to open it.
 
     Returns:
         (structure.BrainImage):
@@ -185,17 +378,162 @@ def pre_process(id_: str, paths: dict, **kwargs) -> structure.BrainImage:
 
     print('-' * 10, 'Processing', id_)
 
+    cache = pre_processing_cache if pre_processing_cache is not None else get_pre_processing_cache(kwargs)
+    if cache is None:
+        return _pre_process(id_, paths, **kwargs)
+
+    key = cache.get_key(id_, paths, [atlas_t1, atlas_t2], kwargs)
+    img = cache.load(key)
+    if img is None:
+        img = _pre_process(id_, paths, **kwargs)
+        cache.save(key, img)
+    return img
+
+
+def get_pre_processing_cache(pre_process_params: dict) -> t.Optional[cache_util.PreProcessingCache]:
+    """Opens the on-disk cache of the pre-processed images, which hashes the code and removes outdated entries.
+
+    Args:
+        pre_process_params (dict): Pre-processing parameters.
+
+    Returns:
+        cache_util.PreProcessingCache: The cache in ``cache_dir``, or None if no ``cache_dir`` is given.
+    """
+    if not pre_process_params.get('cache_dir', None):
+        return None
+    return cache_util.PreProcessingCache(pre_process_params['cache_dir'],
+                                         pre_process_params.get('cache_max_bytes', None))
+
+
+def pre_process_cached(id_: str, paths: dict, cache: cache_util.BrainImageCache = None,
+                       pre_processing_cache: cache_util.PreProcessingCache = None, **kwargs) -> structure.BrainImage:
+    """Gets a pre-processed image from the cache, or pre-processes it and adds it to the cache
+    (see :func:`pre_process`).
+
+    Args:
+        id_ (str): An image identifier.
+        paths (dict): A dict, where the keys are an image identifier of type structure.BrainImageTypes
+            and the values are paths to the images or already loaded images.
+        cache (cache_util.BrainImageCache): The cache, or None to pre-process the image anyway.
+        pre_processing_cache (cache_util.PreProcessingCache): The opened on-disk cache (see :func:`pre_process`).
+
+    Returns:
+        (structure.BrainImage): The pre-processed image, which must not be modified if it is cached.
+    """
+    if cache is None:
+        return pre_process(id_, paths, pre_processing_cache, **kwargs)
+
+    key = cache.get_key(id_, paths, kwargs)
+    img = cache.get(key)
+    if img is None:
+        img = pre_process(id_, paths, pre_processing_cache, **kwargs)
+        cache.put(key, img)
+    return img
+
+
+def estimate_transform(directory: str, images: dict, **kwargs) -> sitk.Transform:
+    """Estimates the transformation registering an image to the atlas, or loads it if it was estimated before.
+
+    The image of type ``registration_image`` (the brain mask by default, which matches the atlas mask) is registered
+    by a :class:`mialab.filtering.preprocessing.MultiResolutionRegistration` with the ``registration_params``. The
+    transformation is stored in the image directory, identified by the digests of the images and the parameters,
+    such that each image is registered once.
+
+    Args:
+        directory (str): The image directory.
+        images (dict): The loaded images by structure.BrainImageTypes (see :func:`load_images`).
+        kwargs: The pre-processing parameters (see :func:`pre_process`).
+
+    Returns:
+        sitk.Transform: The transformation mapping points of the atlas to the image.
+    """
+    registration = fltr_prep.MultiResolutionRegistration(**kwargs.get('registration_params', {}))
+    image = images[kwargs.get('registration_image', structure.BrainImageTypes.BrainMask)]
+
+    transform_path = cache_util.get_transform_path(directory, image, atlas_t1, registration)
+    transform = cache_util.load_transform(transform_path)
+    if transform is None:
+        transform = registration.estimate_transform(image, fltr_prep.MultiResolutionRegistrationParameters(atlas_t1))
+        cache_util.save_transform(transform_path, transform)
+    return transform
+
+
+def correct_bias_field(directory: str, image: sitk.Image, img_mask: sitk.Image, **kwargs) -> sitk.Image:
+    """Corrects the bias field of an image, which is estimated once and stored in the image directory.
+
+    The bias field is estimated by a :class:`mialab.filtering.preprocessing.BiasFieldCorrection` with the
+    ``bias_correction_params`` and identified by the digests of the images and the parameters.
+
+    Args:
+        directory (str): The image directory.
+        image (sitk.Image): The image.
+        img_mask (sitk.Image): The brain mask image limiting the estimation.
+        kwargs: The pre-processing parameters (see :func:`pre_process`).
+
+    Returns:
+        sitk.Image: The float32 corrected image.
+    """
+    correction = fltr_prep.BiasFieldCorrection(**kwargs.get('bias_correction_params', {}))
+
+    field_path = cache_util.get_bias_field_path(directory, image, img_mask, correction)
+    log_bias_field = cache_util.load_image(field_path)
+    if log_bias_field is None:
+        log_bias_field = correction.estimate_log_bias_field(image, img_mask)
+        cache_util.save_image(field_path, log_bias_field)
+    return correction.execute(image, fltr_prep.BiasFieldCorrectionParameters(img_mask, log_bias_field))
+
+
+def _pre_process(id_: str, paths: dict, **kwargs) -> structure.BrainImage:
+    """Loads and processes an image (see :func:`pre_process`)."""
+
+    timer = StageTimer()
+
     # load image
-    path = paths.pop(id_, '')  # the value with key id_ is the root directory of the image
-    path_to_transform = paths.pop(structure.BrainImageTypes.RegistrationTransform, '')
-    img = {img_key: sitk.ReadImage(path) for img_key, path in paths.items()}
-    transform = sitk.ReadTransform(path_to_transform)
-    img = structure.BrainImage(id_, path, img, transform)
+    path = paths.get(id_, '')  # the value with key id_ is the root directory of the image
+    path_to_transform = paths.get(structure.BrainImageTypes.RegistrationTransform, '')
+    # the caller's paths are not modified, e.g. to pre-process the same paths again
+    images = {key: value for key, value in paths.items()
+              if key not in (id_, structure.BrainImageTypes.RegistrationTransform)}
+    img = structure.BrainImage(id_, path, load_images(images), None)
+    timer.lap('loading')
+    if kwargs.get('registration_pre', False) and kwargs.get('estimate_registration', False):
+        if not path:
+            raise ValueError(f'The registration of {id_} cannot be estimated without its directory')
+        img.transformation = estimate_transform(path, img.images, **kwargs)
+        timer.lap('registration estimation')
+    elif kwargs.get('registration_pre', False) and not os.path.isfile(path_to_transform):
+        raise FileNotFoundError(f'The registration transformation of {id_} does not exist: "{path_to_transform}" '
+                                f'(set estimate_registration to estimate it)')
+    else:
+        img.transformation = sitk.ReadTransform(path_to_transform)
+
+    if kwargs.get('bias_correction_pre', False):
+        # correct the bias fields in the native space, where the brain mask matches the images
+        for image_type in (structure.BrainImageTypes.T1w, structure.BrainImageTypes.T2w):
+            img.images[image_type] = correct_bias_field(path, img.images[image_type],
+                                                        img.images[structure.BrainImageTypes.BrainMask], **kwargs)
+        timer.lap('bias correction')
+
+    # register all images at once (the atlas images share their geometry, see load_atlas_images),
+    # otherwise each image in its pipeline
+    register_separately = kwargs.get('registration_pre', False)
+    if register_separately and kwargs.get('fused_registration', True):
+        register_separately = False
+        image_types = [structure.BrainImageTypes.BrainMask, structure.BrainImageTypes.T1w,
+                       structure.BrainImageTypes.T2w, structure.BrainImageTypes.GroundTruth]
+        # the intensities outside the brain mask are removed by the skull-stripping anyway
+        mask_index = 0 if kwargs.get('skullstrip_pre', False) else None
+        registered_images = fltr_prep.MultiImageRegistration().execute(
+            [img.images[image_type] for image_type in image_types],
+            fltr_prep.MultiImageRegistrationParameters(atlas_t1, img.transformation, [True, False, False, True],
+                                                       mask_index))
+        img.images.update(zip(image_types, registered_images))
+        timer.lap('registration')
 
     # construct pipeline for brain mask registration
     # we need to perform this before the T1w and T2w pipeline because the registered mask is used for skull-stripping
     pipeline_brain_mask = fltr.FilterPipeline()
-    if kwargs.get('registration_pre', False):
+    if register_separately:
         pipeline_brain_mask.add_filter(fltr_prep.ImageRegistration())
         pipeline_brain_mask.set_param(fltr_prep.ImageRegistrationParameters(atlas_t1, img.transformation, True),
                                       len(pipeline_brain_mask.filters) - 1)
@@ -206,39 +544,55 @@ def pre_process(id_: str, paths: dict, **kwargs) -> structure.BrainImage:
 
     # construct pipeline for T1w image pre-processing
     pipeline_t1 = fltr.FilterPipeline()
-    if kwargs.get('registration_pre', False):
+    if register_separately:
         pipeline_t1.add_filter(fltr_prep.ImageRegistration())
         pipeline_t1.set_param(fltr_prep.ImageRegistrationParameters(atlas_t1, img.transformation),
                               len(pipeline_t1.filters) - 1)
-    if kwargs.get('skullstrip_pre', False):
-        pipeline_t1.add_filter(fltr_prep.SkullStripping())
-        pipeline_t1.set_param(fltr_prep.SkullStrippingParameters(img.images[structure.BrainImageTypes.BrainMask]),
-                              len(pipeline_t1.filters) - 1)
-    if kwargs.get('normalization_pre', False):
-        pipeline_t1.add_filter(fltr_prep.ImageNormalization())
+    if kwargs.get('inplace_pre', True) and \
+            (kwargs.get('skullstrip_pre', False) or kwargs.get('normalization_pre', False)):
+        pipeline_t1.add_filter(fltr_prep.SkullStrippingNormalization())
+        pipeline_t1.set_param(fltr_prep.SkullStrippingNormalizationParameters(
+            img.images[structure.BrainImageTypes.BrainMask] if kwargs.get('skullstrip_pre', False) else None,
+            kwargs.get('normalization_pre', False), kwargs.get('mask_normalization', False)),
+            len(pipeline_t1.filters) - 1)
+    else:
+        if kwargs.get('skullstrip_pre', False):
+            pipeline_t1.add_filter(fltr_prep.SkullStripping())
+            pipeline_t1.set_param(fltr_prep.SkullStrippingParameters(img.images[structure.BrainImageTypes.BrainMask]),
+                                  len(pipeline_t1.filters) - 1)
+        if kwargs.get('normalization_pre', False):
+            pipeline_t1.add_filter(fltr_prep.ImageNormalization())
 
     # execute pipeline on the T1w image
     img.images[structure.BrainImageTypes.T1w] = pipeline_t1.execute(img.images[structure.BrainImageTypes.T1w])
 
     # construct pipeline for T2w image pre-processing
     pipeline_t2 = fltr.FilterPipeline()
-    if kwargs.get('registration_pre', False):
+    if register_separately:
         pipeline_t2.add_filter(fltr_prep.ImageRegistration())
         pipeline_t2.set_param(fltr_prep.ImageRegistrationParameters(atlas_t2, img.transformation),
                               len(pipeline_t2.filters) - 1)
-    if kwargs.get('skullstrip_pre', False):
-        pipeline_t2.add_filter(fltr_prep.SkullStripping())
-        pipeline_t2.set_param(fltr_prep.SkullStrippingParameters(img.images[structure.BrainImageTypes.BrainMask]),
-                              len(pipeline_t2.filters) - 1)
-    if kwargs.get('normalization_pre', False):
-        pipeline_t2.add_filter(fltr_prep.ImageNormalization())
+    if kwargs.get('inplace_pre', True) and \
+            (kwargs.get('skullstrip_pre', False) or kwargs.get('normalization_pre', False)):
+        pipeline_t2.add_filter(fltr_prep.SkullStrippingNormalization())
+        pipeline_t2.set_param(fltr_prep.SkullStrippingNormalizationParameters(
+            img.images[structure.BrainImageTypes.BrainMask] if kwargs.get('skullstrip_pre', False) else None,
+            kwargs.get('normalization_pre', False), kwargs.get('mask_normalization', False)),
+            len(pipeline_t2.filters) - 1)
+    else:
+        if kwargs.get('skullstrip_pre', False):
+            pipeline_t2.add_filter(fltr_prep.SkullStripping())
+            pipeline_t2.set_param(fltr_prep.SkullStrippingParameters(img.images[structure.BrainImageTypes.BrainMask]),
+                                  len(pipeline_t2.filters) - 1)
+        if kwargs.get('normalization_pre', False):
+            pipeline_t2.add_filter(fltr_prep.ImageNormalization())
 
     # execute pipeline on the T2w image
     img.images[structure.BrainImageTypes.T2w] = pipeline_t2.execute(img.images[structure.BrainImageTypes.T2w])
 
     # construct pipeline for ground truth image pre-processing
     pipeline_gt = fltr.FilterPipeline()
-    if kwargs.get('registration_pre', False):
+    if register_separately:
         pipeline_gt.add_filter(fltr_prep.ImageRegistration())
         pipeline_gt.set_param(fltr_prep.ImageRegistrationParameters(atlas_t1, img.transformation, True),
                               len(pipeline_gt.filters) - 1)
@@ -247,27 +601,136 @@ def pre_process(id_: str, paths: dict, **kwargs) -> structure.BrainImage:
     img.images[structure.BrainImageTypes.GroundTruth] = pipeline_gt.execute(
         img.images[structure.BrainImageTypes.GroundTruth])
 
+    timer.lap('pre-processing')
+
     # update image properties to atlas image properties after registration
     img.image_properties = conversion.ImageProperties(img.images[structure.BrainImageTypes.T1w])
 
+    if kwargs.get('roi_crop', False):
+        # crop all images to the brain such that the subsequent steps skip most of the background
+        crop_to_roi(img, kwargs.get('roi_padding', 5))
+
     # extract the features
     feature_extractor = FeatureExtractor(img, **kwargs)
     img = feature_extractor.execute()
 
-    img.feature_images = {}  # we free up memory because we only need the img.feature_matrix
-    # for training of the classifier
+    # we free up memory because we only need the img.feature_matrix for training of the classifier
+    img.retain(kwargs.get('retention_policy', structure.RetentionPolicy.ALL))
+    timer.lap('feature extraction')
 
+    print(' Stage times of {}: {}'.format(id_, timer))
     return img
 
 
-def post_process(img: structure.BrainImage, segmentation: sitk.Image, probability: sitk.Image,
+def get_roi(mask: sitk.Image, padding: int = 0) -> t.Tuple[tuple, tuple]:
+    """Gets the padded bounding box of a mask.
+
+    Args:
+        mask (sitk.Image): The mask, where non-zero intensities are inside.
+        padding (int): The number of voxels to add on each side, limited by the image extent.
+
+    Returns:
+        tuple: The (index, size) of the bounding box in image order (x, y, z).
+
+    Raises:
+        ValueError: If the mask is empty.
+    """
+
+    mask_array = sitk.GetArrayViewFromImage(mask)
+    index, size = [], []
+    for axis in reversed(range(mask_array.ndim)):  # numpy axes are in reversed order
+        inside = np.flatnonzero(np.any(mask_array, axis=tuple(a for a in range(mask_array.ndim) if a != axis)))
+        if inside.size == 0:
+            raise ValueError('mask is empty')
+        start = max(int(inside[0]) - padding, 0)
+        stop = min(int(inside[-1]) + 1 + padding, mask_array.shape[axis])
+        index.append(start)
+        size.append(stop - start)
+    return tuple(index), tuple(size)
+
+
+def crop_to_roi(img: structure.BrainImage, padding: int = 0):
+    """Crops all images of a brain image to the padded bounding box of its brain mask.
+
+    The full image properties and the region of interest are kept on the brain image to restore the full images
+    with :py:func:`embed_roi`.
+
+    Args:
+        img (structure.BrainImage): The brain image.
+        padding (int): The number of voxels to add on each side of the bounding box.
+    """
+
+    index, size = get_roi(img.images[structure.BrainImageTypes.BrainMask], padding)
+    img.images.update({key: sitk.RegionOfInterest(image, size, index) for key, image in img.images.items()})
+    img.roi = (index, size)
+    img.full_image_properties = img.image_properties
+    img.image_properties = conversion.ImageProperties(img.images[structure.BrainImageTypes.T1w])
+
+
+def embed_roi(img: structure.BrainImage, image: sitk.Image) -> sitk.Image:
+    """Embeds an image of the region of interest into the full image, e.g. before writing a segmentation.
+
+    Args:
+        img (structure.BrainImage): The brain image the image belongs to.
+        image (sitk.Image): The image of the region of interest.
+
+    Returns:
+        sitk.Image: The image with the full image properties, which is zero outside the region of interest.
+    """
+
+    if img.roi is None:
+        return image
+
+    index, size = img.roi
+    array = sitk.GetArrayViewFromImage(image)
+    full_array = np.zeros(img.full_image_properties.size[::-1] + array.shape[3:], array.dtype)
+    full_array[tuple(slice(start, start + extent) for start, extent in zip(index[::-1], size[::-1]))] = array
+    return conversion.NumpySimpleITKImageBridge.convert(full_array, img.full_image_properties)
+
+
+def predict(forest, img: structure.BrainImage, chunk_size: int = 1000000) -> t.Tuple[np.ndarray, np.ndarray]:
+    """Classifies the voxels of an image inside its brain mask.
+
+    The voxels outside the brain mask are assigned the background label 0 with probability one. The forest is
+    evaluated once per voxel, i.e. the labels are the classes with the highest probability as in ``forest.predict``.
+
+    Args:
+        forest: The fitted classifier providing ``classes_`` and ``predict_proba``, e.g. a random forest.
+        img (structure.BrainImage): The image with the feature matrix of all voxels.
+        chunk_size (int): The maximum number of voxels classified at once, which bounds the memory.
+
+    Returns:
+        tuple: The predicted labels of shape (n,) and the float32 probabilities of shape (n, number_of_classes).
+
+    Raises:
+        ValueError: If the forest does not know the background label 0.
+    """
+
+    background = np.flatnonzero(forest.classes_ == 0)
+    if background.size == 0:
+        raise ValueError('forest needs to be trained on the background label 0')
+
+    features = img.feature_matrix[0]
+    inside = np.flatnonzero(sitk.GetArrayViewFromImage(img.images[structure.BrainImageTypes.BrainMask]))
+
+    probabilities = np.zeros((features.shape[0], forest.classes_.size), np.float32)
+    probabilities[:, background[0]] = 1
+    for start in range(0, inside.size, chunk_size):
+        chunk = inside[start:start + chunk_size]
+        probabilities[chunk] = forest.predict_proba(features[chunk])
+
+    predictions = forest.classes_[np.argmax(probabilities, axis=1)]
+    return predictions, probabilities
+
+
+def post_process(img: structure.BrainImage, segmentation: sitk.Image, probability: structure.ProbabilityMap,
                  **kwargs) -> sitk.Image:
     """Post-processes a segmentation.
 
     Args:
         img (structure.BrainImage): The image.
         segmentation (sitk.Image): The segmentation (label image).
-        probability (sitk.Image): The probabilities images (a vector image).
+        probability (structure.ProbabilityMap): The probabilities, only converted to an image if needed.
 
     Returns:
         sitk.Image: The post-processed image.
@@ -283,10 +746,11 @@ def post_process(img: structure.BrainImage, segmentation: sitk.Image, probabilit
         pipeline.add_filter(fltr_postp.DenseCRF())
         pipeline.set_param(fltr_postp.DenseCRFParams(img.images[structure.BrainImageTypes.T1w],
                                                      img.images[structure.BrainImageTypes.T2w],
-                                                     probability), len(pipeline.filters) - 1)
+                                                     probability.to_image()), len(pipeline.filters) - 1)
 
     return pipeline.execute(segmentation)
 
+
 def init_evaluator() -> eval_.Evaluator:
     """Initializes an evaluator with the Dice and Hausdorff metrics.
 
@@ -306,8 +770,73 @@ def init_evaluator() -> eval_.Evaluator:
     evaluator = eval_.SegmentationEvaluator(metrics, labels)
     return evaluator
 
+
+def estimate_pre_process_memory(paths: dict, **kwargs) -> int:
+    """Estimates the memory required to pre-process an image from the headers of its files.
+
+    Args:
+        paths (dict): A dict, where the keys are an image identifier of type structure.BrainImageTypes
+            and the values are paths to the images (see :func:`pre_process`).
+        kwargs: The pre-processing parameters (see :func:`pre_process`).
+
+    Returns:
+        int: The estimated memory in bytes.
+    """
+    image_paths = [path for key, path in paths.items()
+                   if isinstance(key, structure.BrainImageTypes) and
+                   key != structure.BrainImageTypes.RegistrationTransform]
+
+    reader = sitk.ImageFileReader()
+    number_of_bytes = 0
+    number_of_voxels = 0
+    for path in image_paths:
+        reader.SetFileName(path)
+        reader.ReadImageInformation()
+        voxels = int(np.prod(reader.GetSize()))
+        number_of_bytes += voxels * reader.GetNumberOfComponents() * \
+            sitk.Image(1, 1, reader.GetPixelID()).GetSizeOfPixelComponent()
+        number_of_voxels = max(number_of_voxels, voxels)
+    if kwargs.get('registration_pre', False) and atlas_t1.GetNumberOfPixels() > 0:
+        number_of_voxels = max(number_of_voxels, atlas_t1.GetNumberOfPixels())  # the images are resampled to the atlas
+
+    # the bytes held per voxel of the registered images at the end of the pre-processing:
+    # - 16 for the T1w, T2w, brain mask and ground truth images (at most float32 each)
+    # - 12 for the float32 atlas coordinates
+    # - 8 for the float32 T1w and T2w gradient magnitudes
+    # - 28 for the feature matrix with seven float32 columns (the int16 labels fit the smaller mask and ground truth)
+    bytes_per_voxel = 64
+    # the float32 neighborhood features of the T1w and T2w image, held as feature images and as feature matrix columns
+    number_of_neighborhood_features = 0
+    if kwargs.get('moments_feature', False):
+        number_of_neighborhood_features += 6 * len(kwargs.get('moments_kernels', [(3, 3, 3)]))
+    if kwargs.get('texture_feature', False):
+        number_of_neighborhood_features += 16
+    if kwargs.get('histogram_feature', False):
+        number_of_neighborhood_features += 9
+    bytes_per_voxel += 2 * 2 * 4 * number_of_neighborhood_features
+    return number_of_bytes + number_of_voxels * bytes_per_voxel
+
+
+def get_load_fn(pre_process_params: dict, cache: cache_util.BrainImageCache = None) -> callable:
+    """Gets the function loading the images of an image identifier in advance of the pre-processing.
+
+    Args:
+        pre_process_params (dict): Pre-processing parameters.
+        cache (cache_util.BrainImageCache): The in-memory cache of pre-processed images, if any.
+
+    Returns:
+        callable: :func:`load_images`, or a function copying the paths if the pre-processed images are cached, because
+        the images are then mostly not needed.
+    """
+    return dict if pre_process_params.get('cache_dir', None) or cache is not None else load_images
+
+
 def pre_process_batch(data_batch: t.Dict[structure.BrainImageTypes, structure.BrainImage],
-                      pre_process_params: dict = None, multi_process: bool = True) -> t.List[structure.BrainImage]:
+                      pre_process_params: dict = None, multi_process: bool = True,
+                      shared_memory: bool = False, n_workers: int = None,
+                      memory_budget: int = None, pool: mproc.WorkerPool = None, backend: str = 'process',
+                      prefetch_depth: int = 2, prefetch_bytes: int = None,
+                      cache: cache_util.BrainImageCache = None) -> t.List[structure.BrainImage]:
     """Loads and pre-processes a batch of images.
 
     The pre-processing includes:
@@ -320,6 +849,20 @@ def pre_process_batch(data_batch: t.Dict[structure.BrainImageTypes, structure.Br
         data_batch (Dict[structure.BrainImageTypes, structure.BrainImage]): Batch of images to be processed.
         pre_process_params (dict): Pre-processing parameters.
         multi_process (bool): Whether to use the parallel processing on multiple cores or to run sequentially.
+        shared_memory (bool): Whether to transfer the images from the processes via shared memory instead of pipes.
+            The feature matrices then remain views on the shared memory until
+            :func:`mialab.utilities.multi_processor.release_shared_memory` is called.
+        n_workers (int): The number of processes, defaults to the CPUs allocated by SLURM or available.
+        memory_budget (int): The memory in bytes available to the processes, defaults to the memory allocated by SLURM
+            or available. The number of images processed concurrently is limited to fit the budget.
+        pool (mproc.WorkerPool): A pool to process the images in (see :func:`create_worker_pool`), instead of
+            starting a new one.
+        backend (str): Either 'process' or 'thread' to process the images in threads without any conversion
+            (see :meth:`mialab.utilities.multi_processor.MultiProcessor.run`).
+        prefetch_depth (int): The number of images loaded in advance in the background if not processed in parallel.
+        prefetch_bytes (int): The maximum number of bytes of images loaded in advance, or None for no limit.
+        cache (cache_util.BrainImageCache): A cache to get the images pre-processed before from and to add the newly
+            pre-processed images to. The cached images are shared, i.e. they must not be modified.
 
     Returns:
         List[structure.BrainImage]: A list of images.
@@ -327,25 +870,56 @@ def pre_process_batch(data_batch: t.Dict[structure.BrainImageTypes, structure.Br
     if pre_process_params is None:
         pre_process_params = {}
 
+    # only pre-process the images not cached yet
+    keys, images = [], [None] * len(data_batch)
+    if cache is not None:
+        keys = [cache.get_key(id_, paths, pre_process_params) for id_, paths in data_batch.items()]
+        images = [cache.get(key) for key in keys]
+    missing = [idx for idx, img in enumerate(images) if img is None]
+    data_batch = {id_: paths for idx, (id_, paths) in enumerate(data_batch.items()) if idx in missing}
+
     params_list = list(data_batch.items())
-    if multi_process:
-        images = mproc.MultiProcessor.run(pre_process, params_list, pre_process_params, mproc.PreProcessingPickleHelper)
+    # open the on-disk cache once for all images instead of once per image
+    fn_kwargs = dict(pre_process_params, pre_processing_cache=get_pre_processing_cache(pre_process_params))
+    if multi_process and params_list:
+        pickle_helper_cls = mproc.SharedMemoryPreProcessingPickleHelper if shared_memory \
+            else mproc.PreProcessingPickleHelper
+        memory_per_call = [estimate_pre_process_memory(paths, **pre_process_params) for _, paths in params_list]
+        pre_processed = mproc.MultiProcessor.run(pre_process, params_list, fn_kwargs, pickle_helper_cls,
+                                                 n_workers, memory_budget, memory_per_call, pool, backend)
     else:
-        images = [pre_process(id_, path, **pre_process_params) for id_, path in params_list]
+        loader = futil.PrefetchingDataLoader(data_batch, get_load_fn(pre_process_params), prefetch_depth,
+                                             prefetch_bytes)
+        pre_processed = [pre_process(id_, data, **fn_kwargs) for id_, data in loader]
+
+    for idx, img in zip(missing, pre_processed):
+        images[idx] = img
+        if cache is not None:
+            cache.put(keys[idx], img)
     return images
 
 
 def post_process_batch(brain_images: t.List[structure.BrainImage], segmentations: t.List[sitk.Image],
-                       probabilities: t.List[sitk.Image], post_process_params: dict = None,
-                       multi_process: bool = True) -> t.List[sitk.Image]:
+                       probabilities: t.List[structure.ProbabilityMap], post_process_params: dict = None,
+                       multi_process: bool = True, shared_memory: bool = False, n_workers: int = None,
+                       memory_budget: int = None, pool: mproc.WorkerPool = None,
+                       backend: str = 'process') -> t.List[sitk.Image]:
     """ Post-processes a batch of images.
 
     Args:
         brain_images (List[structure.BrainImageTypes]): Original images that were used for the prediction.
         segmentations (List[sitk.Image]): The predicted segmentation.
-        probabilities (List[sitk.Image]): The prediction probabilities.
+        probabilities (List[structure.ProbabilityMap]): The prediction probabilities.
         post_process_params (dict): Post-processing parameters.
         multi_process (bool): Whether to use the parallel processing on multiple cores or to run sequentially.
+        shared_memory (bool): Whether to transfer the images from the processes via shared memory instead of pipes.
+        n_workers (int): The number of processes, defaults to the CPUs allocated by SLURM or available.
+        memory_budget (int): The memory in bytes available to the processes, defaults to the memory allocated by SLURM
+            or available. The number of images processed concurrently is limited to fit the budget.
+        pool (mproc.WorkerPool): A pool to process the images in (see :func:`create_worker_pool`), instead of
+            starting a new one.
+        backend (str): Either 'process' or 'thread' to process the images in threads without any conversion
+            (see :meth:`mialab.utilities.multi_processor.MultiProcessor.run`).
 
     Returns:
         List[sitk.Image]: List of post-processed images
@@ -355,8 +929,15 @@ def post_process_batch(brain_images: t.List[structure.BrainImage], segmentations
 
     param_list = zip(brain_images, segmentations, probabilities)
     if multi_process:
-        pp_images = mproc.MultiProcessor.run(post_process, param_list, post_process_params,
-                                             mproc.PostProcessingPickleHelper)
+        pickle_helper_cls = mproc.SharedMemoryPostProcessingPickleHelper if shared_memory \
+            else mproc.PostProcessingPickleHelper
+        # the transferred images and the probabilities, each of them received and converted
+        memory_per_call = [2 * (sum(image.GetNumberOfPixels() * image.GetSizeOfPixelComponent() *
+                                    image.GetNumberOfComponentsPerPixel() for image in img.images.values()) +
+                                seg.GetNumberOfPixels() * seg.GetSizeOfPixelComponent() + prob.nbytes)
+                           for img, seg, prob in zip(brain_images, segmentations, probabilities)]
+        pp_images = mproc.MultiProcessor.run(post_process, param_list, post_process_params, pickle_helper_cls,
+                                             n_workers, memory_budget, memory_per_call, pool, backend)
     else:
         pp_images = [post_process(img, seg, prob, **post_process_params) for img, seg, prob in param_list]
     return pp_images
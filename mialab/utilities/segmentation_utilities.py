@@ -0,0 +1,192 @@
+"""This module contains the functions of the test phase, i.e. segmenting, post-processing and evaluating images
+with a fitted classifier."""
+import functools
+import os
+import tempfile
+import timeit
+import typing as t
+
+import joblib
+import numpy as np
+import pymia.data.conversion as conversion
+import SimpleITK as sitk
+
+import mialab.data.structure as structure
+import mialab.utilities.cache_utilities as cache_util
+import mialab.utilities.file_access_utilities as futil
+import mialab.utilities.multi_processor as mproc
+import mialab.utilities.pipeline_utilities as putil
+import mialab.utilities.stage_executor as stage_exec
+
+
+@functools.lru_cache(maxsize=1)
+def load_forest(path: str):
+    """Loads a classifier saved with :func:`joblib.dump`, once per process.
+
+    Each process holds its own copy of the classifier, because unpickling the trees copies their arrays anyway.
+
+    Args:
+        path (str): The path to the classifier file.
+
+    Returns:
+        The classifier.
+    """
+    return joblib.load(path)
+
+
+def segment(forest, img: structure.BrainImage) -> t.Tuple[sitk.Image, structure.ProbabilityMap]:
+    """Segments an image.
+
+    Args:
+        forest: The classifier.
+        img (structure.BrainImage): The pre-processed image.
+
+    Returns:
+        tuple: The segmentation and the probabilities.
+    """
+    print('-' * 10, 'Testing', img.id_)
+    start_time = timeit.default_timer()
+    predictions, probabilities = putil.predict(forest, img)
+    print(' Time elapsed:', timeit.default_timer() - start_time, 's')
+
+    # convert prediction back to a SimpleITK image and keep the probabilities compact
+    image_prediction = conversion.NumpySimpleITKImageBridge.convert(predictions.astype(np.uint8), img.image_properties)
+    image_probabilities = structure.ProbabilityMap(probabilities, img.image_properties)
+    return image_prediction, image_probabilities
+
+
+def evaluate_and_save(img: structure.BrainImage, segmentation: sitk.Image, segmentation_post_processed: sitk.Image,
+                      result_dir: str) -> t.Tuple[list, list]:
+    """Evaluates the segmentations of an image and saves them.
+
+    Args:
+        img (structure.BrainImage): The pre-processed image.
+        segmentation (sitk.Image): The segmentation.
+        segmentation_post_processed (sitk.Image): The post-processed segmentation.
+        result_dir (str): The directory to save the segmentations to.
+
+    Returns:
+        tuple: The evaluation results of the segmentation and of the post-processed segmentation.
+    """
+    # evaluate segmentation with and without post-processing
+    evaluator = putil.init_evaluator()
+    evaluator.evaluate(segmentation, img.images[structure.BrainImageTypes.GroundTruth], img.id_)
+    results = evaluator.results
+    evaluator.clear()
+    evaluator.evaluate(segmentation_post_processed, img.images[structure.BrainImageTypes.GroundTruth],
+                       img.id_ + '-PP')
+    results_post_processed = evaluator.results
+
+    # save results (in atlas space if the images were cropped to the brain)
+    sitk.WriteImage(putil.embed_roi(img, segmentation), os.path.join(result_dir, img.id_ + '_SEG.mha'), True)
+    sitk.WriteImage(putil.embed_roi(img, segmentation_post_processed),
+                    os.path.join(result_dir, img.id_ + '_SEG-PP.mha'), True)
+    return results, results_post_processed
+
+
+def test_process(id_: str, paths: dict, forest, result_dir: str, pre_process_params: dict = None,
+                 post_process_params: dict = None, cache: cache_util.BrainImageCache = None,
+                 pre_processing_cache: cache_util.PreProcessingCache = None) -> t.Tuple[list, list]:
+    """Loads, processes, segments, post-processes and evaluates an image, and saves its segmentations.
+
+    Args:
+        id_ (str): An image identifier.
+        paths (dict): A dict, where the keys are an image identifier of type structure.BrainImageTypes
+            and the values are paths to the images.
+        forest: The classifier, or the path to the classifier saved with :func:`joblib.dump`.
+        result_dir (str): The directory to save the segmentations to.
+        pre_process_params (dict): Pre-processing parameters.
+        post_process_params (dict): Post-processing parameters.
+        cache (cache_util.BrainImageCache): A cache of pre-processed images
+            (see :func:`mialab.utilities.pipeline_utilities.pre_process_cached`).
+        pre_processing_cache (cache_util.PreProcessingCache): The opened on-disk cache
+            (see :func:`mialab.utilities.pipeline_utilities.pre_process`).
+
+    Returns:
+        tuple: The evaluation results of the segmentation and of the post-processed segmentation.
+    """
+    if pre_process_params is None:
+        pre_process_params = {}
+    if post_process_params is None:
+        post_process_params = {}
+    if isinstance(forest, str):
+        forest = load_forest(forest)
+
+    img = putil.pre_process_cached(id_, paths, cache, pre_processing_cache, **pre_process_params)
+    segmentation, probabilities = segment(forest, img)
+    segmentation_post_processed = putil.post_process(img, segmentation, probabilities, **post_process_params)
+    return evaluate_and_save(img, segmentation, segmentation_post_processed, result_dir)
+
+
+def test_batch(data_batch: t.Dict[structure.BrainImageTypes, structure.BrainImage], forest, result_dir: str,
+               pre_process_params: dict = None, post_process_params: dict = None, multi_process: bool = True,
+               n_workers: int = None, memory_budget: int = None, pool: mproc.WorkerPool = None,
+               backend: str = 'process', queue_size: int = 1, prefetch_depth: int = 2,
+               prefetch_bytes: int = None, cache: cache_util.BrainImageCache = None) -> list:
+    """Processes, segments, post-processes and evaluates a batch of images concurrently (see :func:`test_process`).
+
+    The classifier is saved once to a file loaded once by each process, instead of being pickled for each image.
+    The thread backend shares the classifier directly.
+
+    Args:
+        data_batch (Dict[structure.BrainImageTypes, structure.BrainImage]): Batch of images to be processed.
+        forest: The fitted classifier.
+        result_dir (str): The directory to save the segmentations to.
+        pre_process_params (dict): Pre-processing parameters.
+        post_process_params (dict): Post-processing parameters.
+        multi_process (bool): Whether to process the images in parallel on multiple cores, or to stream them through
+            the processing stages (see :class:`mialab.utilities.stage_executor.StageExecutor`).
+        n_workers (int): The number of processes, defaults to the CPUs allocated by SLURM or available.
+        memory_budget (int): The memory in bytes available to the processes, defaults to the memory allocated by SLURM
+            or available. The number of images processed concurrently is limited to fit the budget.
+        pool (mproc.WorkerPool): A pool to process the images in, instead of starting a new one
+            (see :func:`mialab.utilities.pipeline_utilities.create_worker_pool`).
+        backend (str): Either 'process' or 'thread' to process the images in threads without any conversion
+            (see :meth:`mialab.utilities.multi_processor.MultiProcessor.run`).
+        queue_size (int): The maximum number of images waiting between two stages if not processed in parallel.
+        prefetch_depth (int): The number of images loaded in advance in the background if not processed in parallel.
+        prefetch_bytes (int): The maximum number of bytes of images loaded in advance, or None for no limit.
+        cache (cache_util.BrainImageCache): A cache of pre-processed images
+            (see :func:`mialab.utilities.pipeline_utilities.pre_process_cached`), which is not used by the process
+            backend because the images are pre-processed in other processes.
+
+    Returns:
+        list: The evaluation results of all segmentations followed by the ones of all post-processed segmentations.
+    """
+    if pre_process_params is None:
+        pre_process_params = {}
+    if post_process_params is None:
+        post_process_params = {}
+
+    params_list = list(data_batch.items())
+    pre_processing_cache = putil.get_pre_processing_cache(pre_process_params)  # opened once for all images
+    if not multi_process:
+        # stream the images through the stages, such that loading, pre-processing, segmentation, post-processing and
+        # saving of consecutive images overlap, and at most queue_size images wait between two stages
+        loader = futil.PrefetchingDataLoader(data_batch, putil.get_load_fn(pre_process_params, cache), prefetch_depth,
+                                             prefetch_bytes)
+        executor = stage_exec.StageExecutor([
+            lambda params: putil.pre_process_cached(*params, cache, pre_processing_cache, **pre_process_params),
+            lambda img: (img, *segment(forest, img)),
+            lambda args: (args[0], args[1], putil.post_process(*args, **post_process_params)),
+            lambda args: evaluate_and_save(*args, result_dir)], queue_size)
+        ret_vals = list(executor.run(loader))
+    elif backend == 'thread':
+        ret_vals = mproc.MultiProcessor.run(test_process, params_list, {
+            'forest': forest, 'result_dir': result_dir, 'pre_process_params': pre_process_params,
+            'post_process_params': post_process_params, 'cache': cache,
+            'pre_processing_cache': pre_processing_cache}, n_workers=n_workers, memory_budget=memory_budget,
+            backend=backend)
+    else:
+        memory_per_call = [putil.estimate_pre_process_memory(paths, **pre_process_params) for _, paths in params_list]
+        with tempfile.TemporaryDirectory() as forest_dir:
+            forest_file = os.path.join(forest_dir, 'forest.joblib')
+            joblib.dump(forest, forest_file)
+            ret_vals = mproc.MultiProcessor.run(test_process, params_list, {
+                'forest': forest_file, 'result_dir': result_dir, 'pre_process_params': pre_process_params,
+                'post_process_params': post_process_params, 'pre_processing_cache': pre_processing_cache},
+                n_workers=n_workers, memory_budget=memory_budget, memory_per_call=memory_per_call, pool=pool)
+
+    results = [result for ret_val in ret_vals for result in ret_val[0]]
+    results.extend(result for ret_val in ret_vals for result in ret_val[1])
+    return results
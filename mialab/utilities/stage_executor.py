@@ -0,0 +1,122 @@
+"""Module for the streaming execution of a sequence of processing stages."""
+import queue
+import threading
+import typing as t
+
+
+class _Failure:
+    """Represents an exception raised by a stage, passed downstream to the consumer."""
+
+    def __init__(self, exception: BaseException):
+        self.exception = exception
+
+
+_END = object()  # marks the end of the stream
+
+
+class StageExecutor:
+    """Represents an executor streaming items through a sequence of stages, each stage running in its own thread.
+
+    The stages are connected by bounded queues, such that the stages process consecutive items at the same time,
+    e.g. while an image is classified, the next image is already being pre-processed and the previous one written.
+    At most ``queue_size`` items wait between two stages, i.e. the memory is bounded by the number of stages and the
+    queue size instead of the number of items.
+
+    Examples:
+        >>> executor = StageExecutor([load, process, save], queue_size=1)
+        >>> for result in executor.run(items):
+        >>>     print(result)
+    """
+
+    def __init__(self, stages: t.List[callable], queue_size: int = 1):
+        """Initializes a new instance of the StageExecutor class.
+
+        Args:
+            stages (List[callable]): The stages, each a function taking the output of the previous stage.
+            queue_size (int): The maximum number of items waiting between two stages.
+        """
+        self.stages = stages
+        self.queue_size = queue_size
+
+    def run(self, items: iter) -> iter:
+        """Streams the items through the stages.
+
+        Args:
+            items (iter): The inputs of the first stage.
+
+        Yields:
+            The outputs of the last stage, in the order of the items.
+
+        Raises:
+            Exception: The first exception raised by a stage, after which no more items are yielded.
+        """
+        queues = [queue.Queue(max(self.queue_size, 1)) for _ in range(len(self.stages) + 1)]
+        stop = threading.Event()  # set when the consumer stops early
+
+        threads = [threading.Thread(target=self._feed, args=(items, queues[0], stop), daemon=True)]
+        for stage, in_queue, out_queue in zip(self.stages, queues[:-1], queues[1:]):
+            threads.append(threading.Thread(target=self._process, args=(stage, in_queue, out_queue, stop),
+                                            daemon=True))
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                item = queues[-1].get()
+                if item is _END:
+                    break
+                if isinstance(item, _Failure):
+                    raise item.exception
+                yield item
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    @staticmethod
+    def _put(out_queue: queue.Queue, item, stop: threading.Event) -> bool:
+        while not stop.is_set():
+            try:
+                out_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    @staticmethod
+    def _get(in_queue: queue.Queue, stop: threading.Event):
+        while not stop.is_set():
+            try:
+                return in_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _END
+
+    @staticmethod
+    def _feed(items: iter, out_queue: queue.Queue, stop: threading.Event):
+        iterator = iter(items)
+        try:
+            for item in iterator:
+                if not StageExecutor._put(out_queue, item, stop):
+                    return
+        except Exception as e:
+            StageExecutor._put(out_queue, _Failure(e), stop)
+        finally:
+            # release the resources of a generator stopped early, e.g. the threads of a prefetching loader
+            if hasattr(iterator, 'close'):
+                iterator.close()
+        StageExecutor._put(out_queue, _END, stop)
+
+    @staticmethod
+    def _process(stage: callable, in_queue: queue.Queue, out_queue: queue.Queue, stop: threading.Event):
+        while True:
+            item = StageExecutor._get(in_queue, stop)
+            if item is _END or isinstance(item, _Failure):
+                StageExecutor._put(out_queue, item, stop)  # the remaining items are not processed after a failure
+                return
+            try:
+                result = stage(item)
+            except Exception as e:
+                result = _Failure(e)
+            if not StageExecutor._put(out_queue, result, stop):
+                return
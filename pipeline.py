@@ -9,23 +9,25 @@ import sys
 import timeit
 import warnings
 
-import SimpleITK as sitk
 import sklearn.ensemble as sk_ensemble
 import numpy as np
-import pymia.data.conversion as conversion
 import pymia.evaluation.writer as writer
 import plot_results as plot
 
 try:
     import mialab.data.structure as structure
     import mialab.utilities.file_access_utilities as futil
+    import mialab.utilities.multi_processor as mproc
     import mialab.utilities.pipeline_utilities as putil
+    import mialab.utilities.segmentation_utilities as seg_util
 except ImportError:
     # Append the MIALab root directory to Python path
     sys.path.insert(0, os.path.join(os.path.dirname(sys.argv[0]), '..'))
     import mialab.data.structure as structure
     import mialab.utilities.file_access_utilities as futil
+    import mialab.utilities.multi_processor as mproc
     import mialab.utilities.pipeline_utilities as putil
+    import mialab.utilities.segmentation_utilities as seg_util
 
 LOADING_KEYS = [structure.BrainImageTypes.T1w,
                 structure.BrainImageTypes.T2w,
@@ -52,114 +54,99 @@ def main(result_dir: str, data_atlas_dir: str, data_train_dir: str, data_test_di
     # load atlas images
     putil.load_atlas_images(data_atlas_dir)
 
-    print('-' * 5, 'Training...')
-
-    # crawl the training image directories
-    crawler = futil.FileSystemDataCrawler(data_train_dir,
-                                          LOADING_KEYS,
-                                          futil.BrainImageFilePathGenerator(),
-                                          futil.DataDirectoryFilter())
-    pre_process_params = {'skullstrip_pre': True,
-                          'normalization_pre': True,
-                          'registration_pre': True,
-                          'coordinates_feature': True,
-                          'intensity_feature': True,
-                          'gradient_intensity_feature': True}
-
-    multiprocess = True # Change to True on UBELIX
-
-    # load images for training and pre-process
-    images = putil.pre_process_batch(crawler.data, pre_process_params, multi_process=multiprocess)
-
-    # generate feature matrix and label vector
-    data_train = np.concatenate([img.feature_matrix[0] for img in images])
-    labels_train = np.concatenate([img.feature_matrix[1] for img in images]).squeeze()
-
-    warnings.warn('Random forest parameters not properly set --> Julien tried something out')
-    #forest = sk_ensemble.RandomForestClassifier(max_features=images[0].feature_matrix[0].shape[1],
-        #                                        n_estimators=1,
-        #                                        max_depth=5)
-    forest = sk_ensemble.RandomForestClassifier(
-        n_estimators=20,  # Increased number of trees
-        max_features=7, # images[0].feature_matrix[0].shape[1],  # Fraction of features per split
-        max_depth=50,  # Allow trees to grow fully (or set an appropriate limit)
-        random_state=42,  # For reproducibility
-        bootstrap = True, # Default True
-        ccp_alpha = 0.0, # Default 0.0
-        class_weight = None, # Default None
-        criterion = "gini", # Default "gini"
-        max_leaf_nodes = None,
-        max_samples = None, # Default None
-        min_impurity_decrease = 0.0, # Default 0.0
-        min_samples_leaf = 2, # Default 1
-        min_samples_split = 2, # Default 2
-        min_weight_fraction_leaf = 0.0, # Default 0.0
-        # monotonic_cst = None, # Default None
-        n_jobs = None, # Default None
-        oob_score = False, # Default False
-        verbose = 0, # Default 0
-        warm_start = False # Default False
-    )
-
-
-    start_time = timeit.default_timer()
-    forest.fit(data_train, labels_train)
-    print(' Time elapsed:', timeit.default_timer() - start_time, 's')
-
-    # create a result directory with timestamp
-    t = datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')
-    result_dir = os.path.join(result_dir, t)
-    os.makedirs(result_dir, exist_ok=True)
-
-    print('-' * 5, 'Testing...')
-
-    # initialize evaluator
-    evaluator = putil.init_evaluator()
-
-    # crawl the training image directories
-    crawler = futil.FileSystemDataCrawler(data_test_dir,
-                                          LOADING_KEYS,
-                                          futil.BrainImageFilePathGenerator(),
-                                          futil.DataDirectoryFilter())
+    # start the worker processes once for all phases, each of them loading the atlas images
+    # (closed at the end of the block, or terminated if an error occurs)
+    with putil.create_worker_pool(data_atlas_dir) as pool:
+        print('-' * 5, 'Training...')
+
+        # crawl the training image directories
+        crawler = futil.FileSystemDataCrawler(data_train_dir,
+                                              LOADING_KEYS,
+                                              futil.BrainImageFilePathGenerator(),
+                                              futil.DataDirectoryFilter())
+        pre_process_params = {'skullstrip_pre': True,
+                              'normalization_pre': True,
+                              'bias_correction_pre': False,  # correct the bias fields, which are stored per subject
+                              'inplace_pre': True,  # skull-strip and normalize in place on a float32 array
+                              'mask_normalization': False,  # normalize with the statistics within the brain mask
+                              'registration_pre': True,
+                              'fused_registration': True,  # register all images of a subject at once
+                              'estimate_registration': False,  # estimate the transformations instead of using the given
+                              'coordinates_feature': True,
+                              'intensity_feature': True,
+                              'gradient_intensity_feature': True,
+                              'sampling_seed': 42,
+                              'roi_crop': False,  # crop the images to the brain after registration
+                              'retention_policy': structure.RetentionPolicy.FEATURE_MATRIX,  # only train on features
+                              'cache_dir': None}  # directory to cache the pre-processed images in across runs
+
+        multiprocess = True # Change to True on UBELIX
+
+        # load images for training and pre-process
+        images = putil.pre_process_batch(crawler.data, pre_process_params, multi_process=multiprocess,
+                                         shared_memory=multiprocess, pool=pool)
+
+        # generate feature matrix and label vector
+        data_train = np.concatenate([img.feature_matrix[0] for img in images])
+        labels_train = np.concatenate([img.feature_matrix[1] for img in images]).squeeze()
+        del images
+        mproc.release_shared_memory()  # the feature matrices were views on the shared memory of the processes
+
+        warnings.warn('Random forest parameters not properly set --> Julien tried something out')
+        #forest = sk_ensemble.RandomForestClassifier(max_features=images[0].feature_matrix[0].shape[1],
+            #                                        n_estimators=1,
+            #                                        max_depth=5)
+        forest = sk_ensemble.RandomForestClassifier(
+            n_estimators=20,  # Increased number of trees
+            max_features=7, # images[0].feature_matrix[0].shape[1],  # Fraction of features per split
+            max_depth=50,  # Allow trees to grow fully (or set an appropriate limit)
+            random_state=42,  # For reproducibility
+            bootstrap = True, # Default True
+            ccp_alpha = 0.0, # Default 0.0
+            class_weight = None, # Default None
+            criterion = "gini", # Default "gini"
+            max_leaf_nodes = None,
+            max_samples = None, # Default None
+            min_impurity_decrease = 0.0, # Default 0.0
+            min_samples_leaf = 2, # Default 1
+            min_samples_split = 2, # Default 2
+            min_weight_fraction_leaf = 0.0, # Default 0.0
+            # monotonic_cst = None, # Default None
+            n_jobs = None, # Default None
+            oob_score = False, # Default False
+            verbose = 0, # Default 0
+            warm_start = False # Default False
+        )
 
-    # load images for testing and pre-process
-    pre_process_params['training'] = False
-    images_test = putil.pre_process_batch(crawler.data, pre_process_params, multi_process=False)
-
-    images_prediction = []
-    images_probabilities = []
-
-    for img in images_test:
-        print('-' * 10, 'Testing', img.id_)
 
         start_time = timeit.default_timer()
-        predictions = forest.predict(img.feature_matrix[0])
-        probabilities = forest.predict_proba(img.feature_matrix[0])
+        forest.fit(data_train, labels_train)
         print(' Time elapsed:', timeit.default_timer() - start_time, 's')
 
-        # convert prediction and probabilities back to SimpleITK images
-        image_prediction = conversion.NumpySimpleITKImageBridge.convert(predictions.astype(np.uint8),
-                                                                        img.image_properties)
-        image_probabilities = conversion.NumpySimpleITKImageBridge.convert(probabilities, img.image_properties)
-
-        # evaluate segmentation without post-processing
-        evaluator.evaluate(image_prediction, img.images[structure.BrainImageTypes.GroundTruth], img.id_)
-
-        images_prediction.append(image_prediction)
-        images_probabilities.append(image_probabilities)
-
-    # post-process segmentation and evaluate with post-processing
-    post_process_params = {'simple_post': True}
-    images_post_processed = putil.post_process_batch(images_test, images_prediction, images_probabilities,
-                                                     post_process_params, multi_process=True)
-
-    for i, img in enumerate(images_test):
-        evaluator.evaluate(images_post_processed[i], img.images[structure.BrainImageTypes.GroundTruth],
-                           img.id_ + '-PP')
-
-        # save results
-        sitk.WriteImage(images_prediction[i], os.path.join(result_dir, images_test[i].id_ + '_SEG.mha'), True)
-        sitk.WriteImage(images_post_processed[i], os.path.join(result_dir, images_test[i].id_ + '_SEG-PP.mha'), True)
+        # create a result directory with timestamp
+        t = datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')
+        result_dir = os.path.join(result_dir, t)
+        os.makedirs(result_dir, exist_ok=True)
+
+        print('-' * 5, 'Testing...')
+
+        # initialize evaluator
+        evaluator = putil.init_evaluator()
+
+        # crawl the training image directories
+        crawler = futil.FileSystemDataCrawler(data_test_dir,
+                                              LOADING_KEYS,
+                                              futil.BrainImageFilePathGenerator(),
+                                              futil.DataDirectoryFilter())
+
+        # pre-process, segment, post-process and evaluate the test images, in parallel or streamed through the stages
+        pre_process_params['training'] = False
+        pre_process_params['retention_policy'] = structure.RetentionPolicy.ALL  # segment, post-process and evaluate
+        if not multiprocess:
+            pre_process_params['feature_threads'] = mproc.get_number_of_workers()  # one image at a time, use all CPUs
+        post_process_params = {'simple_post': True}
+        evaluator.results.extend(seg_util.test_batch(crawler.data, forest, result_dir, pre_process_params,
+                                                     post_process_params, multi_process=multiprocess, pool=pool))
 
     # use two writers to report the results
     os.makedirs(result_dir, exist_ok=True)  # generate result directory, if it does not exists
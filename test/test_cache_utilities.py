@@ -0,0 +1,84 @@
+import numpy as np
+import SimpleITK as sitk
+
+import mialab.data.structure as structure
+import mialab.utilities.cache_utilities as cache_util
+import mialab.utilities.multi_processor as mproc
+
+
+def create_brain_image() -> structure.BrainImage:
+    rng = np.random.default_rng(0)
+    images = {structure.BrainImageTypes.T1w: sitk.GetImageFromArray(rng.normal(size=(4, 5, 6)).astype(np.float32))}
+    img = structure.BrainImage('synthetic', '', images, sitk.AffineTransform(3))
+    img.feature_matrix = (rng.normal(size=(8, 3)).astype(np.float32), np.arange(8, dtype=np.int16).reshape((-1, 1)))
+    return img
+
+
+def test_cache_returns_saved_image(tmp_path):
+    cache = cache_util.PreProcessingCache(str(tmp_path))
+    img = create_brain_image()
+    cache.save('key', img)
+
+    cached = cache.load('key')
+    np.testing.assert_array_equal(cached.feature_matrix[0], img.feature_matrix[0])
+    np.testing.assert_array_equal(cached.feature_matrix[1], img.feature_matrix[1])
+    np.testing.assert_array_equal(sitk.GetArrayFromImage(cached.images[structure.BrainImageTypes.T1w]),
+                                  sitk.GetArrayFromImage(img.images[structure.BrainImageTypes.T1w]))
+    assert cache.load('other key') is None
+
+
+def test_code_version_change_invalidates_cache(tmp_path, monkeypatch):
+    cache_util.PreProcessingCache(str(tmp_path)).save('key', create_brain_image())
+
+    # the same code version keeps the entries
+    assert cache_util.PreProcessingCache(str(tmp_path)).load('key') is not None
+
+    monkeypatch.setattr(cache_util, 'get_code_version', lambda: 'another version')
+    cache = cache_util.PreProcessingCache(str(tmp_path))
+    assert cache.load('key') is None
+    assert cache.nbytes == 0
+
+
+def load_cached_image(directory: str) -> structure.BrainImage:
+    return cache_util.PreProcessingCache(directory).load('key')
+
+
+def test_cached_image_is_returned_by_worker_process(tmp_path):
+    img = create_brain_image()
+    cache_util.PreProcessingCache(str(tmp_path)).save('key', img)
+
+    cached, = mproc.MultiProcessor.run(load_cached_image, [(str(tmp_path),)],
+                                       pickle_helper_cls=mproc.PreProcessingPickleHelper, n_workers=2)
+    np.testing.assert_array_equal(cached.feature_matrix[0], img.feature_matrix[0])
+    np.testing.assert_array_equal(cached.feature_matrix[1], img.feature_matrix[1])
+
+
+def test_memory_cache_evicts_least_recently_used_image():
+    images = {key: create_brain_image() for key in ('a', 'b', 'c')}
+    size = cache_util.get_image_size(images['a'])
+    cache = cache_util.BrainImageCache(max_bytes=2 * size)
+    cache.put('a', images['a'])
+    cache.put('b', images['b'])
+    assert cache.get('a') is images['a']  # 'b' is now the least recently used image
+
+    cache.put('c', images['c'])
+    assert len(cache) == 2
+    assert cache.nbytes == 2 * size
+    assert cache.get('b') is None
+    assert cache.get('a') is images['a']
+    assert cache.get('c') is images['c']
+    assert (cache.hits, cache.misses) == (3, 1)
+
+    cache.put('b', images['b'])  # evicts 'a', which is now the least recently used image
+    assert cache.get('a') is None
+    assert cache.get('b') is images['b']
+    assert (cache.hits, cache.misses) == (4, 2)
+
+
+def test_memory_cache_skips_image_exceeding_budget():
+    img = create_brain_image()
+    cache = cache_util.BrainImageCache(max_bytes=cache_util.get_image_size(img) - 1)
+    cache.put('key', img)
+    assert len(cache) == 0
+    assert cache.get('key') is None
+    assert (cache.hits, cache.misses) == (0, 1)
@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+import mialab.filtering.feature_extraction as fltr_feat
+
+
+@pytest.fixture
+def image():
+    rng = np.random.default_rng(0)
+    return sitk.GetImageFromArray(rng.normal(100, 30, (12, 14, 16)).astype(np.float32))
+
+
+@pytest.fixture
+def indices(image):
+    rng = np.random.default_rng(1)
+    # include the voxels at the end of each axis, whose neighborhoods are padded
+    return np.concatenate([rng.choice(image.GetNumberOfPixels(), 200, replace=False), [image.GetNumberOfPixels() - 1]])
+
+
+def get_neighborhoods(image: sitk.Image, kernel: tuple, indices: np.ndarray) -> np.ndarray:
+    # the neighborhoods as placed by the per-voxel loop, i.e. starting at the voxel and padded symmetrically at the end
+    array = sitk.GetArrayFromImage(image)
+    x_offset, y_offset, z_offset = kernel
+    padded = np.pad(array, ((0, z_offset), (0, y_offset), (0, x_offset)), 'symmetric')
+    return np.array([padded[z:z + z_offset, y:y + y_offset, x:x + x_offset]
+                     for z, y, x in zip(*np.unravel_index(indices, array.shape))])
+
+
+@pytest.mark.parametrize('value_range', [None, (0, 200)])
+def test_rolling_histogram_execute_at_equals_execute(image, indices, value_range):
+    extractor = fltr_feat.NeighborhoodFeatureExtractor((3, 3, 3), fltr_feat.RollingHistogramFeatures(16, value_range))
+    features = sitk.GetArrayFromImage(extractor.execute(image)).reshape((-1, 9))
+    np.testing.assert_allclose(extractor.execute_at(image, indices), features[indices], rtol=1e-6, atol=1e-4)
+
+
+def test_batch_texture_features_equal_per_voxel_features(image):
+    image = sitk.Abs(image) + 1  # positive intensities for the entropy
+    batch = fltr_feat.NeighborhoodFeatureExtractor((3, 3, 3))
+    assert batch.batch_function is fltr_feat.first_order_texture_features_batch_function
+    per_voxel = fltr_feat.NeighborhoodFeatureExtractor((3, 3, 3), lambda values:
+                                                       fltr_feat.first_order_texture_features_function(values))
+    assert per_voxel.batch_function is None
+    np.testing.assert_allclose(sitk.GetArrayFromImage(batch.execute(image)),
+                               sitk.GetArrayFromImage(per_voxel.execute(image)), rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize('kernel', [(3, 3, 3), (5, 3, 1)])
+def test_moments_equal_scipy(image, indices, kernel):
+    stats = pytest.importorskip('scipy.stats')
+    moments = sitk.GetArrayFromImage(fltr_feat.NeighborhoodMomentsExtractor([kernel]).execute(image)).reshape((-1, 6))
+    neighborhoods = get_neighborhoods(image, kernel, indices).reshape((indices.size, -1)).astype(np.float64)
+    mean = np.mean(neighborhoods, axis=1)
+    std = np.std(neighborhoods, axis=1)
+    expected = np.column_stack([mean, np.var(neighborhoods, axis=1), std,
+                                stats.skew(neighborhoods, axis=1, bias=False),
+                                stats.kurtosis(neighborhoods, axis=1, fisher=False),
+                                mean / std])
+    np.testing.assert_allclose(moments[indices], expected, rtol=1e-4, atol=1e-3)
+
+
+@pytest.mark.parametrize('extractor', [fltr_feat.NeighborhoodMomentsExtractor([(3, 3, 3), (5, 3, 1)]),
+                                       fltr_feat.NeighborhoodFeatureExtractor((3, 3, 3))])
+def test_execute_at_equals_execute(image, indices, extractor):
+    image = sitk.Abs(image) + 1  # positive intensities for the entropy
+    features = sitk.GetArrayFromImage(extractor.execute(image))
+    features = features.reshape((image.GetNumberOfPixels(), -1))
+    np.testing.assert_allclose(extractor.execute_at(image, indices), features[indices], rtol=1e-5, atol=1e-4)
+
+
+@pytest.fixture
+def ground_truth():
+    rng = np.random.default_rng(2)
+    labels = rng.choice(3, (12, 14, 16), p=[0.8, 0.19, 0.01]).astype(np.uint8)
+    labels[0, 0, :4] = 3  # a label with fewer voxels than requested
+    return sitk.GetImageFromArray(labels)
+
+
+def test_stratified_sampler_draws_counts_per_label(ground_truth):
+    sampler = fltr_feat.StratifiedVoxelSampler([0, 1, 2, 3], label_counts=[50, 30, 20, 10])
+    indices = sampler.get_indices(ground_truth, np.random.default_rng(42))
+    labels = sitk.GetArrayFromImage(ground_truth).ravel()
+    available = np.bincount(labels, minlength=4)
+    assert available[3] < 10  # label 3 has fewer voxels than requested
+    np.testing.assert_array_equal(np.bincount(labels[indices], minlength=4),
+                                  np.minimum([50, 30, 20, 10], available))
+    np.testing.assert_array_equal(indices, np.unique(indices))  # sorted without duplicates
+
+
+def test_stratified_sampler_is_deterministic_under_seed(ground_truth):
+    sampler = fltr_feat.StratifiedVoxelSampler([0, 1, 2], label_fractions=[0.1, 0.5, 1.0])
+    first = sampler.get_indices(ground_truth, np.random.default_rng(42))
+    second = sampler.get_indices(ground_truth, np.random.default_rng(42))
+    other = sampler.get_indices(ground_truth, np.random.default_rng(43))
+    np.testing.assert_array_equal(first, second)
+    assert not np.array_equal(first, other)
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+import mialab.utilities.file_access_utilities as futil
+
+
+def create_data(n: int = 6) -> dict:
+    return {'subject{}'.format(idx): {'id': 'subject{}'.format(idx), 'value': idx} for idx in range(n)}
+
+
+def load(paths: dict) -> dict:
+    paths['image'] = sitk.GetImageFromArray(np.full((4, 5, 6), paths['value'], np.float32))
+    return paths
+
+
+@pytest.mark.parametrize('depth, max_bytes, n_threads', [(0, None, 1), (2, None, 1), (3, None, 2), (2, 500, 2)])
+def test_prefetching_loader_equals_sequential_loader(depth, max_bytes, n_threads):
+    data = create_data()
+    loader = futil.PrefetchingDataLoader(data, load, depth=depth, max_bytes=max_bytes, n_threads=n_threads)
+    loaded = list(loader)
+    assert [id_ for id_, _ in loaded] == list(data)
+    for (id_, item), expected in zip(loaded, (load(dict(paths)) for paths in data.values())):
+        assert item.keys() == expected.keys()
+        assert item['value'] == expected['value']
+        np.testing.assert_array_equal(sitk.GetArrayFromImage(item['image']), sitk.GetArrayFromImage(expected['image']))
+    assert all('image' not in paths for paths in data.values())  # the data is not modified
+
+
+@pytest.mark.parametrize('failing', [0, 3])
+def test_prefetching_loader_propagates_exception(failing):
+    def load_or_fail(paths: dict) -> dict:
+        if paths['value'] == failing:
+            raise IOError('cannot read {}'.format(paths['id']))
+        return load(paths)
+
+    loader = futil.PrefetchingDataLoader(create_data(), load_or_fail, depth=2, n_threads=2)
+    ids = []
+    with pytest.raises(IOError, match='cannot read subject{}'.format(failing)):
+        for id_, _ in loader:
+            ids.append(id_)
+    assert ids == ['subject{}'.format(idx) for idx in range(failing)]
@@ -0,0 +1,59 @@
+import os
+import time
+
+import numpy as np
+import pytest
+
+import mialab.utilities.multi_processor as mproc
+
+
+class SharedArrayPickleHelper(mproc.DefaultPickleHelper):
+
+    def make_return_value_picklable(self, ret_val):
+        return mproc.SharedArray(ret_val)
+
+    def recover_return_value(self, ret_val):
+        array = ret_val.attach().copy()
+        ret_val.release()
+        return array
+
+    def discard_return_value(self, ret_val):
+        ret_val.discard()
+
+
+def create_array(idx):
+    if idx == 0:
+        raise ValueError('failing task')
+    time.sleep(0.2)  # finish after the failing task
+    return np.full((8, 8), idx, np.float32)
+
+
+def get_segments():
+    return {name for name in os.listdir('/dev/shm') if name.startswith('psm_')}
+
+
+@pytest.mark.skipif(not os.path.isdir('/dev/shm'), reason='requires POSIX shared memory')
+def test_failing_task_releases_shared_memory():
+    segments = get_segments()
+    with mproc.WorkerPool(2) as pool:
+        with pytest.raises(ValueError):
+            mproc.MultiProcessor.run(create_array, [(idx,) for idx in range(4)],
+                                     pickle_helper_cls=SharedArrayPickleHelper, pool=pool)
+        # the pool is still alive, i.e. the segments have not been freed by terminating the workers
+        assert get_segments() == segments
+
+        ret_vals = mproc.MultiProcessor.run(create_array, [(idx,) for idx in range(1, 4)],
+                                            pickle_helper_cls=SharedArrayPickleHelper, pool=pool)
+    assert [ret_val[0, 0] for ret_val in ret_vals] == [1, 2, 3]
+    assert get_segments() == segments
+
+
+@pytest.mark.skipif(not os.path.isdir('/dev/shm'), reason='requires POSIX shared memory')
+def test_early_stop_releases_shared_memory():
+    segments = get_segments()
+    with mproc.WorkerPool(2) as pool:
+        ret_vals = mproc.MultiProcessor.imap_unordered(create_array, [(idx,) for idx in range(1, 5)],
+                                                       pickle_helper_cls=SharedArrayPickleHelper, pool=pool)
+        next(ret_vals)
+        ret_vals.close()
+        assert get_segments() == segments
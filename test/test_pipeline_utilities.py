@@ -0,0 +1,111 @@
+import numpy as np
+import pymia.data.conversion as conversion
+import pytest
+import SimpleITK as sitk
+
+import mialab.data.structure as structure
+import mialab.utilities.pipeline_utilities as putil
+
+
+def create_brain_image(seed: int = 0) -> structure.BrainImage:
+    rng = np.random.default_rng(seed)
+    shape = (10, 12, 14)
+    images = {structure.BrainImageTypes.T1w: rng.normal(100, 30, shape).astype(np.float32),
+              structure.BrainImageTypes.T2w: rng.normal(50, 10, shape).astype(np.float32),
+              structure.BrainImageTypes.GroundTruth: rng.integers(0, 6, shape).astype(np.uint8),
+              structure.BrainImageTypes.BrainMask: np.ones(shape, np.uint8)}
+    images = {key: sitk.GetImageFromArray(array) for key, array in images.items()}
+    for image in images.values():
+        image.SetSpacing((1.0, 1.5, 2.0))
+    return structure.BrainImage('synthetic', '', images, sitk.Transform())
+
+
+def extract_features(**kwargs) -> structure.BrainImage:
+    params = {'training': True, 'sampling_seed': 42, 'label_counts': [20] * 6, 'coordinates_feature': True,
+              'intensity_feature': True, 'gradient_intensity_feature': True}
+    params.update(kwargs)
+    return putil.FeatureExtractor(create_brain_image(), **params).execute()
+
+
+@pytest.mark.parametrize('feature', ['moments_feature', 'texture_feature', 'histogram_feature'])
+def test_sparse_features_equal_dense_features(feature):
+    dense = extract_features(**{feature: True})
+    sparse = extract_features(**{feature: True}, sparse_features=True)
+    np.testing.assert_allclose(sparse.feature_matrix[0], dense.feature_matrix[0], rtol=1e-5, atol=1e-4)
+    np.testing.assert_array_equal(sparse.feature_matrix[1], dense.feature_matrix[1])
+
+
+def test_concurrent_features_equal_sequential_features():
+    sequential = extract_features(moments_feature=True)
+    concurrent = extract_features(moments_feature=True, feature_threads=3)
+    assert list(concurrent.feature_images) == list(sequential.feature_images)
+    np.testing.assert_array_equal(concurrent.feature_matrix[0], sequential.feature_matrix[0])
+    np.testing.assert_array_equal(concurrent.feature_matrix[1], sequential.feature_matrix[1])
+
+
+@pytest.mark.parametrize('training', [False, True])
+def test_feature_matrix_equals_concatenated_feature_images(training):
+    extractor = putil.FeatureExtractor(create_brain_image(), training=training, sampling_seed=42, label_counts=[20] * 6,
+                                       coordinates_feature=True, intensity_feature=True,
+                                       gradient_intensity_feature=True, moments_feature=True)
+    img = extractor.execute()
+    number_of_voxels = img.images[structure.BrainImageTypes.GroundTruth].GetNumberOfPixels()
+    columns = [np.asarray(image if isinstance(image, np.ndarray) else sitk.GetArrayFromImage(image))
+               .reshape((number_of_voxels, -1)) for image in img.feature_images.values()]
+    expected = np.concatenate(columns, axis=1).astype(np.float32)
+    labels = sitk.GetArrayFromImage(img.images[structure.BrainImageTypes.GroundTruth]).reshape((-1, 1))
+    rows = extractor.indices if training else np.arange(number_of_voxels)
+    assert img.feature_matrix[0].dtype == np.float32
+    np.testing.assert_array_equal(img.feature_matrix[0], expected[rows])
+    np.testing.assert_array_equal(img.feature_matrix[1], labels[rows])
+
+
+def test_embed_roi_restores_cropped_image():
+    img = create_brain_image()
+    mask = np.zeros((10, 12, 14), np.uint8)
+    mask[3:6, 2:9, 4:7] = 1
+    img.images[structure.BrainImageTypes.BrainMask] = sitk.GetImageFromArray(mask)
+    direction = (0.0, 1.0, 0.0, -1.0, 0.0, 0.0, 0.0, 0.0, 1.0)
+    for image in img.images.values():
+        image.SetSpacing((1.0, 1.5, 2.0))
+        image.SetOrigin((-10.0, 5.0, 2.5))
+        image.SetDirection(direction)
+    img.image_properties = conversion.ImageProperties(img.images[structure.BrainImageTypes.T1w])
+    t1w = sitk.GetArrayFromImage(img.images[structure.BrainImageTypes.T1w])
+
+    putil.crop_to_roi(img, padding=1)
+    assert img.images[structure.BrainImageTypes.T1w].GetSize() == (5, 9, 5)
+    embedded = putil.embed_roi(img, img.images[structure.BrainImageTypes.T1w])
+
+    assert embedded.GetOrigin() == (-10.0, 5.0, 2.5)
+    assert embedded.GetSpacing() == (1.0, 1.5, 2.0)
+    assert embedded.GetDirection() == direction
+    assert embedded.GetSize() == (14, 12, 10)
+    roi = (slice(2, 7), slice(1, 10), slice(3, 8))
+    embedded_array = sitk.GetArrayFromImage(embedded)
+    np.testing.assert_array_equal(embedded_array[roi], t1w[roi])
+    embedded_array[roi] = 0
+    assert not embedded_array.any()  # background outside the region of interest
+
+
+
+def test_predict_assigns_background_outside_brain_mask():
+    ensemble = pytest.importorskip('sklearn.ensemble')
+    training = extract_features()
+    forest = ensemble.RandomForestClassifier(n_estimators=5, max_depth=4, random_state=42)
+    forest.fit(training.feature_matrix[0], training.feature_matrix[1].ravel())
+    img = extract_features(training=False)
+    mask = np.zeros((10, 12, 14), np.uint8)
+    mask[2:8, 3:9, 4:10] = 1
+    img.images[structure.BrainImageTypes.BrainMask] = sitk.GetImageFromArray(mask)
+    inside = mask.ravel() == 1
+
+    predictions, probabilities = putil.predict(forest, img, chunk_size=50)
+
+    features = img.feature_matrix[0]
+    np.testing.assert_array_equal(predictions[inside], forest.predict(features)[inside])
+    np.testing.assert_allclose(probabilities[inside], forest.predict_proba(features)[inside], rtol=1e-6)
+    np.testing.assert_array_equal(predictions[~inside], 0)
+    expected_background = np.zeros(forest.classes_.size)
+    expected_background[forest.classes_ == 0] = 1
+    np.testing.assert_array_equal(probabilities[~inside], np.tile(expected_background, (np.sum(~inside), 1)))
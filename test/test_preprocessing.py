@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+import mialab.filtering.preprocessing as fltr_prep
+
+
+def create_image(array: np.ndarray, spacing: tuple = (1.2, 1.1, 1.3)) -> sitk.Image:
+    image = sitk.GetImageFromArray(array)
+    image.SetSpacing(spacing)
+    image.SetOrigin((-1.0, 2.0, 0.5))
+    return image
+
+
+@pytest.fixture
+def subject():
+    rng = np.random.default_rng(0)
+    shape = (16, 18, 20)
+    z, y, x = np.indices(shape)
+    mask = ((z - 8) ** 2 / 36 + (y - 9) ** 2 / 49 + (x - 10) ** 2 / 64 < 1).astype(np.uint8)
+    t1w = rng.normal(100, 30, shape).astype(np.float32)
+    t2w = rng.normal(50, 10, shape).astype(np.float32)
+    ground_truth = (rng.integers(1, 6, shape) * mask).astype(np.uint8)
+    return [create_image(mask), create_image(t1w), create_image(t2w), create_image(ground_truth)]
+
+
+@pytest.fixture
+def atlas():
+    return create_image(np.zeros((18, 18, 18), np.float32), (1.0, 1.0, 1.0))
+
+
+@pytest.fixture
+def transformation():
+    return sitk.Euler3DTransform((8.0, 10.0, 12.0), 0.05, -0.03, 0.1, (0.7, -0.4, 1.1))
+
+
+@pytest.mark.parametrize('mask_index', [None, 0])
+def test_multi_image_registration_equals_image_registration(subject, atlas, transformation, mask_index):
+    is_label = [True, False, False, True]
+    fused = fltr_prep.MultiImageRegistration().execute(
+        subject, fltr_prep.MultiImageRegistrationParameters(atlas, transformation, is_label, mask_index))
+    separate = [fltr_prep.ImageRegistration().execute(
+        image, fltr_prep.ImageRegistrationParameters(atlas, transformation, label))
+        for image, label in zip(subject, is_label)]
+
+    mask = sitk.GetArrayFromImage(separate[0]) != 0
+    assert mask.any() and not mask.all()
+    for fused_image, separate_image, label in zip(fused, separate, is_label):
+        assert fused_image.GetSize() == atlas.GetSize()
+        assert fused_image.GetOrigin() == atlas.GetOrigin()
+        fused_array = sitk.GetArrayFromImage(fused_image)
+        separate_array = sitk.GetArrayFromImage(separate_image)
+        if mask_index is not None and not label:
+            # the intensities are only interpolated within the bounding box of the registered mask
+            fused_array, separate_array = fused_array[mask], separate_array[mask]
+        np.testing.assert_array_equal(fused_array, separate_array)
+
+
+@pytest.mark.parametrize('chunk_size', [1 << 20, 1000])
+def test_skull_stripping_normalization_equals_separate_filters(subject, chunk_size):
+    mask, t1w = subject[0], subject[1]
+    fused = fltr_prep.SkullStrippingNormalization(chunk_size).execute(
+        t1w, fltr_prep.SkullStrippingNormalizationParameters(mask, True, mask_aware=False))
+    separate = fltr_prep.ImageNormalization().execute(
+        fltr_prep.SkullStripping().execute(t1w, fltr_prep.SkullStrippingParameters(mask)))
+
+    assert fused.GetPixelID() == sitk.sitkFloat32
+    assert fused.GetSpacing() == t1w.GetSpacing() and fused.GetOrigin() == t1w.GetOrigin()
+    np.testing.assert_allclose(sitk.GetArrayFromImage(fused), sitk.GetArrayFromImage(separate), rtol=1e-5, atol=1e-5)
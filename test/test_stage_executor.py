@@ -0,0 +1,48 @@
+import threading
+
+import pytest
+
+import mialab.utilities.stage_executor as stage_exec
+
+
+def fail_at(value):
+    def stage(item):
+        if item == value:
+            raise ValueError('failing stage')
+        return item
+    return stage
+
+
+def test_run_yields_items_in_order():
+    executor = stage_exec.StageExecutor([lambda item: item + 1, lambda item: item * 2], queue_size=1)
+    assert list(executor.run(range(10))) == [(item + 1) * 2 for item in range(10)]
+
+
+def test_stage_error_stops_all_threads():
+    threads = threading.active_count()
+    executor = stage_exec.StageExecutor([lambda item: item, fail_at(3), lambda item: item], queue_size=1)
+    results = []
+    with pytest.raises(ValueError):
+        for result in executor.run(range(100)):
+            results.append(result)
+    assert results == [0, 1, 2]
+    assert threading.active_count() == threads
+
+
+def test_early_stop_closes_the_items():
+    closed = threading.Event()
+
+    def generate_items():
+        try:
+            for item in range(100):
+                yield item
+        finally:
+            closed.set()
+
+    threads = threading.active_count()
+    executor = stage_exec.StageExecutor([lambda item: item, lambda item: item], queue_size=1)
+    results = executor.run(generate_items())
+    assert next(results) == 0
+    results.close()
+    assert closed.is_set()
+    assert threading.active_count() == threads